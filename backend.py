@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.backend
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: geodata operations behind arcpy and NumPy backends
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import glob
+import logging
+import os
+from os.path import basename, exists, join, splitext
+
+import numpy as np
+
+from . import eez
+from . import split
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+XY_FIELDS = ('POINT_X', 'POINT_Y')
+
+
+# ------------------------------------------------------------------------------
+# ARCPY
+# ------------------------------------------------------------------------------
+class ArcpyBackend(object):
+
+    '''
+    Backend calling arcpy tools; Raw_Month and Raw_MMSI run their split, XY,
+    EEZ selection and export reads through it. Requires ArcGIS.
+
+    A backend works on workspaces and the point datasets inside them, the way
+    a file geodatabase holds feature classes; datasets are referred to by
+    path. Both backends provide create_workspace, path, exists, delete, list,
+    describe, write, write_polygon, read, cursor, split, add_xy, append and
+    select_within. A polygon dataset is what select_within tests points
+    against: a polygon feature class or shapefile here, and a saved EEZ mask
+    for NumpyBackend.
+    '''
+
+    name = 'arcpy'
+
+    def __init__(self, spatial_reference = 4269):
+        import arcpy
+        self.arcpy = arcpy
+        self.sr = arcpy.SpatialReference(spatial_reference)
+
+    def create_workspace(self, directory, name):
+        if not exists(directory):
+            os.makedirs(directory)
+        self.arcpy.CreateFileGDB_management(directory, name + '.gdb')
+        return join(directory, name + '.gdb')
+
+    def path(self, workspace, name):
+        return join(workspace, self.arcpy.ValidateTableName(str(name), workspace))
+
+    def exists(self, dataset):
+        return self.arcpy.Exists(dataset)
+
+    def delete(self, dataset):
+        self.arcpy.Delete_management(dataset)
+
+    def list(self, workspace):
+        datasets = []
+        for dirpath, dirnames, filenames in self.arcpy.da.Walk(
+                workspace, datatype='FeatureClass'):
+            datasets.extend(join(dirpath, name) for name in filenames)
+        return datasets
+
+    def describe(self, dataset):
+        return {
+            'name': self.arcpy.Describe(dataset).name,
+            'fields': [f.name for f in self.arcpy.ListFields(dataset)],
+            'count': int(self.arcpy.GetCount_management(dataset).getOutput(0))}
+
+    def write(self, array, dataset):
+        self.arcpy.da.NumPyArrayToFeatureClass(array, dataset, XY_FIELDS, self.sr)
+
+    def write_polygon(self, rings, dataset):
+        workspace, name = os.path.split(dataset)
+        self.arcpy.CreateFeatureclass_management(
+            workspace, name, 'POLYGON', spatial_reference=self.sr)
+        parts = self.arcpy.Array([
+            self.arcpy.Array([self.arcpy.Point(x, y) for x, y in ring])
+            for ring in rings])
+        with self.arcpy.da.InsertCursor(dataset, ['SHAPE@']) as cursor:
+            cursor.insertRow([self.arcpy.Polygon(parts, self.sr)])
+
+    def read(self, dataset, fields = None):
+        from .raw import read_array
+        array = read_array(dataset)
+        return array if fields is None else array[list(fields)]
+
+    def cursor(self, dataset, fields):
+        with self.arcpy.da.SearchCursor(dataset, fields) as cursor:
+            for row in cursor:
+                yield row
+
+    def split(self, dataset, workspace, field = 'MMSI'):
+        before = len(self.list(workspace))
+        self.arcpy.SplitByAttributes_analysis(dataset, workspace, [field])
+        return len(self.list(workspace)) - before
+
+    def add_xy(self, dataset):
+        self.arcpy.AddXY_management(dataset)
+
+    def append(self, source, target):
+        if self.arcpy.Exists(target):
+            self.arcpy.Append_management(source, target)
+        else:
+            self.arcpy.Copy_management(source, target)
+
+    def select_within(self, dataset, polygon, output, minimum = 1):
+        '''
+        Write the points of a dataset that are within a polygon dataset to
+        output if there are at least minimum of them, and return their
+        number.
+        '''
+        layer = basename(dataset) + '_lyr'
+        self.arcpy.MakeFeatureLayer_management(dataset, layer)
+        self.arcpy.SelectLayerByLocation_management(layer, 'within', polygon)
+        count = int(self.arcpy.GetCount_management(layer).getOutput(0))
+        if count >= minimum:
+            self.arcpy.CopyFeatures_management(layer, output)
+        self.arcpy.Delete_management(layer)
+        return count
+
+
+# ------------------------------------------------------------------------------
+# NUMPY
+# ------------------------------------------------------------------------------
+class NumpyBackend(object):
+
+    '''
+    Backend on local files that needs only NumPy. A workspace is a folder
+    and each dataset a NumPy .npy file of records with POINT_X and POINT_Y
+    fields in place of a geometry, so add_xy has nothing to do. A polygon
+    dataset is an EEZ mask saved as .npz (see ais_arcpy.eez).
+    '''
+
+    name = 'numpy'
+
+    def create_workspace(self, directory, name):
+        workspace = join(directory, name)
+        if not exists(workspace):
+            os.makedirs(workspace)
+        return workspace
+
+    def path(self, workspace, name):
+        return join(workspace, '%s.npy' % name)
+
+    def exists(self, dataset):
+        return exists(dataset)
+
+    def delete(self, dataset):
+        os.remove(dataset)
+
+    def list(self, workspace):
+        return sorted(glob.glob(join(workspace, '*.npy')))
+
+    def describe(self, dataset):
+        array = np.load(dataset, mmap_mode='r')
+        return {
+            'name': splitext(basename(dataset))[0],
+            'fields': list(array.dtype.names),
+            'count': len(array)}
+
+    def write(self, array, dataset):
+        temp = dataset + '.tmp.npy'
+        np.save(temp, array)
+        util.replace_file(temp, dataset)
+
+    def write_polygon(self, rings, dataset):
+        eez.EEZMask.build(rings).save(dataset)
+
+    def read(self, dataset, fields = None):
+        array = np.load(dataset)
+        return array if fields is None else array[list(fields)]
+
+    def cursor(self, dataset, fields):
+        array = np.load(dataset, mmap_mode='r')
+        columns = []
+        for name in fields:
+            column = array[name]
+            if column.dtype.kind == 'M':
+                column = column.astype('M8[us]')
+            columns.append(column)
+        for start in range(0, len(array), split.BATCH_SIZE):
+            batch = [c[start:start + split.BATCH_SIZE].tolist() for c in columns]
+            for row in zip(*batch):
+                yield row
+
+    def split(self, dataset, workspace, field = 'MMSI'):
+        array = split.sort_by_mmsi(np.load(dataset), key=field)
+        count = 0
+        for value, group in split.iter_groups(array, key=field):
+            output = self.path(workspace, value)
+            if exists(output):
+                continue
+            self.write(group, output)
+            count += 1
+        return count
+
+    def add_xy(self, dataset):
+        names = np.load(dataset, mmap_mode='r').dtype.names
+        missing = [name for name in XY_FIELDS if name not in names]
+        if missing:
+            raise ValueError('%s has no %s field.' % (dataset, missing[0]))
+
+    def append(self, source, target):
+        array = np.load(source)
+        if exists(target):
+            array = np.concatenate((np.load(target), array))
+        self.write(array, target)
+
+    def select_within(self, dataset, polygon, output, minimum = 1):
+        array = np.load(dataset)
+        mask = eez.EEZMask.load(polygon)
+        array = array[mask.contains(array['POINT_X'], array['POINT_Y'])]
+        if len(array) >= minimum:
+            self.write(array, output)
+        return len(array)
+
+
+# ------------------------------------------------------------------------------
+# FACTORY
+# ------------------------------------------------------------------------------
+BACKENDS = {
+    'arcpy': ArcpyBackend,
+    'numpy': NumpyBackend}
+
+def get_backend(name):
+    '''
+    Return a backend instance by name.
+
+    :param name: 'arcpy' or 'numpy'
+    :type name: string
+
+    :return: backend
+    :rtype: ArcpyBackend or NumpyBackend
+    '''
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend %s.' % name)
+    return BACKENDS[name]()
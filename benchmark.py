@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.benchmark
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: benchmark preprocessing stages on synthetic data
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import csv
+from datetime import datetime
+import logging
+from os.path import basename, join, splitext
+import shutil
+import sys
+import tempfile
+import time
+
+from . import backend
+from . import export
+from . import split
+from . import synthetic
+from . import track
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+SCALES = (1, 10, 100)
+STAGES = ('split', 'describe', 'add_xy', 'append', 'select_within', 'cursor')
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def dataset_name(dataset):
+    '''
+    Return the name of a dataset without its folder or extension.
+    '''
+    return splitext(basename(dataset))[0]
+
+
+# ------------------------------------------------------------------------------
+# SPLIT
+# ------------------------------------------------------------------------------
+def bench_split_numpy(rows = 1000000, vessels = 5000, repeat = 3):
+    '''
+    Time the in-memory NumPy group-by on a synthetic month and return the
+    best rows per second.
+
+    :param rows: Number of rows in the synthetic month
+    :param vessels: Number of distinct MMSI
+    :param repeat: Number of timed runs
+
+    :type rows: int
+    :type vessels: int
+    :type repeat: int
+
+    :return: Rows per second
+    :rtype: float
+    '''
+    array = synthetic.synthetic_month(rows, vessels)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        groups = 0
+        for mmsi, group in split.iter_groups(split.sort_by_mmsi(array)):
+            groups += 1
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    logger.info('NumPy group-by: %d rows, %d groups in %.3fs', rows, groups, best)
+    return rows / best
+
+def bench_split_arcpy(rows = 100000, vessels = 500, directory = None):
+    '''
+    Time Raw_Month.split_by_mmsi with the 'arcpy' and 'numpy' engines on the
+    same synthetic month written to a scratch file geodatabase. Requires
+    arcpy.
+
+    :param rows: Number of rows in the synthetic month
+    :param vessels: Number of distinct MMSI
+    :param directory: Scratch directory, a temporary one is used by default
+
+    :type rows: int
+    :type vessels: int
+    :type directory: string
+
+    :return: Rows per second for each engine
+    :rtype: dict
+    '''
+    import arcpy
+    from . import raw
+
+    scratch = directory or tempfile.mkdtemp()
+    array = synthetic.synthetic_month(rows, vessels)
+    sr = arcpy.SpatialReference(4269)
+    result = {}
+    try:
+        for engine in ('arcpy', 'numpy'):
+            raw_month = raw.Raw_Month(join(scratch, engine), '10', '2014', '01',
+                                      split_engine=engine)
+            arcpy.CreateFileGDB_management(raw_month.workspace, raw_month.gdb_copy)
+            arcpy.da.NumPyArrayToFeatureClass(
+                array,
+                join(raw_month.workspace, raw_month.gdb_copy, raw_month.broadcast),
+                ('POINT_X', 'POINT_Y'),
+                sr)
+            start = time.time()
+            raw_month.split_by_mmsi()
+            elapsed = time.time() - start
+            logger.info('%s split: %d rows in %.3fs', engine, rows, elapsed)
+            result[engine] = rows / elapsed
+    finally:
+        if directory is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return result
+
+
+# ------------------------------------------------------------------------------
+# STAGES
+# ------------------------------------------------------------------------------
+def bench_stages(scale = 1, engine = 'numpy', directory = None):
+    '''
+    Run every preprocessing stage of one synthetic month through a backend
+    (see ais_arcpy.backend) and time each stage. The stages follow
+    Raw_Month and Raw_MMSI: split the Broadcast dataset by MMSI, list and
+    describe the MMSI datasets, add XY fields, append them to the MMSI
+    workspace, select the points within the EEZ, and write them to csv with
+    a cursor. With the 'arcpy' backend these are the calls Raw_Month and
+    Raw_MMSI make.
+
+    :param scale: Size of the month as a multiple of synthetic.SCALE_ROWS
+    :param engine: Name of the backend, 'numpy' or 'arcpy'
+    :param directory: Scratch directory, a temporary one is used by default
+
+    :type scale: int
+    :type engine: string
+    :type directory: string
+
+    :return: Seconds spent in each stage, with the row and vessel counts
+    :rtype: dict
+    '''
+    geo = backend.get_backend(engine)
+    scratch = directory or tempfile.mkdtemp()
+    array = synthetic.scaled_month(scale)
+    timings = {'rows': len(array)}
+    try:
+        month = geo.create_workspace(scratch, 'month')
+        mmsi = geo.create_workspace(scratch, 'mmsi')
+        selected = geo.create_workspace(scratch, 'eez')
+        polygon = join(scratch, 'eez_polygon.npz')
+        if engine != 'numpy':
+            polygon = geo.path(mmsi, 'eez_polygon')
+        geo.write_polygon(synthetic.synthetic_eez(), polygon)
+        broadcast = geo.path(month, 'Broadcast')
+        geo.write(array, broadcast)
+        del array
+
+        start = time.time()
+        timings['vessels'] = geo.split(broadcast, month)
+        geo.delete(broadcast)
+        timings['split'] = time.time() - start
+
+        start = time.time()
+        datasets = [
+            d for d in geo.list(month)
+            if geo.describe(d)['count']]
+        timings['describe'] = time.time() - start
+
+        start = time.time()
+        for dataset in datasets:
+            geo.add_xy(dataset)
+        timings['add_xy'] = time.time() - start
+
+        start = time.time()
+        targets = []
+        for dataset in datasets:
+            target = geo.path(mmsi, dataset_name(dataset))
+            geo.append(dataset, target)
+            targets.append(target)
+        timings['append'] = time.time() - start
+
+        start = time.time()
+        outputs = []
+        for target in targets:
+            output = geo.path(selected, dataset_name(target))
+            if geo.select_within(target, polygon, output, minimum=3) > 2:
+                outputs.append(output)
+        timings['select_within'] = time.time() - start
+
+        start = time.time()
+        fields = list(synthetic.BROADCAST_DTYPE.names)
+        for output in outputs:
+            csv_path = join(scratch, dataset_name(output) + '.csv')
+            export.write_csv(csv_path, fields, list(geo.cursor(output, fields)))
+        timings['cursor'] = time.time() - start
+    finally:
+        if directory is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    logger.info(
+        '%s backend at %dx: %d rows, %d vessels', engine, scale,
+        timings['rows'], timings['vessels'])
+    for stage in STAGES:
+        logger.info('    %-14s %8.3fs', stage, timings[stage])
+    return timings
+
+def bench_suite(scales = SCALES, engine = 'numpy', directory = None):
+    '''
+    Time every stage at several scales and return the timings by scale.
+
+    :param scales: Multiples of synthetic.SCALE_ROWS to run
+    :param engine: Name of the backend, 'numpy' or 'arcpy'
+    :param directory: Scratch directory, a temporary one is used by default
+
+    :type scales: list of ints
+    :type engine: string
+    :type directory: string
+
+    :return: Dictionary of scale to stage timings
+    :rtype: dict
+    '''
+    results = {}
+    for scale in scales:
+        scratch = None if directory is None else join(directory, '%dx' % scale)
+        results[scale] = bench_stages(scale, engine, scratch)
+    return results
+
+def format_suite(results):
+    '''
+    Return a table of stage timings with one column per scale.
+    '''
+    scales = sorted(results)
+    lines = ['%-14s' % 'stage' + ''.join('%12s' % ('%dx' % s) for s in scales)]
+    for key in ('rows', 'vessels'):
+        lines.append('%-14s' % key + ''.join(
+            '%12d' % results[s][key] for s in scales))
+    for stage in STAGES + ('total',):
+        seconds = [
+            sum(results[s][k] for k in STAGES) if stage == 'total'
+            else results[s][stage] for s in scales]
+        lines.append('%-14s' % stage + ''.join('%11.3fs' % t for t in seconds))
+    return '\n'.join(lines)
+
+
+# ------------------------------------------------------------------------------
+# TRACK
+# ------------------------------------------------------------------------------
+def row_bytes(rows):
+    '''
+    Return the approximate bytes held by a list of row tuples and the values
+    in them.
+    '''
+    return sys.getsizeof(rows) + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+        for row in rows)
+
+def bench_track(rows = 1000000, directory = None):
+    '''
+    Load a synthetic vessel-year from csv as tuples, the way consumers of
+    the exported files read them, and as a track.Track, and compare the time
+    and memory of each.
+
+    :param rows: Number of points of the vessel
+    :param directory: Scratch directory, a temporary one is used by default
+
+    :type rows: int
+    :type directory: string
+
+    :return: Seconds and bytes of the tuples and of the track
+    :rtype: dict
+    '''
+    scratch = directory or tempfile.mkdtemp()
+    array = synthetic.synthetic_tracks(rows, 1, 2014, 1)
+    fields = list(array.dtype.names)
+    filepath = join(scratch, 'track.csv')
+    columns = dict((name, array[name]) for name in fields)
+    export.write_csv(filepath, fields, export.column_rows(columns, fields))
+
+    time_field = fields.index('BaseDateTime')
+    start = time.time()
+    with track.open_csv(filepath) as f:
+        reader = csv.reader(f)
+        next(reader)
+        tuples = [
+            tuple(
+                datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if i == time_field
+                else float(value) for i, value in enumerate(row))
+            for row in reader]
+    results = {'tuples_seconds': time.time() - start, 'tuples_bytes': row_bytes(tuples)}
+    del tuples
+
+    start = time.time()
+    loaded = track.Track.from_csv(filepath)
+    results['track_seconds'] = time.time() - start
+    results['track_bytes'] = loaded.nbytes
+    if directory is None:
+        shutil.rmtree(scratch)
+    logger.info(
+        'Track load: tuples %.2fs %.1f MB, track %.2fs %.1f MB.',
+        results['tuples_seconds'], results['tuples_bytes'] / 1e6,
+        results['track_seconds'], results['track_bytes'] / 1e6)
+    return results
+
+
+# ------------------------------------------------------------------------------
+# MAIN
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print('NumPy group-by: %.0f rows/sec' % bench_split_numpy())
+    print(format_suite(bench_suite()))
+    loads = bench_track()
+    print('Track load: %.1fx less memory, %.1fx faster than tuples' % (
+        loads['tuples_bytes'] / float(loads['track_bytes']),
+        loads['tuples_seconds'] / loads['track_seconds']))
+    try:
+        import arcpy
+    except ImportError:
+        print('arcpy not available, skipping split comparison.')
+    else:
+        for engine, rate in sorted(bench_split_arcpy().items()):
+            print('%s split: %.0f rows/sec' % (engine, rate))
+        print(format_suite(bench_suite(SCALES[:2], 'arcpy')))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.cache
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: shared content-addressed cache of downloaded archives
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import contextlib
+import hashlib
+import logging
+import os
+from os.path import exists, getsize, join, splitext
+import shutil
+import sqlite3
+import time
+
+from . import download
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+BUDGET = 100 * 1024 ** 3
+BUFFER_SIZE = 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL);
+'''
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def file_digest(filepath):
+    '''
+    Return the SHA-256 hex digest of a file.
+
+    :param filepath: Path to the file
+    :type filepath: string
+
+    :return: Hex digest
+    :rtype: string
+    '''
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+# CACHE
+# ------------------------------------------------------------------------------
+class DownloadCache(object):
+
+    '''
+    Local cache of source archives shared by every Raw_Month and Raw_MMSI
+    instance, and by every root directory.
+
+    Archives are stored once under the SHA-256 digest of their content and
+    looked up by URL. The index is a SQLite database, so several processes
+    can use the cache at once. When the cache grows over its disk budget,
+    the least recently used archives are evicted. Hit and miss counts are
+    kept in the database.
+    '''
+
+    def __init__(self, directory, budget = BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.objects = join(self.directory, 'objects')
+        if not exists(self.objects):
+            os.makedirs(self.objects)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        '''
+        Open a connection to the cache index for one transaction. Connections
+        are not kept on the instance so it can be passed to worker processes.
+        '''
+        db = sqlite3.connect(join(self.directory, 'cache.sqlite'), timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def count(self, db, name):
+        '''
+        Increment a counter.
+        '''
+        db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        db.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (name,))
+
+    def get(self, url):
+        '''
+        Return the path to the cached archive for a URL, or None. The lookup
+        is counted as a hit or a miss.
+
+        :param url: Source URL
+        :type url: string
+
+        :return: Path to the cached archive
+        :rtype: string
+        '''
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT o.digest, o.name FROM urls u '
+                'JOIN objects o ON o.digest = u.digest WHERE u.url = ?',
+                (url,)).fetchone()
+            filepath = join(self.objects, row[1]) if row else None
+            if filepath is None or not exists(filepath):
+                self.count(db, 'misses')
+                return None
+            db.execute(
+                'UPDATE objects SET last_used = ? WHERE digest = ?',
+                (time.time(), row[0]))
+            self.count(db, 'hits')
+        logger.info('Cache hit for %s.', url)
+        return filepath
+
+    def put(self, url, filepath):
+        '''
+        Move a downloaded archive into the cache and return its cached path.
+        If the same content is already cached, the file is removed instead.
+
+        :param url: Source URL
+        :param filepath: Path to the downloaded archive
+
+        :type url: string
+        :type filepath: string
+
+        :return: Path to the cached archive
+        :rtype: string
+        '''
+        digest = file_digest(filepath)
+        name = digest + splitext(filepath)[1]
+        cached = join(self.objects, name)
+        if exists(cached):
+            os.remove(filepath)
+        else:
+            try:
+                util.replace_file(filepath, cached)
+            except OSError:
+                # Different file system
+                shutil.move(filepath, cached)
+
+        with self.connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+                (digest, name, getsize(cached), time.time()))
+            db.execute('INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, digest))
+        self.evict(keep=digest)
+        return cached
+
+    def fetch(self, url):
+        '''
+        Return the path to the cached archive for a URL, downloading it on a
+        miss.
+
+        :param url: Source URL
+        :type url: string
+
+        :return: Path to the cached archive
+        :rtype: string
+        '''
+        cached = self.get(url)
+        if cached is not None:
+            return cached
+        name = url.rsplit('/', 1)[1].split('?')[0] or 'download'
+        temp = join(self.directory, '%d_%s' % (os.getpid(), name))
+        download.fetch(url, temp)
+        return self.put(url, temp)
+
+    def evict(self, keep = None):
+        '''
+        Remove the least recently used archives until the cache is within
+        its budget. The archive with digest keep is never removed.
+        '''
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT digest, name, size FROM objects ORDER BY last_used').fetchall()
+            total = sum(size for _, _, size in rows)
+            for digest, name, size in rows:
+                if total <= self.budget:
+                    break
+                if digest == keep:
+                    continue
+                try:
+                    os.remove(join(self.objects, name))
+                except OSError:
+                    # In use by another process
+                    continue
+                db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+                db.execute('DELETE FROM urls WHERE digest = ?', (digest,))
+                self.count(db, 'evictions')
+                total -= size
+                logger.info('Evicted %s from the cache.', name)
+
+    @property
+    def stats(self):
+        '''
+        Return the hit, miss, and eviction counts, the number of cached
+        archives, and their total size.
+        '''
+        with self.connect() as db:
+            stats = dict(db.execute('SELECT name, value FROM counters').fetchall())
+            entries, size = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+        for name in ('hits', 'misses', 'evictions'):
+            stats.setdefault(name, 0)
+        stats['entries'] = entries
+        stats['size'] = size
+        return stats
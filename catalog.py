@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.catalog
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: cache of feature class metadata for a run
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import arcpy
+import logging
+import os
+from os.path import basename, dirname, isabs, join
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+KINDS = ('list', 'exists', 'describe', 'count')
+
+
+# ------------------------------------------------------------------------------
+# CATALOG
+# ------------------------------------------------------------------------------
+class Catalog(object):
+
+    '''
+    Metadata of the feature classes in the workspaces used by a Raw_Month or
+    Raw_MMSI instance.
+
+    The names of all feature classes in a workspace are loaded with one
+    arcpy.da.Walk the first time the workspace is used. Fields and spatial
+    reference are read with one arcpy.Describe per feature class, and row
+    counts with GetCount, the first time they are needed. The pipeline
+    tells the catalog when it creates, changes, or deletes a feature class,
+    and may pass the fields or count it already knows.
+
+    Every lookup is counted as a hit if it was answered from the cache, or a
+    miss if it needed a call to arcpy.
+    '''
+
+    def __init__(self):
+        self.workspaces = {}
+        self.hits = dict((kind, 0) for kind in KINDS)
+        self.misses = dict((kind, 0) for kind in KINDS)
+
+    def key(self, path):
+        '''
+        Return the normalized absolute path of a feature class. Relative
+        names are taken to be in the current arcpy workspace.
+        '''
+        if not isabs(path):
+            path = join(arcpy.env.workspace, path)
+        return os.path.normcase(os.path.normpath(path))
+
+    def load(self, path):
+        '''
+        Return the cached entries of a workspace, loading the names of its
+        feature classes on first use.
+        '''
+        key = self.key(path)
+        entries = self.workspaces.get(key)
+        if entries is not None:
+            return entries, True
+
+        entries = {}
+        for dirpath, dirnames, filenames in arcpy.da.Walk(
+                path, datatype='FeatureClass'):
+            for name in filenames:
+                fc = join(dirpath, name)
+                entries[self.key(fc)] = {'path': fc, 'name': name}
+        self.workspaces[key] = entries
+        logger.debug('Loaded %d feature classes in %s.', len(entries), path)
+        return entries, False
+
+    def entry(self, path):
+        '''
+        Return the cached entry of a feature class, or None if it does not
+        exist.
+        '''
+        key = self.key(path)
+        entries, cached = self.load(dirname(key))
+        return entries.get(key), cached
+
+    def count_lookup(self, kind, cached):
+        '''
+        Count a lookup as a hit or a miss.
+        '''
+        if cached:
+            self.hits[kind] += 1
+        else:
+            self.misses[kind] += 1
+
+    def list(self, workspace):
+        '''
+        Return the paths of the feature classes in a workspace.
+
+        :param workspace: Path of the workspace
+        :type workspace: string
+
+        :return: Paths of the feature classes
+        :rtype: list of strings
+        '''
+        entries, cached = self.load(workspace)
+        self.count_lookup('list', cached)
+        return sorted(entry['path'] for entry in entries.values())
+
+    def exists(self, path):
+        '''
+        Return True if a feature class exists.
+        '''
+        entry, cached = self.entry(path)
+        self.count_lookup('exists', cached)
+        return entry is not None
+
+    def name(self, path):
+        '''
+        Return the name of a feature class. The name is the last part of the
+        path and needs no call to arcpy.
+        '''
+        return basename(path.rstrip('/\\'))
+
+    def describe(self, path):
+        '''
+        Return the cached entry of a feature class with its fields and
+        spatial reference.
+
+        :param path: Path or name of the feature class
+        :type path: string
+
+        :return: Entry with the path, name, (name, type) pairs of the fields,
+            and spatial reference
+        :rtype: dict
+        '''
+        entry, _ = self.entry(path)
+        if entry is None:
+            # Not created through the pipeline; add it
+            entry = self.created(path)
+        cached = 'fields' in entry
+        self.count_lookup('describe', cached)
+        if not cached:
+            desc = arcpy.Describe(path)
+            entry['fields'] = [(f.name, f.type) for f in desc.fields]
+            entry['spatial_reference'] = desc.spatialReference
+        return entry
+
+    def fields(self, path):
+        '''
+        Return the field names of a feature class.
+        '''
+        return [name for name, _ in self.describe(path)['fields']]
+
+    def field_types(self, path):
+        '''
+        Return the (name, type) pairs of the fields of a feature class.
+        '''
+        return self.describe(path)['fields']
+
+    def spatial_reference(self, path):
+        '''
+        Return the spatial reference of a feature class.
+        '''
+        return self.describe(path)['spatial_reference']
+
+    def count(self, path):
+        '''
+        Return the number of rows in a feature class.
+        '''
+        entry, _ = self.entry(path)
+        if entry is None:
+            entry = self.created(path)
+        cached = 'count' in entry
+        self.count_lookup('count', cached)
+        if not cached:
+            entry['count'] = int(arcpy.GetCount_management(path).getOutput(0))
+        return entry['count']
+
+    def created(self, path, fields = None, count = None):
+        '''
+        Record a feature class created by the pipeline, with the (name, type)
+        pairs of its fields and its row count if they are known.
+        '''
+        key = self.key(path)
+        entries = self.workspaces.get(dirname(key))
+        entry = {'path': path, 'name': self.name(path)}
+        if fields is not None:
+            entry['fields'] = list(fields)
+        if count is not None:
+            entry['count'] = count
+        if entries is not None:
+            entries[key] = entry
+        return entry
+
+    def changed(self, path, fields = None):
+        '''
+        Record that rows or fields of a feature class have changed. The row
+        count is read again when next needed; added fields may be given as
+        (name, type) pairs.
+        '''
+        entry, _ = self.entry(path)
+        if entry is None:
+            return
+        entry.pop('count', None)
+        if fields is not None and 'fields' in entry:
+            entry['fields'].extend(
+                f for f in fields if f[0] not in dict(entry['fields']))
+
+    def deleted(self, path):
+        '''
+        Record a feature class or workspace deleted by the pipeline.
+        '''
+        key = self.key(path)
+        self.workspaces.pop(key, None)
+        entries = self.workspaces.get(dirname(key))
+        if entries is not None:
+            entries.pop(key, None)
+
+    def invalidate(self, workspace = None):
+        '''
+        Drop the cached metadata of a workspace, or of every workspace.
+        '''
+        if workspace is None:
+            self.workspaces.clear()
+        else:
+            self.workspaces.pop(self.key(workspace), None)
+
+    @property
+    def stats(self):
+        '''
+        Return the hit and miss counts of each kind of lookup and in total.
+        '''
+        stats = {
+            'hits': sum(self.hits.values()),
+            'misses': sum(self.misses.values())}
+        for kind in KINDS:
+            stats[kind] = {'hits': self.hits[kind], 'misses': self.misses[kind]}
+        return stats
+
+    def report(self):
+        '''
+        Log the hit and miss counts. Each hit is a call to arcpy saved.
+        '''
+        stats = self.stats
+        logger.info(
+            'Catalog: %d hits, %d misses.', stats['hits'], stats['misses'])
+        for kind in KINDS:
+            logger.info(
+                '    %-9s %d hits, %d misses', kind,
+                stats[kind]['hits'], stats[kind]['misses'])
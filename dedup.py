@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.dedup
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: hash-based removal of repeated AIS reports
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import os
+from os.path import exists, join
+import threading
+
+import numpy as np
+
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+KEY_FIELDS = ('MMSI', 'BaseDateTime', 'POINT_X', 'POINT_Y', 'SOG', 'COG')
+
+# 64-bit FNV offset and prime, and the splitmix64 finalizer constants
+OFFSET = np.uint64(14695981039346656037)
+PRIME = np.uint64(1099511628211)
+MIX = (np.uint64(0xbf58476d1ce4e5b9), np.uint64(0x94d049bb133111eb))
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def to_words(column):
+    '''
+    Return a column as 64-bit words that are equal exactly when the values
+    are equal: timestamps as microseconds, numbers as float64 with -0.0 and
+    every NaN made the same.
+    '''
+    column = np.asarray(column)
+    if column.dtype.kind == 'M':
+        return column.astype('M8[us]').astype('i8').view('u8')
+    if column.dtype.kind == 'O':
+        # Cursor values with nulls; None is NaT or NaN
+        try:
+            column = np.array(
+                [np.nan if value is None else value for value in column], dtype='f8')
+        except TypeError:
+            return to_words(column.astype('M8[us]'))
+    column = np.asarray(column, dtype='f8') + 0.0
+    column[np.isnan(column)] = np.nan
+    return column.view('u8')
+
+def mix(words):
+    '''
+    Return 64-bit words through the splitmix64 finalizer, so a change in
+    any bit of a word changes about half of the bits of the result.
+    '''
+    with np.errstate(over='ignore'):
+        words = words ^ (words >> np.uint64(30))
+        words *= MIX[0]
+        words ^= words >> np.uint64(27)
+        words *= MIX[1]
+        words ^= words >> np.uint64(31)
+    return words
+
+def hash_columns(columns, fields = KEY_FIELDS):
+    '''
+    Return a 64-bit hash of the key fields of each row, computed over whole
+    columns. Each field is mixed before it is combined: the FNV multiply
+    only carries a difference to higher bits, so unmixed sign bit flips in
+    two fields, as in (-122.5, 47.25) and (122.5, -47.25), would cancel.
+
+    :param columns: Record array or dictionary of columns with the fields
+    :param fields: Key fields
+
+    :type columns: numpy.ndarray or dict
+    :type fields: tuple of strings
+
+    :return: Hash of each row
+    :rtype: numpy.ndarray
+    '''
+    with np.errstate(over='ignore'):
+        keys = None
+        for name in fields:
+            words = mix(to_words(columns[name]))
+            if keys is None:
+                keys = np.full(len(words), OFFSET, dtype='u8')
+            keys ^= words
+            keys *= PRIME
+    return mix(keys)
+
+def first_unique(keys):
+    '''
+    Return a mask of the first occurrence of each key.
+    '''
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[np.unique(keys, return_index=True)[1]] = True
+    return mask
+
+
+# ------------------------------------------------------------------------------
+# DEDUPLICATOR
+# ------------------------------------------------------------------------------
+class Deduplicator(object):
+
+    '''
+    Drop repeated AIS reports before they are aggregated.
+
+    A report is keyed by the 64-bit hash of its MMSI, BaseDateTime,
+    POINT_X, POINT_Y, SOG, and COG. The keys stored for each vessel are
+    kept as a sorted array, with the month each key came from, in
+    <directory>/<MMSI>.npz, so reports repeated by several receivers within
+    a month and reports seen in an earlier run or month are both found.
+
+    filter returns the new rows of a batch; the keys of a month are only
+    saved by commit once its rows have been written, and discard forgets a
+    month whose rows are deleted for a retry. The rows in and duplicates
+    dropped are counted per vessel.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not exists(self.directory):
+            os.makedirs(self.directory)
+        self.pending = {}
+        self.vessels = {}
+        self.lock = threading.Lock()
+
+    def path(self, mmsi):
+        '''
+        Return the path of the key file of a vessel.
+        '''
+        return join(self.directory, '%s.npz' % mmsi)
+
+    def load(self, mmsi):
+        '''
+        Return the sorted keys of a vessel and the month of each key.
+        '''
+        filepath = self.path(mmsi)
+        if not exists(filepath):
+            return np.empty(0, dtype='u8'), np.empty(0, dtype='u1')
+        with np.load(filepath) as saved:
+            return saved['keys'], saved['months']
+
+    def save(self, mmsi, keys, months):
+        '''
+        Replace the key file of a vessel.
+        '''
+        filepath = self.path(mmsi)
+        with open(filepath + '.tmp', 'wb') as f:
+            np.savez(f, keys=keys, months=months)
+        util.replace_file(filepath + '.tmp', filepath)
+
+    def filter(self, mmsi, month, columns):
+        '''
+        Return a mask of the rows of a batch that have not been seen for the
+        vessel, neither in its saved keys nor earlier in the month. The keys
+        of the new rows are held until commit.
+
+        :param mmsi: Vessel identifier
+        :param month: Month of the batch
+        :param columns: Record array or dictionary with the key fields
+
+        :type mmsi: int or string
+        :type month: string
+        :type columns: numpy.ndarray or dict
+
+        :return: Mask of the rows to keep
+        :rtype: numpy.ndarray
+        '''
+        keys = hash_columns(columns)
+        stored, _ = self.load(mmsi)
+        pending = self.pending.get((str(mmsi), month), np.empty(0, dtype='u8'))
+
+        keep = first_unique(keys)
+        for seen in (stored, pending):
+            if len(seen):
+                found = np.searchsorted(seen, keys).clip(0, len(seen) - 1)
+                keep &= seen[found] != keys
+        self.pending[(str(mmsi), month)] = np.union1d(pending, keys[keep])
+
+        with self.lock:
+            rows, duplicates = self.vessels.get(str(mmsi), (0, 0))
+            self.vessels[str(mmsi)] = (
+                rows + len(keys), duplicates + int(len(keys) - keep.sum()))
+        if not keep.all():
+            logger.debug(
+                'Dropped %d repeated reports of %s.', len(keys) - keep.sum(), mmsi)
+        return keep
+
+    def commit(self, mmsi, month):
+        '''
+        Save the keys of the rows of a month that have been written.
+        '''
+        pending = self.pending.pop((str(mmsi), month), None)
+        if pending is None or not len(pending):
+            return
+        keys, months = self.load(mmsi)
+        keys = np.concatenate([keys, pending])
+        months = np.concatenate([months, np.full(len(pending), int(month), dtype='u1')])
+        order = np.argsort(keys, kind='mergesort')
+        self.save(mmsi, keys[order], months[order])
+
+    def discard(self, mmsi, month):
+        '''
+        Forget the saved keys of a month of a vessel, when its rows are
+        deleted to be written again.
+        '''
+        self.pending.pop((str(mmsi), month), None)
+        keys, months = self.load(mmsi)
+        other = months != int(month)
+        if not other.all():
+            self.save(mmsi, keys[other], months[other])
+
+    @property
+    def stats(self):
+        '''
+        Return the vessels, rows in, and duplicates dropped.
+        '''
+        with self.lock:
+            counts = list(self.vessels.values())
+        return {
+            'vessels': len(counts),
+            'rows': sum(c[0] for c in counts),
+            'duplicates': sum(c[1] for c in counts)}
+
+    def report(self):
+        '''
+        Log the rows in and duplicates dropped.
+        '''
+        stats = self.stats
+        logger.info(
+            'Deduplication: %d duplicates dropped of %d rows in %d vessels.',
+            stats['duplicates'], stats['rows'], stats['vessels'])
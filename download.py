@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.download
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: parallel, resumable downloads over reused connections
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import certifi
+import hashlib
+import logging
+import os
+from os.path import exists, getsize, join
+import pycurl
+
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+CONNECTIONS = 4
+RETRIES = 3
+
+
+# ------------------------------------------------------------------------------
+# EXCEPTIONS
+# ------------------------------------------------------------------------------
+class downloadFailed(Exception):
+    def __init__(self, url, reason, msg = None):
+        if msg is None:
+            msg = ('The download of {0} failed: {1}').format(url, reason)
+        super(downloadFailed, self).__init__(msg)
+        self.url = url
+        self.reason = reason
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def part_file(url, filepath):
+    '''
+    Return the name of the partial file for a download. The name is unique
+    to the URL and stable across runs, so an interrupted download is resumed
+    from the same file.
+
+    :param url: URL to download
+    :param filepath: Final path of the download
+
+    :type url: string
+    :type filepath: string
+
+    :return: Path to the partial file
+    :rtype: string
+    '''
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    return '%s.%s.part' % (filepath, digest)
+
+
+# ------------------------------------------------------------------------------
+# TRANSFER
+# ------------------------------------------------------------------------------
+class Transfer(object):
+
+    '''
+    State of one download. Data is appended to the partial file, starting
+    at its current size. The total size is taken from the Content-Range or
+    Content-Length header and checked once the transfer is finished.
+    '''
+
+    def __init__(self, url, filepath):
+        self.url = url
+        self.filepath = filepath
+        self.part = part_file(url, filepath)
+        self.attempts = 0
+        self.offset = 0
+        self.code = None
+        self.total = None
+        self.handle = None
+        self.f = None
+
+    def start(self, handle):
+        '''
+        Configure a reused curl handle for the transfer.
+        '''
+        self.attempts += 1
+        self.offset = getsize(self.part) if exists(self.part) else 0
+        self.code = None
+        self.total = None
+        self.handle = handle
+        self.f = None
+        handle.transfer = self
+        handle.setopt(pycurl.URL, self.url)
+        handle.setopt(pycurl.CAINFO, certifi.where())
+        handle.setopt(pycurl.FOLLOWLOCATION, True)
+        handle.setopt(pycurl.HEADERFUNCTION, self.header)
+        handle.setopt(pycurl.WRITEFUNCTION, self.write)
+        handle.setopt(pycurl.RESUME_FROM_LARGE, self.offset)
+        if self.offset:
+            logger.info('Resuming %s at byte %d.', self.url, self.offset)
+
+    def header(self, line):
+        '''
+        Curl header callback, records the status code and the total size of
+        the file. Curl does not allow getinfo while a transfer is running.
+        '''
+        line = line.decode('iso-8859-1').strip().lower()
+        if line.startswith('http/'):
+            parts = line.split()
+            self.code = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            self.total = None
+        elif line.startswith('content-range:') and '/' in line:
+            total = line.rsplit('/', 1)[1]
+            if total.isdigit():
+                self.total = int(total)
+        elif line.startswith('content-length:') and self.total is None:
+            length = line.split(':', 1)[1].strip()
+            if length.isdigit() and self.code == 200:
+                self.total = int(length)
+
+    def write(self, data):
+        '''
+        Curl write callback. The body of an error response is discarded.
+        '''
+        if self.code not in (200, 206):
+            return
+        if self.f is None:
+            self.f = open(self.part, 'ab')
+        self.f.write(data)
+
+    def finish(self):
+        '''
+        Close the partial file, check its size against the total size sent
+        by the server, and rename it to the final path.
+
+        :raises downloadFailed: HTTP error or incomplete download
+        '''
+        self.close()
+        code = self.handle.getinfo(pycurl.RESPONSE_CODE)
+        size = getsize(self.part) if exists(self.part) else 0
+
+        # A complete partial file has nothing left to fetch past its end
+        complete = code == 416 and self.offset and self.total == size
+        if code not in (200, 206) and not complete:
+            raise downloadFailed(self.url, 'HTTP %d' % code)
+        if self.total is not None and size != self.total:
+            raise downloadFailed(
+                self.url, 'expected %d bytes, got %d' % (self.total, size))
+
+        util.replace_file(self.part, self.filepath)
+        logger.info('Downloaded %s to %s (%d bytes).', self.url, self.filepath, size)
+
+    def fail(self, errno):
+        '''
+        Close the partial file after a failed transfer. It is kept so the
+        next attempt can resume, unless the server cannot resume it.
+        '''
+        self.close()
+        if errno == pycurl.E_RANGE_ERROR and exists(self.part):
+            os.remove(self.part)
+
+    def close(self):
+        '''
+        Close the partial file.
+        '''
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+# ------------------------------------------------------------------------------
+# MANAGER
+# ------------------------------------------------------------------------------
+class DownloadManager(object):
+
+    '''
+    Download several files at once with a pycurl CurlMulti. A fixed pool of
+    curl handles is reused across files, so connections to the same host
+    are kept alive. Each file is written to a partial file that is resumed
+    with an HTTP Range request after a failure, and renamed to its final
+    path once its size has been checked.
+    '''
+
+    def __init__(self, connections = CONNECTIONS, retries = RETRIES):
+        self.connections = connections
+        self.retries = retries
+        self.multi = pycurl.CurlMulti()
+        self.handles = [pycurl.Curl() for _ in range(connections)]
+
+    def close(self):
+        '''
+        Close the curl handles.
+        '''
+        for handle in self.handles:
+            handle.close()
+        self.multi.close()
+
+    def download(self, targets):
+        '''
+        Download every (url, filepath) target. Targets whose final file
+        already exists are skipped.
+
+        :param targets: URL and destination path pairs
+        :type targets: list of tuples
+
+        :return: Dictionary of URL to downloaded filepath
+        :rtype: dict
+        :raises downloadFailed: A download failed after all retries
+        '''
+        pending = [
+            Transfer(url, filepath) for url, filepath in targets
+            if not exists(filepath)]
+        done = dict(targets)
+        free = list(self.handles)
+        active = 0
+        failed = []
+
+        while pending or active:
+            while pending and free:
+                handle = free.pop()
+                handle.reset()
+                pending.pop(0).start(handle)
+                self.multi.add_handle(handle)
+                active += 1
+
+            while True:
+                ret, _ = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = self.multi.info_read()
+                finished = [(h, None, None) for h in ok_list] + err_list
+                for handle, errno, error in finished:
+                    self.multi.remove_handle(handle)
+                    free.append(handle)
+                    active -= 1
+                    transfer = handle.transfer
+                    try:
+                        if errno is not None:
+                            raise downloadFailed(transfer.url, error)
+                        transfer.finish()
+                    except downloadFailed as err:
+                        transfer.fail(errno)
+                        logger.warning('%s (attempt %d)', err, transfer.attempts)
+                        if transfer.attempts < self.retries:
+                            pending.append(transfer)
+                        else:
+                            failed.append(err)
+                if queued == 0:
+                    break
+
+            if active:
+                self.multi.select(1.0)
+
+        if failed:
+            raise failed[0]
+        return done
+
+
+# ------------------------------------------------------------------------------
+# CONVENIENCE
+# ------------------------------------------------------------------------------
+def fetch(url, filepath, retries = RETRIES):
+    '''
+    Download a single file with resume and size checking.
+
+    :param url: URL to download
+    :param filepath: Destination path
+
+    :type url: string
+    :type filepath: string
+
+    :return: Path to the downloaded file
+    :rtype: string
+    '''
+    manager = DownloadManager(1, retries)
+    try:
+        return manager.download([(url, filepath)])[url]
+    finally:
+        manager.close()
+
+def download_months(raw_months, connections = CONNECTIONS):
+    '''
+    Download the zip files of several Raw_Month instances at once. Months
+    whose raw gdb has already been extracted are skipped.
+
+    :param raw_months: Months to download
+    :param connections: Number of simultaneous downloads
+
+    :type raw_months: list of Raw_Month
+    :type connections: int
+
+    :return: Dictionary of URL to downloaded filepath
+    :rtype: dict
+    '''
+    targets = [
+        (m.url, m.zip_file) for m in raw_months
+        if not exists(join(m.workspace, m.gdb_raw))]
+    manager = DownloadManager(connections)
+    try:
+        return manager.download(targets)
+    finally:
+        manager.close()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.eez
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: tiled polygon mask for fast point-in-EEZ tests
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+CELL_SIZE = 0.25
+CHUNK_SIZE = 200000
+
+
+# ------------------------------------------------------------------------------
+# GEOMETRY
+# ------------------------------------------------------------------------------
+def ring_edges(rings):
+    '''
+    Return an (n, 4) array of x0, y0, x1, y1 for every edge of the rings.
+    Rings are closed if the last vertex differs from the first.
+
+    :param rings: Sequence of rings, each a sequence of (x, y) vertices
+    :type rings: list
+
+    :return: Edges
+    :rtype: numpy.ndarray
+    '''
+    edges = []
+    for ring in rings:
+        ring = np.asarray(ring, dtype='f8')
+        if len(ring) < 3:
+            continue
+        if (ring[0] != ring[-1]).any():
+            ring = np.vstack((ring, ring[:1]))
+        edges.append(np.hstack((ring[:-1], ring[1:])))
+    return np.vstack(edges)
+
+def row_crossings(x, y, edges):
+    '''
+    Return the number of edges crossed by a ray towards positive x from each
+    point (x[i], y) of a row. An odd count means the point is inside.
+    '''
+    x0, y0, x1, y1 = edges.T
+    span = (y0 <= y) != (y1 <= y)
+    x0, y0, x1, y1 = x0[span], y0[span], x1[span], y1[span]
+    xi = np.sort(x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return len(xi) - np.searchsorted(xi, x, side='right')
+
+def orientation(ax, ay, bx, by, cx, cy):
+    '''
+    Return the sign of the cross product (b - a) x (c - a).
+    '''
+    return np.sign((bx - ax) * (cy - ay) - (by - ay) * (cx - ax))
+
+
+# ------------------------------------------------------------------------------
+# MASK
+# ------------------------------------------------------------------------------
+class EEZMask(object):
+
+    '''
+    Grid over the extent of a polygon with each cell classified as inside,
+    outside, or on the boundary of the polygon.
+
+    Points in inside and outside cells are answered by a lookup. For a point
+    in a boundary cell, the segment from the cell center to the point is
+    tested against the polygon edges that touch the cell: the point is inside
+    if the center is inside and the segment crosses an even number of edges,
+    or the center is outside and it crosses an odd number.
+    '''
+
+    def __init__(self, extent, cell_size, state, center_inside, edge_ptr,
+                 edge_idx, edges):
+        self.extent = tuple(float(v) for v in extent)
+        self.cell_size = float(cell_size)
+        self.state = state
+        self.center_inside = center_inside
+        self.edge_ptr = edge_ptr
+        self.edge_idx = edge_idx
+        self.edges = edges
+
+    @property
+    def shape(self):
+        '''
+        Return the number of rows and columns in the grid.
+        '''
+        return self.state.shape
+
+    @classmethod
+    def build(cls, rings, cell_size = CELL_SIZE):
+        '''
+        Build the mask for a polygon given as a list of rings. Holes are
+        handled by the even-odd rule, so exterior and interior rings do not
+        need to be distinguished.
+
+        :param rings: Sequence of rings, each a sequence of (x, y) vertices
+        :param cell_size: Width and height of a grid cell
+
+        :type rings: list
+        :type cell_size: float
+
+        :return: Mask
+        :rtype: EEZMask
+        '''
+        edges = ring_edges(rings)
+        xmin = min(edges[:, 0].min(), edges[:, 2].min())
+        ymin = min(edges[:, 1].min(), edges[:, 3].min())
+        xmax = max(edges[:, 0].max(), edges[:, 2].max())
+        ymax = max(edges[:, 1].max(), edges[:, 3].max())
+        nx = int(np.ceil((xmax - xmin) / cell_size)) + 1
+        ny = int(np.ceil((ymax - ymin) / cell_size)) + 1
+        logger.info('Building %d x %d EEZ mask over %d edges...', ny, nx, len(edges))
+
+        # Cells touched by the bounding box of each edge
+        ix0 = ((np.minimum(edges[:, 0], edges[:, 2]) - xmin) // cell_size).astype(np.intp)
+        ix1 = ((np.maximum(edges[:, 0], edges[:, 2]) - xmin) // cell_size).astype(np.intp)
+        iy0 = ((np.minimum(edges[:, 1], edges[:, 3]) - ymin) // cell_size).astype(np.intp)
+        iy1 = ((np.maximum(edges[:, 1], edges[:, 3]) - ymin) // cell_size).astype(np.intp)
+        width = ix1 - ix0 + 1
+        counts = width * (iy1 - iy0 + 1)
+        edge = np.repeat(np.arange(len(edges)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell = (iy0[edge] + offset // width[edge]) * nx + ix0[edge] + offset % width[edge]
+
+        order = np.argsort(cell, kind='mergesort')
+        edge_idx = edge[order].astype(np.int32)
+        edge_ptr = np.zeros(nx * ny + 1, dtype=np.int64)
+        edge_ptr[1:] = np.cumsum(np.bincount(cell, minlength=nx * ny))
+
+        # Classify cell centers with the ray test
+        cx = xmin + (np.arange(nx) + 0.5) * cell_size
+        cy = ymin + (np.arange(ny) + 0.5) * cell_size
+        center_inside = np.array(
+            [row_crossings(cx, y, edges) % 2 == 1 for y in cy]).ravel()
+
+        state = np.where(center_inside, INSIDE, OUTSIDE).astype(np.uint8)
+        state[np.diff(edge_ptr) > 0] = BOUNDARY
+        return cls(
+            (xmin, ymin, xmax, ymax), cell_size, state.reshape(ny, nx),
+            center_inside.reshape(ny, nx), edge_ptr, edge_idx, edges)
+
+    def save(self, filepath):
+        '''
+        Save the mask to a NumPy .npz file.
+        '''
+        np.savez(
+            filepath,
+            extent=np.array(self.extent),
+            cell_size=np.array(self.cell_size),
+            state=self.state,
+            center_inside=self.center_inside,
+            edge_ptr=self.edge_ptr,
+            edge_idx=self.edge_idx,
+            edges=self.edges)
+
+    @classmethod
+    def load(cls, filepath):
+        '''
+        Load a mask saved with save.
+        '''
+        data = np.load(filepath)
+        return cls(
+            data['extent'], float(data['cell_size']), data['state'],
+            data['center_inside'], data['edge_ptr'], data['edge_idx'],
+            data['edges'])
+
+    def cells(self, x, y):
+        '''
+        Return the flat cell index of each point, -1 outside the grid.
+        '''
+        xmin, ymin = self.extent[:2]
+        ny, nx = self.shape
+        ix = np.floor((x - xmin) / self.cell_size)
+        iy = np.floor((y - ymin) / self.cell_size)
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        cell = np.full(len(x), -1, dtype=np.intp)
+        cell[valid] = iy[valid].astype(np.intp) * nx + ix[valid].astype(np.intp)
+        return cell
+
+    def contains(self, x, y):
+        '''
+        Return a boolean array that is True for points inside the polygon.
+
+        :param x: Point longitudes (POINT_X)
+        :param y: Point latitudes (POINT_Y)
+
+        :type x: numpy.ndarray
+        :type y: numpy.ndarray
+
+        :return: Inside flags
+        :rtype: numpy.ndarray
+        '''
+        x = np.asarray(x, dtype='f8')
+        y = np.asarray(y, dtype='f8')
+        cell = self.cells(x, y)
+        valid = cell >= 0
+        state = np.full(len(x), OUTSIDE, dtype=np.uint8)
+        state[valid] = self.state.ravel()[cell[valid]]
+
+        inside = state == INSIDE
+        boundary = np.flatnonzero(state == BOUNDARY)
+        for start in range(0, len(boundary), CHUNK_SIZE):
+            points = boundary[start:start + CHUNK_SIZE]
+            inside[points] = self.contains_boundary(x[points], y[points], cell[points])
+        return inside
+
+    def contains_boundary(self, x, y, cell):
+        '''
+        Exact test for points in boundary cells against the edges that touch
+        each point's cell.
+        '''
+        xmin, ymin = self.extent[:2]
+        nx = self.shape[1]
+        cx = xmin + (cell % nx + 0.5) * self.cell_size
+        cy = ymin + (cell // nx + 0.5) * self.cell_size
+
+        start = self.edge_ptr[cell]
+        counts = (self.edge_ptr[cell + 1] - start).astype(np.intp)
+        point = np.repeat(np.arange(len(x)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ax, ay, bx, by = self.edges[self.edge_idx[start[point] + offset]].T
+
+        px, py, qx, qy = cx[point], cy[point], x[point], y[point]
+        cross = (
+            (orientation(px, py, qx, qy, ax, ay) > 0)
+            != (orientation(px, py, qx, qy, bx, by) > 0)) & (
+            (orientation(ax, ay, bx, by, px, py) > 0)
+            != (orientation(ax, ay, bx, by, qx, qy) > 0))
+        parity = np.bincount(point, weights=cross, minlength=len(x)) % 2 == 1
+        return self.center_inside.ravel()[cell] != parity
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.export
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: batched, multi-threaded csv export
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import csv
+import gzip
+import io
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
+import time
+
+from . import util
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+THREADS = 4
+BATCH_SIZE = 100000
+BUFFER_SIZE = 4 * 1024 * 1024
+
+EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'lzma': '.xz'}
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def output_path(filepath, compression = None):
+    '''
+    Return the path of a csv file with the extension of the compression.
+
+    :param filepath: Path of the uncompressed csv file
+    :param compression: None, 'gzip', or 'lzma'
+
+    :type filepath: string
+    :type compression: string
+
+    :return: Path of the output file
+    :rtype: string
+    '''
+    if compression not in EXTENSIONS:
+        raise ValueError('Unknown compression %s.' % compression)
+    return filepath + EXTENSIONS[compression]
+
+def open_output(filepath, compression = None):
+    '''
+    Open a binary file for writing, compressed with gzip or lzma if given.
+    '''
+    if compression is None:
+        return open(filepath, 'wb', BUFFER_SIZE)
+    if compression == 'gzip':
+        return gzip.open(filepath, 'wb', 6)
+    if compression == 'lzma':
+        if lzma is None:
+            raise ValueError('lzma compression needs the backports.lzma package.')
+        return lzma.LZMAFile(filepath, 'wb')
+    raise ValueError('Unknown compression %s.' % compression)
+
+def format_rows(rows):
+    '''
+    Format a batch of rows as csv in one call to writerows and return the
+    encoded bytes.
+
+    :param rows: Rows of field values
+    :type rows: iterable of sequences
+
+    :return: CSV text
+    :rtype: bytes
+    '''
+    if sys.version_info[0] < 3:
+        buf = io.BytesIO()
+        csv.writer(buf).writerows(rows)
+        return buf.getvalue()
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue().encode('utf-8')
+
+def column_rows(columns, fields):
+    '''
+    Return the rows of a dictionary of NumPy columns as a list of tuples.
+    Dates are converted to whole seconds, as written by SearchCursor.
+    '''
+    values = []
+    for name in fields:
+        column = columns[name]
+        if column.dtype.kind == 'M':
+            column = column.astype('M8[s]')
+        values.append(column.tolist())
+    return list(zip(*values))
+
+def write_csv(filepath, header, rows, compression = None):
+    '''
+    Write a header and rows to a csv file in batches and return the number of
+    rows and bytes written. The file is written under a temporary name and
+    renamed once complete.
+
+    :param filepath: Path of the output file
+    :param header: Field names
+    :param rows: Rows of field values
+    :param compression: None, 'gzip', or 'lzma'
+
+    :type filepath: string
+    :type header: list of strings
+    :type rows: list of sequences
+    :type compression: string
+
+    :return: Rows and bytes written
+    :rtype: tuple of ints
+    '''
+    batches = (
+        rows[start:start + BATCH_SIZE] for start in range(0, len(rows), BATCH_SIZE))
+    return write_chunks(filepath, header, batches, compression)
+
+def write_chunks(filepath, header, chunks, compression = None):
+    '''
+    Write a header and chunks of rows to a csv file, holding one chunk at a
+    time, and return the number of rows and bytes written. The file is
+    written under a temporary name and renamed once complete.
+
+    :param filepath: Path of the output file
+    :param header: Field names
+    :param chunks: Lists of rows of field values
+    :param compression: None, 'gzip', or 'lzma'
+
+    :type filepath: string
+    :type header: list of strings
+    :type chunks: iterable of lists
+    :type compression: string
+
+    :return: Rows and bytes written
+    :rtype: tuple of ints
+    '''
+    temp = filepath + '.part'
+    count = 0
+    f = open_output(temp, compression)
+    try:
+        f.write(format_rows([header]))
+        for rows in chunks:
+            f.write(format_rows(rows))
+            count += len(rows)
+    finally:
+        f.close()
+    util.replace_file(temp, filepath)
+    return count, os.path.getsize(filepath)
+
+
+# ------------------------------------------------------------------------------
+# EXPORTER
+# ------------------------------------------------------------------------------
+class Exporter(object):
+
+    '''
+    Write csv files on a pool of threads. The caller reads the rows of each
+    file, so arcpy is only used from the calling thread, and submits them
+    with write; formatting, compression, and writing of several files then
+    overlap with reading the next. At most pending files are held in memory
+    at once.
+
+    The number of files, rows, and bytes written is kept in stats, and
+    report logs files/sec and MB/sec.
+    '''
+
+    def __init__(self, threads = THREADS, compression = None, pending = None):
+        output_path('', compression)
+        self.threads = threads
+        self.compression = compression
+        self.slots = threading.BoundedSemaphore(pending or threads * 4)
+        self.lock = threading.Lock()
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.results = []
+        self.start = time.time()
+        self.stats = {'files': 0, 'rows': 0, 'bytes': 0}
+
+    def path(self, filepath):
+        '''
+        Return the output path of a csv file.
+        '''
+        return output_path(filepath, self.compression)
+
+    def write(self, filepath, header, rows, callback = None):
+        '''
+        Write a csv file in the background. The callback is called with the
+        number of rows and bytes once the file is complete.
+
+        :param filepath: Output path, see path
+        :param header: Field names
+        :param rows: Rows of field values
+        :param callback: Function of rows and bytes written
+
+        :type filepath: string
+        :type header: list of strings
+        :type rows: list of sequences
+        :type callback: function
+        '''
+        if self.pool is None:
+            self.run(filepath, header, rows, callback)
+            return
+        self.slots.acquire()
+        # Raise errors from finished files early
+        running = []
+        for result in self.results:
+            if result.ready():
+                result.get()
+            else:
+                running.append(result)
+        self.results = running
+        self.results.append(self.pool.apply_async(
+            self.run, (filepath, header, rows, callback)))
+
+    def stream(self, filepath, header, chunks, callback = None):
+        '''
+        Write a csv file from chunks of rows on the calling thread, for files
+        too large to be held in memory while they wait for the pool.
+
+        :param filepath: Output path, see path
+        :param header: Field names
+        :param chunks: Lists of rows of field values
+        :param callback: Function of rows and bytes written
+
+        :type filepath: string
+        :type header: list of strings
+        :type chunks: iterable of lists
+        :type callback: function
+        '''
+        count, size = write_chunks(filepath, header, chunks, self.compression)
+        with self.lock:
+            self.stats['files'] += 1
+            self.stats['rows'] += count
+            self.stats['bytes'] += size
+        if callback is not None:
+            callback(count, size)
+
+    def run(self, filepath, header, rows, callback):
+        '''
+        Write one file and update the stats.
+        '''
+        try:
+            count, size = write_csv(filepath, header, rows, self.compression)
+            with self.lock:
+                self.stats['files'] += 1
+                self.stats['rows'] += count
+                self.stats['bytes'] += size
+            if callback is not None:
+                callback(count, size)
+        finally:
+            if self.pool is not None:
+                self.slots.release()
+
+    def close(self):
+        '''
+        Wait for every file to be written, raise the first error, and return
+        the stats with the seconds taken.
+
+        :return: Files, rows, bytes, and seconds
+        :rtype: dict
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            for result in self.results:
+                result.get()
+        self.stats['seconds'] = time.time() - self.start
+        self.report()
+        return self.stats
+
+    def report(self):
+        '''
+        Log the files and megabytes written per second.
+        '''
+        seconds = max(time.time() - self.start, 1e-9)
+        logger.info(
+            'Exported %d files, %d rows, %.1f MB in %.1fs '
+            '(%.1f files/sec, %.1f MB/sec).',
+            self.stats['files'], self.stats['rows'],
+            self.stats['bytes'] / 1e6, seconds,
+            self.stats['files'] / seconds,
+            self.stats['bytes'] / 1e6 / seconds)
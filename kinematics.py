@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.kinematics
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: vectorized per-track time deltas, distances, and speeds
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_SECOND = 1852.0 / 3600
+
+# Implied speed in knots above which a point that jumps out and back is a spike
+MAX_SPEED = 50.0
+# Seconds between points above which the track has a gap
+MAX_GAP = 900
+
+# Derived fields with their NumPy dtype and geodatabase field type
+FIELDS = (
+    ('DeltaTime', 'f8', 'Double'),
+    ('Distance', 'f8', 'Double'),
+    ('ImpliedSpeed', 'f8', 'Double'),
+    ('HeadingChange', 'f8', 'Double'),
+    ('Spike', 'i2', 'SmallInteger'),
+    ('Gap', 'i2', 'SmallInteger'))
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def haversine(x1, y1, x2, y2):
+    '''
+    Return the great circle distance in meters between points given as
+    longitude and latitude in degrees.
+    '''
+    x1, y1, x2, y2 = [np.radians(np.asarray(v, dtype='f8')) for v in (x1, y1, x2, y2)]
+    a = (np.sin((y2 - y1) / 2) ** 2
+         + np.cos(y1) * np.cos(y2) * np.sin((x2 - x1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def bearing(x1, y1, x2, y2):
+    '''
+    Return the initial bearing in degrees from north from the first to the
+    second point.
+    '''
+    x1, y1, x2, y2 = [np.radians(np.asarray(v, dtype='f8')) for v in (x1, y1, x2, y2)]
+    east = np.sin(x2 - x1) * np.cos(y2)
+    north = np.cos(y1) * np.sin(y2) - np.sin(y1) * np.cos(y2) * np.cos(x2 - x1)
+    return np.degrees(np.arctan2(east, north)) % 360
+
+def speed(distance, seconds):
+    '''
+    Return the speed in knots of a distance in meters covered in a number
+    of seconds, NaN if no time passed.
+    '''
+    knots = np.full(len(distance), np.nan)
+    moving = seconds > 0
+    knots[moving] = distance[moving] / seconds[moving] / METERS_PER_SECOND
+    return knots
+
+def to_seconds(times):
+    '''
+    Return timestamps as float seconds since the epoch.
+    '''
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        times = times.astype('M8[us]').astype('i8') / 1e6
+    return times.astype('f8')
+
+
+# ------------------------------------------------------------------------------
+# KINEMATICS
+# ------------------------------------------------------------------------------
+def compute(times, x, y, max_speed = MAX_SPEED, max_gap = MAX_GAP):
+    '''
+    Compute the derived fields of a time-ordered track. Each value at a
+    point describes the leg from the previous point: the seconds and meters
+    since it, the implied speed in knots, and the change in degrees from the
+    bearing of the leg before, in (-180, 180]. The first point has no leg.
+
+    A point is flagged as a spike if the implied speed of the legs into and
+    out of it are both above max_speed while the leg skipping it is not, or,
+    at either end of the track, if its leg is above max_speed and the next
+    leg is not. A point is flagged as a gap if more than max_gap seconds
+    passed since the previous point.
+
+    :param times: Timestamps, as datetime64 or seconds
+    :param x: Longitudes
+    :param y: Latitudes
+    :param max_speed: Largest plausible speed in knots
+    :param max_gap: Largest time between points in seconds
+
+    :type times: numpy.ndarray
+    :type x: numpy.ndarray
+    :type y: numpy.ndarray
+    :type max_speed: float
+    :type max_gap: float
+
+    :return: Dictionary of field name to column, see FIELDS
+    :rtype: dict
+    '''
+    seconds = to_seconds(times)
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    count = len(seconds)
+    columns = dict(
+        (name, np.full(count, np.nan) if dtype == 'f8' else np.zeros(count, dtype=dtype))
+        for name, dtype, _ in FIELDS)
+    if count < 2:
+        return columns
+
+    dt = np.diff(seconds)
+    distance = haversine(x[:-1], y[:-1], x[1:], y[1:])
+    knots = speed(distance, dt)
+    columns['DeltaTime'][1:] = dt
+    columns['Distance'][1:] = distance
+    columns['ImpliedSpeed'][1:] = knots
+
+    course = bearing(x[:-1], y[:-1], x[1:], y[1:])
+    course[distance == 0] = np.nan
+    turn = (course[1:] - course[:-1] + 180) % 360 - 180
+    turn[turn == -180] = 180
+    columns['HeadingChange'][2:] = turn
+
+    with np.errstate(invalid='ignore'):
+        fast = knots > max_speed
+        spike = np.zeros(count, dtype=bool)
+        if count > 2:
+            spike[0] = fast[0] & ~fast[1]
+            spike[-1] = fast[-1] & ~fast[-2]
+            skip = speed(
+                haversine(x[:-2], y[:-2], x[2:], y[2:]), seconds[2:] - seconds[:-2])
+            spike[1:-1] = fast[:-1] & fast[1:] & ~(skip > max_speed)
+        columns['Spike'][:] = spike
+        columns['Gap'][1:] = dt > max_gap
+    return columns
+
+def add_columns(array, columns, fields = None):
+    '''
+    Return a copy of a record array with columns added.
+
+    :param array: Record array
+    :param columns: Dictionary of field name to column
+    :param fields: Names and dtypes of the added fields, default FIELDS
+
+    :type array: numpy.ndarray
+    :type columns: dict
+    :type fields: list of tuples
+
+    :return: Record array
+    :rtype: numpy.ndarray
+    '''
+    fields = [(f[0], f[1]) for f in fields or FIELDS]
+    new = [(name, dtype) for name, dtype in fields if name not in array.dtype.names]
+    out = np.empty(len(array), dtype=array.dtype.descr + new)
+    for name in array.dtype.names:
+        out[name] = array[name]
+    for name, _ in fields:
+        out[name] = columns[name]
+    return out
+
+def summary(columns):
+    '''
+    Return the number of points, spikes, and gaps of computed columns.
+    '''
+    return {
+        'points': len(columns['Spike']),
+        'spikes': int(columns['Spike'].sum()),
+        'gaps': int(columns['Gap'].sum())}
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.manifest
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: persistent record of completed pipeline units
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import contextlib
+import logging
+import os
+from os.path import exists, join
+import sqlite3
+import time
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# A unit left running by a crash is retried once
+MAX_ATTEMPTS = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS units (
+    zone TEXT NOT NULL,
+    year TEXT NOT NULL,
+    month TEXT NOT NULL,
+    mmsi TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    rows INTEGER,
+    attempts INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (zone, year, month, mmsi, stage));
+'''
+
+
+# ------------------------------------------------------------------------------
+# EXCEPTIONS
+# ------------------------------------------------------------------------------
+class unitFailed(Exception):
+    def __init__(self, key, msg = None):
+        if msg is None:
+            msg = ('Unit {0} failed after {1} attempts; delete it from the '
+                   'manifest to run it again').format(key, MAX_ATTEMPTS)
+        super(unitFailed, self).__init__(msg)
+        self.key = key
+
+
+# ------------------------------------------------------------------------------
+# MANIFEST
+# ------------------------------------------------------------------------------
+class Manifest(object):
+
+    '''
+    SQLite record of every (zone, year, month, MMSI, stage) unit of work in
+    a root directory, with its status, row count, and number of attempts.
+
+    A unit is started with begin and completed with finish. A re-run skips
+    completed units without touching the geodatabase. A unit still marked
+    running was interrupted; begin returns it once more with attempt 2 so
+    the caller can clean up partial output first, and marks it failed if
+    that attempt is interrupted too. A failed unit raises unitFailed from
+    begin, then and on every later run, so it is never taken as done.
+
+    Month-level units use an empty MMSI, and zone-year units an empty month.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        if not exists(self.root):
+            os.makedirs(self.root)
+        self.filepath = join(self.root, 'manifest.sqlite')
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        '''
+        Open a connection to the manifest for one transaction. Connections
+        are not kept on the instance so it can be passed to worker processes.
+        '''
+        db = sqlite3.connect(self.filepath, timeout=60)
+        db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def status(self, zone, year, month, mmsi, stage):
+        '''
+        Return the status of a unit, or None if it has never been started.
+        '''
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT status FROM units WHERE zone = ? AND year = ? '
+                'AND month = ? AND mmsi = ? AND stage = ?',
+                (zone, year, month, str(mmsi), stage)).fetchone()
+        return row[0] if row else None
+
+    def done(self, zone, year, month, mmsi, stage):
+        '''
+        Return True if a unit has been completed.
+        '''
+        return self.status(zone, year, month, mmsi, stage) == DONE
+
+    def completed(self, zone, year, month, stage):
+        '''
+        Return the set of MMSI for which a stage has been completed.
+        '''
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT mmsi FROM units WHERE zone = ? AND year = ? '
+                'AND month = ? AND stage = ? AND status = ?',
+                (zone, year, month, stage, DONE)).fetchall()
+        return set(row[0] for row in rows)
+
+    def begin(self, zone, year, month, mmsi, stage):
+        '''
+        Mark a unit as running and return the attempt number, or 0 if the
+        unit is done and should be skipped.
+
+        :param zone: Zone of the unit
+        :param year: Year of the unit
+        :param month: Month of the unit, empty for zone-year units
+        :param mmsi: MMSI of the unit, empty for month-level units
+        :param stage: Name of the pipeline stage
+
+        :type zone: string
+        :type year: string
+        :type month: string
+        :type mmsi: string
+        :type stage: string
+
+        :return: Attempt number, 1 for a first run and 2 for the retry
+        :rtype: int
+        :raises unitFailed: The unit has failed its last attempt
+        '''
+        key = (zone, year, month, str(mmsi), stage)
+        # Raised after the transaction, so the failed status is kept
+        failed = False
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT status, attempts FROM units WHERE zone = ? AND year = ? '
+                'AND month = ? AND mmsi = ? AND stage = ?', key).fetchone()
+            if row is None:
+                db.execute(
+                    'INSERT INTO units VALUES (?, ?, ?, ?, ?, ?, NULL, 1, ?)',
+                    key + (RUNNING, time.time()))
+                return 1
+
+            status, attempts = row
+            if status == DONE:
+                return 0
+            if status == FAILED:
+                failed = True
+            elif attempts >= MAX_ATTEMPTS:
+                logger.warning('Giving up on %s after %d attempts.', key, attempts)
+                db.execute(
+                    'UPDATE units SET status = ?, updated = ? WHERE zone = ? '
+                    'AND year = ? AND month = ? AND mmsi = ? AND stage = ?',
+                    (FAILED, time.time()) + key)
+                failed = True
+            else:
+                logger.info('Retrying interrupted unit %s.', key)
+                db.execute(
+                    'UPDATE units SET attempts = attempts + 1, updated = ? '
+                    'WHERE zone = ? AND year = ? AND month = ? AND mmsi = ? '
+                    'AND stage = ?', (time.time(),) + key)
+        if failed:
+            raise unitFailed(key)
+        return attempts + 1
+
+    def finish(self, zone, year, month, mmsi, stage, rows = None):
+        '''
+        Mark a unit as done and record its row count. A unit that was not
+        started with begin is recorded as done on its first attempt.
+        '''
+        key = (zone, year, month, str(mmsi), stage)
+        with self.connect() as db:
+            cursor = db.execute(
+                'UPDATE units SET status = ?, rows = ?, updated = ? '
+                'WHERE zone = ? AND year = ? AND month = ? AND mmsi = ? '
+                'AND stage = ?', (DONE, rows, time.time()) + key)
+            if cursor.rowcount == 0:
+                db.execute(
+                    'INSERT INTO units VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)',
+                    key + (DONE, rows, time.time()))
+
+    def summary(self):
+        '''
+        Return a dictionary of (stage, status) to unit count.
+        '''
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT stage, status, COUNT(*) FROM units '
+                'GROUP BY stage, status').fetchall()
+        return dict(((stage, status), count) for stage, status, count in rows)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.memory
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: memory budget, chunk sizing, and spill files
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from . import metrics
+from . import split
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+# Bytes of one value of each geodatabase field type in a record array
+FIELD_BYTES = {
+    'Double': 8,
+    'Single': 4,
+    'Integer': 4,
+    'SmallInteger': 2,
+    'Date': 8,
+    'OID': 4,
+    'GUID': 38,
+    'GlobalID': 38,
+    'Geometry': 16}
+# Fixed width assumed for a string field, whose length is not listed
+STRING_BYTES = 256
+
+# Bytes of a tuple, and of each value object and its pointer in the tuple
+TUPLE_BYTES = 56
+VALUE_BYTES = 40
+
+# Copies of a chunk held while it is processed: as read, selected, sorted
+OVERHEAD = 3
+MIN_ROWS = 1000
+
+MB = 1024.0 ** 2
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def row_bytes(field_types):
+    '''
+    Return the bytes of one row of a record array read from a feature class.
+
+    :param field_types: (name, type) pairs of the fields
+    :type field_types: list of tuples
+
+    :return: Bytes per row
+    :rtype: int
+    '''
+    return sum(FIELD_BYTES.get(kind, STRING_BYTES) for _, kind in field_types)
+
+def tuple_bytes(count):
+    '''
+    Return the bytes of one row of count values read by a cursor as a tuple.
+    '''
+    return TUPLE_BYTES + count * VALUE_BYTES
+
+def chunk_rows(budget, row_bytes, parts = 1, default = None):
+    '''
+    Return the rows of a chunk sized from a memory budget, or default if
+    there is no budget.
+    '''
+    if budget is None:
+        return default
+    return budget.rows(row_bytes, parts)
+
+
+# ------------------------------------------------------------------------------
+# SPILL
+# ------------------------------------------------------------------------------
+class Spill(object):
+
+    '''
+    Temporary files holding record arrays that do not fit in memory. Rows
+    are appended to the file of their bucket, chosen by the key modulo the
+    number of buckets, so every row of a vessel is in the same bucket, and
+    the buckets are read back one at a time. The directory is removed when
+    the spill is closed.
+    '''
+
+    def __init__(self, directory, buckets = 1, key = 'MMSI'):
+        self.directory = directory
+        self.buckets = max(int(buckets), 1)
+        self.key = key
+        self.dtype = None
+        self.counts = [0] * self.buckets
+        if not exists(self.directory):
+            os.makedirs(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def path(self, bucket):
+        '''
+        Return the path of the file of a bucket.
+        '''
+        return join(self.directory, '%d.bin' % bucket)
+
+    def add(self, array):
+        '''
+        Append the rows of a record array to the files of their buckets.
+        '''
+        if self.dtype is None:
+            self.dtype = array.dtype
+        if self.buckets == 1:
+            parts = [(0, array)]
+        else:
+            bucket = array[self.key] % self.buckets
+            order = np.argsort(bucket, kind='mergesort')
+            values, starts, stops = split.group_bounds(bucket[order])
+            parts = [
+                (int(value), array[order[start:stop]])
+                for value, start, stop in zip(values, starts, stops)]
+        for bucket, part in parts:
+            with open(self.path(bucket), 'ab') as f:
+                part.tofile(f)
+            self.counts[bucket] += len(part)
+
+    def read(self, bucket, mmap = False):
+        '''
+        Return the rows of a bucket, read into memory or memory-mapped.
+        '''
+        count = self.counts[bucket]
+        if not count:
+            return np.empty(0, dtype=self.dtype)
+        if mmap:
+            return np.memmap(
+                self.path(bucket), dtype=self.dtype, mode='r', shape=(count,))
+        return np.fromfile(self.path(bucket), dtype=self.dtype)
+
+    def __iter__(self):
+        for bucket in range(self.buckets):
+            yield self.read(bucket)
+
+    def close(self):
+        '''
+        Remove the spill files.
+        '''
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def split_spilled(batches, budget, count, row_bytes, write_groups,
+                  write_large_groups, stage = 'split'):
+    '''
+    Split batches of rows by MMSI through spill files. The batches are
+    added to buckets that each fit in the budget if the rows are spread
+    evenly, then each bucket is split in turn: a bucket that fits is read
+    whole, sorted by MMSI and time, and passed to write_groups; a bucket
+    still too large, such as one holding a vessel that reports all month,
+    is passed to write_large_groups as a memory map.
+
+    :param batches: Record arrays to split
+    :param budget: Memory budget
+    :param count: Rows expected in the batches, to size the buckets
+    :param row_bytes: Bytes per row
+    :param write_groups: Function of a record array sorted by MMSI
+    :param write_large_groups: Function of an unsorted memory-mapped array
+    :param stage: Stage whose memory is sampled after each bucket
+
+    :type batches: iterable of numpy.ndarray
+    :type budget: MemoryBudget
+    :type count: int
+    :type row_bytes: int
+    :type write_groups: function
+    :type write_large_groups: function
+    :type stage: string
+
+    :return: Rows split
+    :rtype: int
+    '''
+    with budget.spill(budget.buckets(count, row_bytes)) as spill:
+        for array in batches:
+            spill.add(array)
+        for bucket, rows in enumerate(spill.counts):
+            if budget.fits(rows, row_bytes):
+                write_groups(split.sort_by_mmsi(spill.read(bucket)))
+            else:
+                write_large_groups(spill.read(bucket, mmap=True))
+            budget.sample(stage)
+        return len(spill)
+
+
+# ------------------------------------------------------------------------------
+# MEMORY BUDGET
+# ------------------------------------------------------------------------------
+class MemoryBudget(object):
+
+    '''
+    Bound on the memory the stages of a run may use for the rows they hold.
+
+    Stages read rows in chunks of rows sized from the budget and the width
+    of a row, and spill what does not fit to temporary files under
+    directory, the system temporary folder by default. Usage is the
+    resident set size of the process above what it was when the budget was
+    created; each stage samples it between chunks, and report logs the peak
+    of every stage against the budget.
+    '''
+
+    def __init__(self, limit, directory = None, overhead = OVERHEAD):
+        self.limit = int(limit)
+        self.directory = directory
+        self.overhead = overhead
+        self.baseline = metrics.rss() or 0
+        self.peaks = {}
+        self.lock = threading.Lock()
+
+    def rows(self, row_bytes, parts = 1):
+        '''
+        Return the number of rows of a chunk, when parts chunks of rows of
+        the given width are held at once.
+
+        :param row_bytes: Bytes per row, see row_bytes and tuple_bytes
+        :param parts: Chunks held at once
+
+        :type row_bytes: int
+        :type parts: int
+
+        :return: Rows per chunk
+        :rtype: int
+        '''
+        size = self.limit // (max(parts, 1) * max(row_bytes, 1) * self.overhead)
+        return max(int(size), MIN_ROWS)
+
+    def fits(self, count, row_bytes, parts = 1):
+        '''
+        Return True if count rows can be held as one chunk.
+        '''
+        return count <= self.rows(row_bytes, parts)
+
+    def buckets(self, count, row_bytes):
+        '''
+        Return the number of spill buckets that each fit in one chunk, if
+        the rows are spread evenly.
+        '''
+        return -(-count // self.rows(row_bytes))
+
+    def spill(self, buckets = 1, key = 'MMSI'):
+        '''
+        Return a new spill in a temporary folder.
+        '''
+        directory = tempfile.mkdtemp(prefix='ais_spill_', dir=self.directory)
+        logger.info('Spilling rows to %d buckets in %s...', buckets, directory)
+        return Spill(directory, buckets, key)
+
+    def __getstate__(self):
+        # Workers measure their own usage
+        return {
+            'limit': self.limit,
+            'directory': self.directory,
+            'overhead': self.overhead}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def sampled(self, chunks, stage):
+        '''
+        Yield each chunk of an iterable and sample the memory used by the
+        stage once the chunk has been processed.
+        '''
+        for chunk in chunks:
+            yield chunk
+            self.sample(stage)
+
+    def sample(self, stage):
+        '''
+        Record the memory used by a stage now, and warn the first time a
+        stage is over the budget.
+        '''
+        used = (metrics.rss() or 0) - self.baseline
+        with self.lock:
+            first = stage not in self.peaks
+            peak = self.peaks.get(stage, 0)
+            self.peaks[stage] = max(peak, used)
+        if used > self.limit and (first or peak <= self.limit):
+            logger.warning(
+                'Stage %s is using %.0f MB, over the memory budget of %.0f MB.',
+                stage, used / MB, self.limit / MB)
+
+    @property
+    def stats(self):
+        '''
+        Return the budget and the peak bytes used by each stage.
+        '''
+        with self.lock:
+            peaks = dict(self.peaks)
+        return {'limit': self.limit, 'peaks': peaks}
+
+    def report(self):
+        '''
+        Log the peak memory used by each stage against the budget.
+        '''
+        stats = self.stats
+        for stage in sorted(stats['peaks']):
+            peak = stats['peaks'][stage]
+            logger.info(
+                'Memory budget: %s peaked at %.0f MB of %.0f MB (%.0f%%).',
+                stage, peak / MB, self.limit / MB, 100.0 * peak / self.limit)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.merge
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: streaming k-way merge of time-sorted runs
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def is_sorted(times):
+    '''
+    Return True if a column of timestamps is in non-decreasing order.
+    '''
+    times = np.asarray(times)
+    return len(times) < 2 or bool((times[1:] >= times[:-1]).all())
+
+def sort_by_time(array, time = 'BaseDateTime'):
+    '''
+    Return a record array stable sorted by time. An array that is already
+    sorted is returned as is.
+    '''
+    if is_sorted(array[time]):
+        return array
+    return array[np.argsort(array[time], kind='mergesort')]
+
+def array_chunks(array, time = 'BaseDateTime', chunk_size = CHUNK_SIZE):
+    '''
+    Return a time-sorted record array as a run of (times, rows) chunks.
+    '''
+    for start in range(0, len(array), chunk_size):
+        rows = array[start:start + chunk_size]
+        yield rows[time], rows
+
+def take(parts, order):
+    '''
+    Concatenate the rows of several chunks and return them in the given
+    order. Rows are either record arrays or lists of tuples.
+    '''
+    if isinstance(parts[0], np.ndarray):
+        return np.concatenate(parts)[order]
+    rows = []
+    for part in parts:
+        rows.extend(part)
+    return [rows[i] for i in order]
+
+
+# ------------------------------------------------------------------------------
+# MERGE
+# ------------------------------------------------------------------------------
+def merge_runs(runs):
+    '''
+    Merge runs of rows, each sorted by time, into one run sorted by time.
+
+    Each run is an iterable of (times, rows) chunks, where times is a NumPy
+    datetime64 column and rows a record array or list of tuples of the same
+    length. Only the current chunk of each run is held in memory. Rows are
+    ordered by (time, run index), so rows with equal timestamps come in the
+    order of their runs and, within a run, in their order in the run. In
+    each step every row up to the smallest (last time, run index) among the
+    current chunks of the runs that are not exhausted is emitted, so at
+    least one run needs its next chunk, and the rows are ordered with one
+    stable sort.
+
+    :param runs: Time-sorted runs
+    :type runs: list of iterables
+
+    :return: Generator of merged (times, rows) chunks
+    :rtype: generator
+    '''
+    iterators = [iter(run) for run in runs]
+    pending = [None] * len(iterators)
+    live = [True] * len(iterators)
+    while True:
+        for i, iterator in enumerate(iterators):
+            while live[i] and (pending[i] is None or len(pending[i][0]) == 0):
+                try:
+                    times, rows = next(iterator)
+                except StopIteration:
+                    live[i] = False
+                    break
+                pending[i] = (np.asarray(times), rows)
+
+        active = [
+            i for i in range(len(iterators))
+            if pending[i] is not None and len(pending[i][0])]
+        if not active:
+            return
+
+        # Rows after the cutoff may still be preceded by rows of another
+        # run; a later run's rows at the cutoff time wait for the next chunk
+        # of the run that set it
+        bounds = [(pending[i][0][-1], i) for i in active if live[i]]
+        cutoff = min(bounds) if bounds else None
+
+        times_parts, rows_parts = [], []
+        for i in active:
+            times, rows = pending[i]
+            if cutoff is None:
+                stop = len(times)
+            else:
+                side = 'right' if i <= cutoff[1] else 'left'
+                stop = int(np.searchsorted(times, cutoff[0], side=side))
+            if stop:
+                times_parts.append(times[:stop])
+                rows_parts.append(rows[:stop])
+                pending[i] = (times[stop:], rows[stop:])
+
+        times = np.concatenate(times_parts)
+        order = np.argsort(times, kind='mergesort')
+        yield times[order], take(rows_parts, order)
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.metrics
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: per-stage timing, row, byte, and memory instrumentation
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import ctypes
+import functools
+import json
+import logging
+import os
+from os.path import getsize, isdir, join
+import sys
+import threading
+import time
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+COUNTERS = ('rows_in', 'rows_out', 'bytes_read', 'bytes_written')
+
+# Seconds between samples of the resident set size while stages run
+SAMPLE_INTERVAL = 0.25
+
+PROMETHEUS = (
+    ('calls', 'Number of times the stage ran.'),
+    ('wall', 'Wall time spent in the stage in seconds.'),
+    ('cpu', 'CPU time spent in the stage in seconds.'),
+    ('rows_in', 'Rows read by the stage.'),
+    ('rows_out', 'Rows written by the stage.'),
+    ('bytes_read', 'Bytes read by the stage.'),
+    ('bytes_written', 'Bytes written by the stage.'),
+    ('peak_rss', 'Peak resident set size of the process during the stage in bytes.'))
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def cpu_time():
+    '''
+    Return the user and system CPU time of the process in seconds.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+def peak_rss():
+    '''
+    Return the peak resident set size of the process in bytes, or None if it
+    cannot be read.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return windows_peak_rss()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def rss():
+    '''
+    Return the current resident set size of the process in bytes. Where it
+    cannot be read, the peak is returned instead.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    if sys.platform == 'win32':
+        return windows_peak_rss(current=True)
+    return peak_rss()
+
+def windows_peak_rss(current = False):
+    '''
+    Return the peak working set size of the process in bytes on Windows, or
+    the current working set size if current is True.
+    '''
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ('cb', ctypes.c_ulong),
+            ('PageFaultCount', ctypes.c_ulong),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t)]
+    try:
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            process, ctypes.byref(counters), counters.cb)
+        if current:
+            return counters.WorkingSetSize
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+def path_size(path):
+    '''
+    Return the size in bytes of a file, or of every file under a folder such
+    as a file geodatabase. Missing paths have size 0.
+
+    :param path: File or folder
+    :type path: string
+
+    :return: Size in bytes
+    :rtype: int
+    '''
+    if not os.path.exists(path):
+        return 0
+    if not isdir(path):
+        return getsize(path)
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += getsize(join(dirpath, name))
+            except OSError:
+                # Lock files come and go
+                continue
+    return size
+
+
+# ------------------------------------------------------------------------------
+# SAMPLER
+# ------------------------------------------------------------------------------
+class Sampler(threading.Thread):
+
+    '''
+    Daemon thread that samples the resident set size every interval seconds
+    and raises the peak_rss of every running record of a recorder.
+    '''
+
+    def __init__(self, recorder, interval = SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.recorder = recorder
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.recorder.sample()
+
+    def stop(self):
+        '''
+        Stop sampling and wait for the thread to finish.
+        '''
+        self.stopped.set()
+        self.join()
+
+
+# ------------------------------------------------------------------------------
+# RECORDER
+# ------------------------------------------------------------------------------
+class Recorder(object):
+
+    '''
+    Record of every stage run in a process. Each record holds the stage
+    name, the MMSI if the stage works on one vessel, the wall and CPU time,
+    the rows and bytes in and out, and the peak RSS of the process while the
+    stage ran, sampled every SAMPLE_INTERVAL seconds and at its start and
+    end.
+
+    Records are kept per thread while a stage runs, so a stage on the fetch
+    thread of ais_arcpy.pipeline does not mix with the processing thread.
+    Records made in worker processes are added with add.
+    '''
+
+    def __init__(self, basepath = None, prometheus = False):
+        self.basepath = basepath
+        self.prometheus = prometheus
+        self.started = time.time()
+        self.records = []
+        self.running = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sampler = None
+
+    def start(self, name, mmsi = None):
+        '''
+        Start a record for a stage and make it the current record of the
+        thread.
+        '''
+        record = {
+            'stage': name,
+            'mmsi': mmsi,
+            'pid': os.getpid(),
+            'start': time.time(),
+            'cpu_start': cpu_time(),
+            'peak_rss': rss()}
+        for key in COUNTERS:
+            record[key] = 0
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(record)
+        with self.lock:
+            self.running.append(record)
+            if self.sampler is None:
+                self.sampler = Sampler(self)
+                self.sampler.start()
+        return record
+
+    def stop(self, record, error = None):
+        '''
+        Finish the current record of the thread.
+        '''
+        self.local.stack.remove(record)
+        record['wall'] = time.time() - record.pop('start')
+        record['cpu'] = cpu_time() - record.pop('cpu_start')
+        size = rss()
+        if error is not None:
+            record['error'] = error
+        with self.lock:
+            self.running.remove(record)
+            record['peak_rss'] = max(record['peak_rss'] or 0, size or 0)
+            self.records.append(record)
+
+    def sample(self):
+        '''
+        Raise the peak RSS of every running record to the current RSS.
+        '''
+        size = rss()
+        with self.lock:
+            for record in self.running:
+                record['peak_rss'] = max(record['peak_rss'] or 0, size or 0)
+
+    def close(self):
+        '''
+        Stop sampling the RSS.
+        '''
+        with self.lock:
+            sampler, self.sampler = self.sampler, None
+        if sampler is not None:
+            sampler.stop()
+
+    def add(self, records):
+        '''
+        Add finished records made by another recorder, such as one in a
+        worker process.
+        '''
+        with self.lock:
+            self.records.extend(records)
+
+    def current(self):
+        '''
+        Return the current record of the thread, or None outside a stage.
+        '''
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def update(self, mmsi = None, record = None, **counts):
+        '''
+        Set the MMSI of the current record of the thread and add to its row
+        and byte counters. Does nothing outside a stage.
+
+        A record taken with current() on another thread can be given, for
+        work a stage hands to a thread pool.
+        '''
+        if record is None:
+            record = self.current()
+            if record is None:
+                return
+        with self.lock:
+            if mmsi is not None:
+                record['mmsi'] = str(mmsi)
+            for key, value in counts.items():
+                if key not in COUNTERS:
+                    raise KeyError('Unknown counter %s.' % key)
+                record[key] += int(value or 0)
+
+    def summary(self):
+        '''
+        Return the totals of every stage: calls, wall and CPU time, rows and
+        bytes, and the largest peak RSS.
+
+        :return: Dictionary of stage name to totals
+        :rtype: dict
+        '''
+        stages = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            total = stages.setdefault(record['stage'], {
+                'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+            total['calls'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['peak_rss'] = max(total['peak_rss'], record['peak_rss'] or 0)
+            for key in COUNTERS:
+                total[key] = total.get(key, 0) + record[key]
+        return stages
+
+    def slowest(self, count = 20):
+        '''
+        Return the MMSI records with the longest wall time.
+
+        :param count: Number of records to return
+        :type count: int
+
+        :return: Records, slowest first
+        :rtype: list of dicts
+        '''
+        with self.lock:
+            records = [r for r in self.records if r['mmsi'] is not None]
+        return sorted(records, key=lambda r: r['wall'], reverse=True)[:count]
+
+    def report(self):
+        '''
+        Return the run report: the stage totals, the slowest vessels, and
+        every record.
+        '''
+        with self.lock:
+            records = list(self.records)
+        return {
+            'started': self.started,
+            'finished': time.time(),
+            'pid': os.getpid(),
+            'stages': self.summary(),
+            'slowest': self.slowest(),
+            'records': records}
+
+    def write(self, basepath = None):
+        '''
+        Write the run report to basepath + '.json' and, if enabled, the stage
+        totals in the Prometheus text format to basepath + '.prom'.
+
+        :param basepath: Path without extension, default is the one given
+            when the recorder was created
+        :type basepath: string
+
+        :return: Paths written
+        :rtype: list of strings
+        '''
+        from . import util
+
+        basepath = basepath or self.basepath
+        if basepath is None:
+            return []
+
+        written = [basepath + '.json']
+        temp = basepath + '.json.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+        util.replace_file(temp, written[0])
+
+        if self.prometheus:
+            written.append(basepath + '.prom')
+            temp = basepath + '.prom.tmp'
+            with open(temp, 'w') as f:
+                f.write(self.format_prometheus())
+            util.replace_file(temp, written[1])
+        logger.info('Wrote run report to %s.', ', '.join(written))
+        return written
+
+    def format_prometheus(self):
+        '''
+        Return the stage totals in the Prometheus text exposition format, for
+        the node exporter textfile collector.
+        '''
+        stages = self.summary()
+        lines = []
+        for key, text in PROMETHEUS:
+            metric = 'ais_arcpy_stage_%s' % key
+            if key in ('wall', 'cpu'):
+                metric += '_seconds'
+            elif key == 'peak_rss':
+                metric += '_bytes'
+            lines.append('# HELP %s %s' % (metric, text))
+            lines.append('# TYPE %s gauge' % metric)
+            for name in sorted(stages):
+                lines.append('%s{stage="%s"} %s' % (metric, name, stages[name][key]))
+        return '\n'.join(lines) + '\n'
+
+
+# ------------------------------------------------------------------------------
+# ACTIVE RECORDER
+# ------------------------------------------------------------------------------
+_active = None
+
+def start(basepath = None, prometheus = False):
+    '''
+    Start recording the stages of this process.
+
+    :param basepath: Path of the run report without extension
+    :param prometheus: Also write a Prometheus textfile
+
+    :type basepath: string
+    :type prometheus: bool
+
+    :return: Active recorder
+    :rtype: Recorder
+    '''
+    global _active
+    _active = Recorder(basepath, prometheus)
+    return _active
+
+def finish():
+    '''
+    Write the reports of the active recorder and stop recording.
+
+    :return: Paths written
+    :rtype: list of strings
+    '''
+    global _active
+    recorder, _active = _active, None
+    if recorder is None:
+        return []
+    recorder.close()
+    return recorder.write()
+
+def active():
+    '''
+    Return the active recorder, or None.
+    '''
+    return _active
+
+def add(records):
+    '''
+    Add records made in a worker process to the active recorder. Does
+    nothing when no recorder is active.
+    '''
+    if _active is not None:
+        _active.add(records)
+
+def current():
+    '''
+    Return the current record of the thread, or None when no recorder is
+    active or no stage is running.
+    '''
+    if _active is not None:
+        return _active.current()
+
+def update(mmsi = None, record = None, **counts):
+    '''
+    Set the MMSI of the current stage, or of the given record, and add to
+    its row and byte counters. Does nothing when no recorder is active.
+    '''
+    if _active is not None:
+        _active.update(mmsi, record, **counts)
+
+def measure(name):
+    '''
+    Decorator recording each call of a function as a stage. Calls are not
+    recorded when no recorder is active.
+
+    :param name: Stage name
+    :type name: string
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = _active
+            if recorder is None:
+                return func(*args, **kwargs)
+            record = recorder.start(name)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                recorder.stop(record, repr(err))
+                raise
+            recorder.stop(record)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.parallel
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: preprocess months in a pool of worker processes
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import multiprocessing
+import os
+from os.path import join
+
+from . import metrics
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+# WORKER
+# ------------------------------------------------------------------------------
+def preprocess_staged(task):
+    '''
+    Download, split, and add XY fields to one month without aggregating it.
+    Runs in a worker process with its own arcpy environment; the scratch
+    workspace is set to a folder inside the month workspace.
+
+    If the calling process records metrics, the stages of the month are
+    recorded in the worker and returned, so the caller can add them to its
+    run report.
+
+    :param task: Directory, zone, year, month, Raw_Month keyword options,
+        and whether to record metrics
+    :type task: tuple
+
+    :return: Zone, year, and month that were processed, and the records of
+        their stages
+    :rtype: tuple
+    '''
+    import arcpy
+    from . import raw
+
+    directory, zone, year, month, options, record = task
+    recorder = metrics.start() if record else None
+    try:
+        raw_month = raw.Raw_Month(
+            directory, zone, year, month, staged=True, **options)
+
+        scratch = join(raw_month.workspace, 'scratch')
+        if not os.path.exists(scratch):
+            os.makedirs(scratch)
+        arcpy.env.scratchWorkspace = scratch
+
+        raw_month.preprocess_month()
+    finally:
+        if recorder is not None:
+            metrics.finish()
+    records = recorder.records if recorder is not None else []
+    return zone, year, month, records
+
+
+# ------------------------------------------------------------------------------
+# DRIVER
+# ------------------------------------------------------------------------------
+def preprocess_months(directory, zones, year, months, processes = None, **options):
+    '''
+    Preprocess every zone and month of a year in a pool of worker processes.
+    Workers stage each month in its own workspace; the calling process
+    merges the staged months into the shared MMSI gdb or store one at a
+    time, as soon as each month is finished. The stages run in the workers
+    are added to the run report of the calling process, if there is one.
+
+    On Windows this must be called from under an
+    ``if __name__ == '__main__':`` guard.
+
+    :param directory: Root directory for the data
+    :param zones: Zones to process
+    :param year: Year to process
+    :param months: Months to process
+    :param processes: Number of worker processes, default is the CPU count
+    :param options: Keyword options passed to Raw_Month
+
+    :type directory: string
+    :type zones: list of strings
+    :type year: string
+    :type months: list of strings
+    :type processes: int
+    :type options: dict
+
+    :return: List of (zone, year, month) in the order they were merged
+    :rtype: list of tuples
+    '''
+    from . import raw
+
+    record = metrics.active() is not None
+    tasks = [
+        (directory, zone, year, month, options, record)
+        for zone in zones
+        for month in months]
+
+    merged = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for zone, year, month, records in pool.imap_unordered(
+                preprocess_staged, tasks):
+            metrics.add(records)
+            logger.info('Merging zone %s, %s-%s...', zone, year, month)
+            raw_month = raw.Raw_Month(
+                directory, zone, year, month, staged=True, **options)
+            raw_month.merge_month()
+            merged.append((zone, year, month))
+        pool.close()
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return merged
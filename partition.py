@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.partition
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: csv output partitioned by zone, year, and month
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import csv
+import gzip
+import io
+import itertools
+import logging
+import os
+from os.path import join
+import re
+import sys
+import time
+
+from . import export
+from . import store
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+INDEX = '.index.json'
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def mmsi_digits(name):
+    '''
+    Return the digits of a feature class or file name, the MMSI it
+    contains, or an empty string if it has none.
+    '''
+    return re.sub(r'\D', '', os.path.basename(str(name)))
+
+def mmsi_key(name):
+    '''
+    Return a sort key that orders feature class names or paths by the MMSI
+    they contain.
+    '''
+    digits = mmsi_digits(name)
+    return (int(digits) if digits else -1, str(name))
+
+def compress(data, compression = None):
+    '''
+    Compress a row group on its own, so it can be read from its byte range.
+    Concatenated gzip members and xz streams also read as one file.
+    '''
+    if compression is None:
+        return data
+    if compression == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+            f.write(data)
+        return buf.getvalue()
+    if compression == 'lzma':
+        if export.lzma is None:
+            raise ValueError('lzma compression needs the backports.lzma package.')
+        return export.lzma.compress(data)
+    raise ValueError('Unknown compression %s.' % compression)
+
+def decompress(data, compression = None):
+    '''
+    Decompress a row group read from its byte range.
+    '''
+    if compression is None:
+        return data
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    return export.lzma.decompress(data)
+
+def parse_rows(data):
+    '''
+    Parse csv bytes into a list of rows of strings.
+    '''
+    if sys.version_info[0] < 3:
+        return list(csv.reader(io.BytesIO(data)))
+    return list(csv.reader(io.StringIO(data.decode('utf-8'))))
+
+
+# ------------------------------------------------------------------------------
+# WRITER
+# ------------------------------------------------------------------------------
+class PartitionWriter(object):
+
+    '''
+    Write the EEZ points of a zone and year to one csv file per month,
+    <directory>/Zone<zone>_<year>_<month>_eez.csv, instead of one file per
+    vessel.
+
+    Vessels must be written in MMSI order. Each vessel's rows for a month
+    are sorted by time and written as one row group, compressed on its own
+    if compression is given. A sidecar index, the file name plus
+    '.index.json', records the byte range and row count of each row group,
+    so one vessel can be read without scanning the file. The files are
+    written under temporary names and renamed when the writer is closed.
+    '''
+
+    def __init__(self, directory, zone, fields, compression = None,
+                 time_field = 'BaseDateTime', mmsi_field = 'MMSI'):
+        export.output_path('', compression)
+        self.directory = directory
+        self.zone = zone
+        self.fields = list(fields)
+        self.compression = compression
+        self.time = self.fields.index(time_field)
+        self.mmsi = self.fields.index(mmsi_field)
+        self.partitions = {}
+        self.last = None
+        self.start = time.time()
+        self.stats = {'files': 0, 'rows': 0, 'bytes': 0, 'groups': 0}
+
+    def path(self, year, month):
+        '''
+        Return the path of the partition of a year and month.
+        '''
+        name = 'Zone%s_%04d_%02d_eez.csv' % (self.zone, year, month)
+        return export.output_path(join(self.directory, name), self.compression)
+
+    def partition(self, year, month):
+        '''
+        Return the open partition of a year and month, creating it with a
+        header row group on first use.
+        '''
+        key = (year, month)
+        if key not in self.partitions:
+            filepath = self.path(year, month)
+            f = open(filepath + '.part', 'wb', export.BUFFER_SIZE)
+            header = compress(export.format_rows([self.fields]), self.compression)
+            f.write(header)
+            self.partitions[key] = {
+                'path': filepath,
+                'file': f,
+                'offset': len(header),
+                'header': [0, len(header)],
+                'groups': []}
+        return self.partitions[key]
+
+    def write(self, rows):
+        '''
+        Write the rows of one vessel. The rows are split into row groups by
+        the month of their timestamp.
+
+        :param rows: Rows with the writer's fields, timestamps as datetime
+        :type rows: list of sequences
+        '''
+        if not rows:
+            return
+        mmsi = rows[0][self.mmsi]
+        if self.last is not None and mmsi_key(mmsi) < mmsi_key(self.last):
+            logger.warning('MMSI %s written after %s.', mmsi, self.last)
+        self.last = mmsi
+
+        rows = sorted(rows, key=lambda row: row[self.time])
+        month = lambda row: (row[self.time].year, row[self.time].month)
+        for key, group in itertools.groupby(rows, month):
+            group = list(group)
+            data = compress(export.format_rows(group), self.compression)
+            part = self.partition(*key)
+            part['file'].write(data)
+            part['groups'].append([str(mmsi), part['offset'], len(data), len(group)])
+            part['offset'] += len(data)
+            self.stats['groups'] += 1
+            self.stats['rows'] += len(group)
+
+    def close(self):
+        '''
+        Close every partition, write its index, and rename it into place.
+
+        :return: Files, row groups, rows, bytes, and seconds
+        :rtype: dict
+        '''
+        for key in sorted(self.partitions):
+            part = self.partitions[key]
+            part['file'].close()
+            store.write_json(part['path'] + INDEX, {
+                'fields': self.fields,
+                'compression': self.compression,
+                'header': part['header'],
+                'groups': part['groups']})
+            util.replace_file(part['path'] + '.part', part['path'])
+            self.stats['files'] += 1
+            self.stats['bytes'] += part['offset']
+        self.partitions = {}
+        self.stats['seconds'] = time.time() - self.start
+        logger.info(
+            'Wrote %d partitions, %d row groups, %d rows, %.1f MB in %.1fs.',
+            self.stats['files'], self.stats['groups'], self.stats['rows'],
+            self.stats['bytes'] / 1e6, self.stats['seconds'])
+        return self.stats
+
+
+# ------------------------------------------------------------------------------
+# READERS
+# ------------------------------------------------------------------------------
+def read_index(filepath):
+    '''
+    Return the index of a partition.
+
+    :param filepath: Path of the partition
+    :type filepath: string
+
+    :return: Fields, compression, header byte range, and row groups as
+        [MMSI, offset, length, rows]
+    :rtype: dict
+    '''
+    index = store.read_json(filepath + INDEX, None)
+    if index is None:
+        raise util.fileNotFound(os.path.dirname(filepath), os.path.basename(filepath) + INDEX)
+    return index
+
+def read_vessel(filepath, mmsi, index = None):
+    '''
+    Return the rows of one vessel in a partition, read from the byte ranges
+    of its row groups.
+
+    :param filepath: Path of the partition
+    :param mmsi: MMSI of the vessel
+    :param index: Index of the partition, read from its sidecar if None
+
+    :type filepath: string
+    :type mmsi: int or string
+    :type index: dict
+
+    :return: Rows of strings, without the header
+    :rtype: list of lists
+    '''
+    index = index or read_index(filepath)
+    rows = []
+    with open(filepath, 'rb') as f:
+        for name, offset, length, count in index['groups']:
+            if name != str(mmsi):
+                continue
+            f.seek(offset)
+            rows.extend(parse_rows(decompress(f.read(length), index['compression'])))
+    return rows
+
+def iter_rows(filepath):
+    '''
+    Stream every row of a partition in MMSI and time order, starting with
+    the header.
+
+    :param filepath: Path of the partition
+    :type filepath: string
+
+    :return: Generator of rows of strings
+    :rtype: generator
+    '''
+    index = read_index(filepath)
+    with open(filepath, 'rb') as f:
+        for start, length in [index['header']] + [g[1:3] for g in index['groups']]:
+            f.seek(start)
+            for row in parse_rows(decompress(f.read(length), index['compression'])):
+                yield row
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.pipeline
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: overlap downloading of months with processing
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+DEPTH = 2
+
+
+# ------------------------------------------------------------------------------
+# PIPELINE
+# ------------------------------------------------------------------------------
+class Pipeline(object):
+
+    '''
+    Run Raw_Month.preprocess_month for several months with the download
+    and extraction of later months running on a background thread.
+
+    The fetch stage runs download_raw_data and the process stage runs
+    process_month. At most depth months are fetched ahead of the month
+    being processed; the fetch stage takes a slot from a bounded queue
+    before each download and the process stage returns it once the month
+    is processed. The slots bound the months downloaded but not yet
+    processed. A processed month keeps its raw gdb and its copy on disk
+    unless cleanup is True, when its raw gdb and zip file are deleted with
+    Raw_Month.delete_raw_data before its slot is returned, so disk use
+    stays bounded by the raw data of depth + 1 months plus the copies.
+
+    The time each stage spends working and waiting on the other stage is
+    recorded in stats. The stage that waits least limits throughput.
+    '''
+
+    def __init__(self, raw_months, depth = DEPTH, cleanup = False):
+        self.raw_months = list(raw_months)
+        self.depth = depth
+        self.cleanup = cleanup
+        self.stats = {
+            'fetch': 0.0,
+            'fetch_wait': 0.0,
+            'process': 0.0,
+            'process_wait': 0.0}
+        self.logger = logging.getLogger(__name__)
+
+    def fetch(self, slots, ready, stop):
+        '''
+        Background thread: download and extract each month in order.
+        '''
+        for raw_month in self.raw_months:
+            start = time.time()
+            slots.put(None)
+            self.stats['fetch_wait'] += time.time() - start
+            if stop.is_set():
+                return
+
+            start = time.time()
+            try:
+                raw_month.download_raw_data()
+            except Exception as err:
+                ready.put((raw_month, err))
+                return
+            self.stats['fetch'] += time.time() - start
+            ready.put((raw_month, None))
+
+    def run(self):
+        '''
+        Preprocess every month and return the stage timings.
+
+        :return: Seconds spent working and waiting in each stage
+        :rtype: dict
+        '''
+        slots = queue.Queue(maxsize=self.depth + 1)
+        ready = queue.Queue()
+        stop = threading.Event()
+        thread = threading.Thread(target=self.fetch, args=(slots, ready, stop))
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for _ in self.raw_months:
+                start = time.time()
+                raw_month, err = ready.get()
+                self.stats['process_wait'] += time.time() - start
+                if err is not None:
+                    raise err
+
+                start = time.time()
+                self.logger.info('Processing %s...', raw_month.workspace)
+                raw_month.process_month()
+                if self.cleanup:
+                    raw_month.delete_raw_data()
+                self.stats['process'] += time.time() - start
+                slots.get()
+        finally:
+            stop.set()
+            # Unblock the fetch thread if it is waiting for a slot
+            while not slots.empty():
+                slots.get()
+
+        thread.join()
+        self.report()
+        return self.stats
+
+    def report(self):
+        '''
+        Log the stage timings and the stage that limits throughput.
+        '''
+        for stage in ('fetch', 'process'):
+            self.logger.info(
+                '%s: %.1fs working, %.1fs waiting', stage,
+                self.stats[stage], self.stats[stage + '_wait'])
+        limit = min(('fetch', 'process'), key=lambda s: self.stats[s + '_wait'])
+        self.logger.info('Throughput is limited by the %s stage.', limit)
+
+
+# ------------------------------------------------------------------------------
+# CONVENIENCE
+# ------------------------------------------------------------------------------
+def preprocess_months(directory, zone, year, months, depth = DEPTH,
+                      cleanup = False, **options):
+    '''
+    Preprocess the months of a zone and year, fetching up to depth months
+    ahead of the month being processed.
+
+    :param directory: Root directory for the data
+    :param zone: Zone to process
+    :param year: Year to process
+    :param months: Months to process, in order
+    :param depth: Number of months to fetch ahead
+    :param cleanup: Delete the raw data of each month once it is processed
+    :param options: Keyword options passed to Raw_Month
+
+    :type directory: string
+    :type zone: string
+    :type year: string
+    :type months: list of strings
+    :type depth: int
+    :type cleanup: bool
+    :type options: dict
+
+    :return: Seconds spent working and waiting in each stage
+    :rtype: dict
+    '''
+    from . import raw
+
+    raw_months = [
+        raw.Raw_Month(directory, zone, year, month, **options)
+        for month in months]
+    return Pipeline(raw_months, depth, cleanup).run()
@@ -14,16 +14,139 @@
 # ------------------------------------------------------------------------------
 import arcpy
 from arcpy import env
-import csv
 from datetime import datetime
+import itertools
 import logging
+import numpy as np
 import os
-from os.path import exists, expanduser, join
+from os.path import dirname, exists, expanduser, join
+import shutil
 import webbrowser
 
+from . import backend as backends
+from . import catalog
+from . import dedup
+from . import download
+from . import eez
+from . import export
+from . import kinematics
+from . import memory
+from . import merge
+from . import metrics
+from . import partition
+from . import simplify
+from . import split
+from . import store
+from . import track
+from . import trackindex
 from . import util
 
 
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def read_array(fc, where_clause=None, field_types=None):
+    '''
+    Read a feature class into a record array. The point geometry is read
+    into the POINT_X and POINT_Y fields. The (name, type) pairs of the
+    fields are listed from the feature class unless they are given.
+    '''
+    if field_types is None:
+        field_types = [(f.name, f.type) for f in arcpy.ListFields(fc)]
+    fields = [
+        (name, kind) for name, kind in field_types
+        if kind not in ('OID', 'Geometry')
+        and name not in ('POINT_X', 'POINT_Y')]
+    names = [name for name, _ in fields]
+
+    # Numeric nulls cannot be held in a NumPy array
+    null_value = {}
+    for name, kind in fields:
+        if kind in ('Double', 'Single'):
+            null_value[name] = np.nan
+        elif kind in ('Integer', 'SmallInteger'):
+            null_value[name] = -1
+
+    array = arcpy.da.FeatureClassToNumPyArray(
+        fc,
+        names + ['SHAPE@X', 'SHAPE@Y'],
+        where_clause,
+        null_value=null_value)
+    array.dtype.names = tuple(names + ['POINT_X', 'POINT_Y'])
+    return array
+
+def read_batches(fc, field_types, batch_size=split.BATCH_SIZE):
+    '''
+    Read a feature class into record arrays in OBJECTID batches, see
+    read_array.
+    '''
+    oid = arcpy.Describe(fc).OIDFieldName
+    sql = (None, 'ORDER BY %s DESC' % oid)
+    with arcpy.da.SearchCursor(fc, ['OID@'], sql_clause=sql) as cursor:
+        last = next(cursor, (0,))[0]
+
+    for start in range(0, last, batch_size):
+        where = '%s > %d AND %s <= %d' % (oid, start, oid, start + batch_size)
+        yield read_array(fc, where, field_types)
+
+def append_array(fc, array):
+    '''
+    Insert the records of a record array into a feature class written by
+    NumPyArrayToFeatureClass, with POINT_X and POINT_Y as the point.
+    '''
+    names = list(array.dtype.names)
+    rows = export.column_rows(dict((name, array[name]) for name in names), names)
+    points = zip(array['POINT_X'].tolist(), array['POINT_Y'].tolist())
+    with arcpy.da.InsertCursor(fc, names + ['SHAPE@XY']) as cursor:
+        for row, point in zip(rows, points):
+            cursor.insertRow(row + (point,))
+
+def read_sorted(fc, fields, time_field='BaseDateTime', chunk_size=merge.CHUNK_SIZE):
+    '''
+    Read the rows of a feature class in time order, sorted by the
+    geodatabase, as a run of (times, rows) chunks for merge.merge_runs.
+    '''
+    position = fields.index(time_field)
+    sql = (None, 'ORDER BY %s' % time_field)
+    with arcpy.da.SearchCursor(fc, fields, sql_clause=sql) as cursor:
+        while True:
+            rows = list(itertools.islice(cursor, chunk_size))
+            if not rows:
+                return
+            times = np.array([row[position] for row in rows], dtype='M8[us]')
+            yield times, rows
+
+def time_bound(fc, last=False, time_field='BaseDateTime'):
+    '''
+    Return the first or last timestamp of a feature class, or None if it is
+    empty.
+    '''
+    sql = (None, 'ORDER BY %s%s' % (time_field, ' DESC' if last else ''))
+    with arcpy.da.SearchCursor(fc, [time_field], sql_clause=sql) as cursor:
+        return next(cursor, (None,))[0]
+
+def read_times(fc, time_field='BaseDateTime'):
+    '''
+    Return the timestamps of a feature class in the order the rows are
+    stored.
+    '''
+    array = arcpy.da.FeatureClassToNumPyArray(fc, [time_field])
+    return array[time_field].astype('M8[us]')
+
+def insert_rows(fc, fields, chunks):
+    '''
+    Insert runs of (times, rows) chunks into a feature class and return the
+    number of rows inserted.
+    '''
+    count = 0
+    with arcpy.da.InsertCursor(fc, fields) as cursor:
+        for _, rows in chunks:
+            for row in rows:
+                cursor.insertRow(row)
+            count += len(rows)
+    return count
+
+
 # ------------------------------------------------------------------------------
 # RAW DATA OBJECT
 # ------------------------------------------------------------------------------
@@ -39,20 +162,88 @@ class Raw_Month(object):
     file is split by the ship identification number (MMSI). The latitude and
     longitude of each data point is added to the feature table. Finally, the
     data for a given MMSI is aggregated in a mmsi_gdb across months.
+
+    The split engine is either 'arcpy', which uses SplitByAttributes, or
+    'numpy', which reads the Broadcast file in batches, sorts it once by MMSI
+    and BaseDateTime, and writes each vessel's slice as a feature class.
+
+    The aggregation target is either 'gdb', the MMSI geodatabase, or 'store',
+    a columnar MMSI store with one file per field (see ais_arcpy.store).
+
+    All paths are absolute, so the arcpy workspace is never changed and
+    months can be processed side by side. A staged month is not aggregated
+    by preprocess_month; merge_month adds it to the MMSI gdb or store later.
+
+    If the path to an EEZ mask (see Raw_MMSI.make_eez_mask) is given, points
+    outside the EEZ are removed from the Broadcast file before it is split,
+    so they never reach the MMSI gdb or store.
+
+    If a download cache (see ais_arcpy.cache) is given, the raw data zip is
+    fetched from and kept in the cache instead of the workspace.
+
+    If a manifest (see ais_arcpy.manifest) is given, each stage of the month
+    and each MMSI aggregated is recorded in it. Completed units are skipped
+    on a re-run without touching the geodatabase, and interrupted units are
+    cleaned up and retried once.
+
+    If index_tracks is True, the bounding box and time range of each vessel
+    on each day are recorded in a track index (see ais_arcpy.trackindex) as
+    the month is aggregated. For the MMSI store the index also holds the
+    rows covering each day.
+
+    If deduplicate is True, reports repeated by several receivers or seen in
+    an earlier run are dropped as the month is aggregated (see
+    ais_arcpy.dedup). The keys of each vessel are kept next to the MMSI gdb
+    or store.
+
+    If kinematic_fields is True, the time delta, distance, implied speed,
+    heading change, and spike and gap flags of each point are added to each
+    vessel's month after the XY fields (see ais_arcpy.kinematics).
+
+    If a memory budget (see ais_arcpy.memory) is given, the EEZ filter,
+    split, and aggregation read rows in chunks sized from the budget. A
+    broadcast file that does not fit is split through spill files holding
+    a share of the vessels each, and a month file that does not fit is
+    stored from a spill file. The peak memory of each stage is logged.
+
+    The arcpy split and the XY fields run through a backend (see
+    ais_arcpy.backend), an ArcpyBackend unless another is given, so the
+    benchmark times the same calls.
     '''
 
-    def __init__(self, directory, zone, year, month):
+    def __init__(self, directory, zone, year, month, split_engine='arcpy',
+                 aggregate='gdb', staged=False, eez_mask=None, cache=None,
+                 manifest=None, index_tracks=False, deduplicate=False,
+                 kinematic_fields=False, memory_budget=None, backend=None):
         self.root = directory
         self.year = year
         self.month = month
         self.zone = zone
         self.parameters = (self.zone, self.year, self.month)
+        self.split_engine = split_engine
+        self.aggregate = aggregate
+        self.staged = staged
+        self.eez_mask = eez_mask
+        self.eez_removed = None
+        self.cache = cache
+        self.manifest = manifest
+        self.index_tracks = index_tracks
+        self.kinematic_fields = kinematic_fields
+        self.memory_budget = memory_budget
+        self.backend = backend or backends.ArcpyBackend()
+        self.dedup = None
+        if deduplicate:
+            name_keys = 'Zone%s_%s_MMSI.keys' % (self.zone, self.year)
+            self.dedup = dedup.Deduplicator(join(self.root, self.year, 'MMSI', name_keys))
+        self.extract_stats = None
+        self.catalog = catalog.Catalog()
+        self._store = None
+        self._mask = None
 
         # Arcpy environment
         self.workspace = join(self.root, self.year, self.month, 'Zone ' + self.zone)
         if not exists(self.workspace):
             os.makedirs(self.workspace)
-        arcpy.env.workspace = self.workspace
         arcpy.env.overwriteOutput = False
 
         # Geo-Databases
@@ -69,18 +260,94 @@ class Raw_Month(object):
         '''
         Main method.
         '''
-        print('Current arcpy workspace: %s' % arcpy.env.workspace)
-        self.logger.info('Current arcpy workspace: %s', arcpy.env.workspace)
+        if not self.begin('month'):
+            self.logger.info('Month %s already processed.', self.month)
+            return
+
+        print('Current workspace: %s' % self.workspace)
+        self.logger.info('Current workspace: %s', self.workspace)
         self.download_raw_data()
+        self.process_month()
+
+    def begin(self, stage, mmsi=''):
+        '''
+        Start a unit of work in the manifest and return the attempt number,
+        or 0 if the unit is done and should be skipped. Without a manifest
+        every unit is run as a first attempt.
+
+        :raises unitFailed: The unit failed its last attempt, so the month
+            is not processed further or marked done
+        '''
+        if self.manifest is None:
+            return 1
+        return self.manifest.begin(self.zone, self.year, self.month, mmsi, stage)
+
+    def finish(self, stage, mmsi='', rows=None):
+        '''
+        Record a completed unit of work in the manifest.
+        '''
+        if self.manifest is not None:
+            self.manifest.finish(self.zone, self.year, self.month, mmsi, stage, rows)
+
+    def process_month(self):
+        '''
+        Process the downloaded raw data: copy, split, add XY fields, and
+        aggregate.
+        '''
         self.copy_raw_data()
+        if self.eez_mask:
+            self.filter_eez()
         self.split_by_mmsi()
 
-        self.logger.info('Getting list of feature classes in %s...', self.gdb_copy)
-        arcpy.env.workspace = join(self.workspace, self.gdb_copy)
-        featureClasses = arcpy.ListFeatureClasses()
-        for fc in featureClasses:
+        for fc in self.list_feature_classes():
             self.add_xy(fc)
-            self.aggregate_month_mmsi(fc)
+            if self.kinematic_fields:
+                self.add_kinematics(fc)
+            # A staged month may only write to its own store
+            if not self.staged or self.aggregate == 'store':
+                self.aggregate_month_mmsi(fc)
+
+        if not self.staged:
+            self.finish('month')
+        self.catalog.report()
+        if self.dedup is not None:
+            self.dedup.report()
+        if self.memory_budget is not None:
+            self.memory_budget.report()
+
+    @metrics.measure('month.merge')
+    def merge_month(self):
+        '''
+        Aggregate a staged month into the MMSI gdb or store. This is run by a
+        single process, so the shared MMSI data is never written concurrently.
+        '''
+        if self.manifest is not None and self.manifest.done(
+                self.zone, self.year, self.month, '', 'month'):
+            return
+
+        if self.aggregate == 'store':
+            month_store = self.store
+            self.logger.info('Merging %s into the MMSI store...', month_store.directory)
+            self.mmsi_store.merge(month_store)
+            shutil.rmtree(month_store.directory)
+            self._store = None
+        else:
+            for fc in self.list_feature_classes():
+                self.aggregate_month_mmsi(fc)
+            self.catalog.report()
+        if self.dedup is not None:
+            self.dedup.report()
+        if self.memory_budget is not None:
+            self.memory_budget.report()
+        self.finish('month')
+
+    def list_feature_classes(self):
+        '''
+        Return the paths of the feature classes in the copy of the raw gdb.
+        '''
+        gdb = join(self.workspace, self.gdb_copy)
+        self.logger.info('Getting list of feature classes in %s...', self.gdb_copy)
+        return self.catalog.list(gdb)
 
     @property
     def url(self):
@@ -93,6 +360,13 @@ class Raw_Month(object):
         if self.year == '2013':
             return 'https://coast.noaa.gov/htdata/CMSP/AISDataHandler/%s/%s/Zone%s_%s_%s.gdb.zip' % param
 
+    @property
+    def zip_file(self):
+        '''
+        Return the path the raw data zip file is downloaded to.
+        '''
+        return join(self.workspace, self.url.rsplit('/', 1)[1])
+
     @property
     def gdb_mmsi(self):
         '''
@@ -108,34 +382,136 @@ class Raw_Month(object):
             arcpy.CreateFileGDB_management(mmsi_folder, name_mmsi)
         return gdb
 
+    @property
+    def mmsi_store(self):
+        '''
+        Return the columnar MMSI store for the zone and year, create it if it
+        doesn't exist.
+        '''
+        name_store = 'Zone%s_%s_MMSI.store' % (self.zone, self.year)
+        return store.MMSIStore(
+            join(self.root, self.year, 'MMSI', name_store), self.track_index,
+            self.dedup)
+
+    @property
+    def track_index(self):
+        '''
+        Return the track index for the zone and year, or None if tracks are
+        not indexed.
+        '''
+        if not self.index_tracks:
+            return None
+        name_index = 'Zone%s_%s_MMSI.index.sqlite' % (self.zone, self.year)
+        return trackindex.TrackIndex(join(self.root, self.year, 'MMSI', name_index))
+
+    @property
+    def store(self):
+        '''
+        Return the store the month is aggregated to. A staged month has its
+        own store in the month workspace.
+        '''
+        if self._store is None:
+            if self.staged:
+                name_store = 'Zone%s_%s_%s_MMSI.store' % self.parameters
+                self._store = store.MMSIStore(join(self.workspace, name_store))
+            else:
+                self._store = self.mmsi_store
+        return self._store
+
+    @property
+    def mask(self):
+        '''
+        Return the tiled EEZ mask, loading it on first use.
+        '''
+        if self._mask is None:
+            self._mask = eez.EEZMask.load(self.eez_mask)
+        return self._mask
+
+    @metrics.measure('month.download')
     def download_raw_data(self):
         '''
         Download raw data from Marine Cadastre to local machine.
+
+        :raises unitFailed: The manifest records the download as failed
+            after its last attempt
         '''
-        if exists(join(self.workspace, self.gdb_raw)):
+        attempt = self.begin('download')
+        if not attempt:
+            self.logger.info('Data already downloaded for %s', self.month)
+            return
+
+        gdb = join(self.workspace, self.gdb_raw)
+        if attempt > 1 and exists(gdb):
+            self.logger.info('Removing partially extracted %s', self.gdb_raw)
+            shutil.rmtree(gdb)
+        if exists(gdb):
             self.logger.info('Data already downloaded for %s', self.month)
+            self.finish('download')
             return
 
         self.logger.info('Downloading data from %s:', self.url)
-        zfile = util.download_url(self.url, self.workspace, '.zip')
+        if self.cache is not None:
+            zfile = self.cache.fetch(self.url)
+        else:
+            zfile = download.fetch(self.url, self.zip_file)
+        metrics.update(bytes_read=metrics.path_size(zfile))
 
         if not exists(join(self.workspace, self.gdb_raw)):
             self.logger.info('Extracting files from %s:', zfile)
-            files.extract_zip(zfile, self.workspace)
-            os.remove(zfile)
+            self.extract_stats = util.extract_selected(
+                zfile, self.workspace, self.is_gdb_member, threads=4)
+            if self.cache is None:
+                os.remove(zfile)
+        self.finish('download')
+
+    def delete_raw_data(self):
+        '''
+        Delete the extracted raw gdb of a processed month, and its zip file
+        if no download cache is used. The copy of the raw gdb, which holds
+        the split feature classes, is kept. Without a manifest, a later run
+        downloads the month again.
+        '''
+        gdb = join(self.workspace, self.gdb_raw)
+        if exists(gdb):
+            self.logger.info('Deleting raw gdb %s', self.gdb_raw)
+            shutil.rmtree(gdb)
+        if self.cache is None and exists(self.zip_file):
+            os.remove(self.zip_file)
 
+    def is_gdb_member(self, name):
+        '''
+        Return True for zip members that belong to the raw gdb. Lock files
+        and any other files in the archive are not extracted.
+        '''
+        path = '/' + name
+        return '/%s/' % self.gdb_raw in path and not path.endswith('.lock')
+
+    @metrics.measure('month.copy')
     def copy_raw_data(self):
         '''
         Make copy of original gdb in same directory.
         '''
+        attempt = self.begin('copy')
+        if not attempt:
+            return
+
         copy = join(self.workspace, self.gdb_copy)
         raw = join(self.workspace, self.gdb_raw)
+        if attempt > 1 and exists(copy):
+            self.logger.info('Deleting partial copy of raw gdb: %s', self.gdb_copy)
+            arcpy.Delete_management(copy)
+            self.catalog.deleted(copy)
         if not exists(copy):
             self.logger.info('Making copy of raw gdb: %s', self.gdb_copy)
             arcpy.Copy_management(raw, copy)
+            self.catalog.invalidate(copy)
+            size = metrics.path_size(copy)
+            metrics.update(bytes_read=size, bytes_written=size)
         else:
             self.logger.info('Copy of raw gdb already exits: %s', self.gdb_copy)
+        self.finish('copy')
 
+    @metrics.measure('month.split')
     def split_by_mmsi(self):
         '''
         Split the broadcast file by MMSI.
@@ -143,64 +519,577 @@ class Raw_Month(object):
         After the broadcast file has been split by MMSI, it is deleted. This
         is used to prevent the splitting process from running more than once.
         '''
-        input_file = join(self.gdb_copy, self.broadcast)
-        if not arcpy.Exists(input_file):
+        attempt = self.begin('split')
+        if not attempt:
             self.logger.info('%s already split by MMSI.', self.broadcast)
             return
 
+        input_file = join(self.workspace, self.gdb_copy, self.broadcast)
+        if not self.catalog.exists(input_file):
+            input_file += '_eez'
+        if not self.catalog.exists(input_file):
+            self.logger.info('%s already split by MMSI.', self.broadcast)
+            self.finish('split')
+            return
+
+        if attempt > 1:
+            self.logger.info('Deleting output of interrupted split...')
+            for fc in self.list_feature_classes():
+                if not os.path.basename(fc).startswith(self.broadcast):
+                    arcpy.Delete_management(fc)
+                    self.catalog.deleted(fc)
+
         self.logger.info('Splitting %s by MMSI...', self.broadcast)
-        arcpy.SplitByAttributes_analysis(input_file, self.gdb_copy, ['MMSI'])
+        if self.split_engine == 'numpy':
+            self.split_numpy(input_file)
+        else:
+            rows = self.catalog.count(input_file)
+            self.backend.split(input_file, join(self.workspace, self.gdb_copy))
+            self.catalog.invalidate(join(self.workspace, self.gdb_copy))
+            metrics.update(rows_in=rows, rows_out=rows)
 
         self.logger.info('Deleting input broadcast file %s', self.broadcast)
         arcpy.Delete_management(input_file)
+        self.catalog.deleted(input_file)
+        self.finish('split')
+
+    @metrics.measure('month.eez')
+    def filter_eez(self):
+        '''
+        Remove points outside the EEZ from the broadcast file. The points
+        inside are written to a new broadcast file with an '_eez' suffix and
+        the original is deleted. The numpy split engine filters the points
+        in memory while splitting instead.
+        '''
+        if self.split_engine == 'numpy' or not self.begin('eez'):
+            return
+
+        gdb = join(self.workspace, self.gdb_copy)
+        input_file = join(gdb, self.broadcast)
+        output_file = input_file + '_eez'
+        if not self.catalog.exists(input_file):
+            self.logger.info('%s already filtered by EEZ.', self.broadcast)
+            self.finish('eez')
+            return
+        if self.catalog.exists(output_file):
+            arcpy.Delete_management(output_file)
+            self.catalog.deleted(output_file)
+
+        sr = self.catalog.spatial_reference(input_file)
+        if self.memory_budget is None:
+            batches = [self.read_broadcast(input_file)]
+        else:
+            batches = self.memory_budget.sampled(read_batches(
+                input_file, self.catalog.field_types(input_file),
+                self.batch_size(input_file)), 'eez')
 
+        self.logger.info('Writing EEZ points to %s...', output_file)
+        rows = 0
+        created = False
+        for array in self.select_eez(batches):
+            if created:
+                append_array(output_file, array)
+            else:
+                arcpy.da.NumPyArrayToFeatureClass(
+                    array, output_file, ('POINT_X', 'POINT_Y'), sr)
+                created = True
+            rows += len(array)
+        if created:
+            self.catalog.created(output_file, count=rows)
+        metrics.update(rows_in=rows + self.eez_removed['rows'], rows_out=rows)
+
+        self.logger.info('Deleting input broadcast file %s', self.broadcast)
+        arcpy.Delete_management(input_file)
+        self.catalog.deleted(input_file)
+        self.finish('eez', rows=rows)
+
+    def select_eez(self, batches):
+        '''
+        Yield the records of each batch inside the EEZ, and report the number
+        of rows and vessels that were removed once every batch is read.
+        '''
+        rows = 0
+        before = after = np.empty(0, dtype='i8')
+        for array in batches:
+            inside = self.mask.contains(array['POINT_X'], array['POINT_Y'])
+            before = np.union1d(before, array['MMSI'])
+            array = array[inside]
+            after = np.union1d(after, array['MMSI'])
+            rows += len(inside) - len(array)
+            yield array
+        self.eez_removed = {
+            'rows': int(rows),
+            'vessels': int(len(before) - len(after))}
+        msg = 'EEZ filter removed %(rows)d rows and %(vessels)d vessels.'
+        print(msg % self.eez_removed)
+        self.logger.info(msg, self.eez_removed)
+
+    def read_broadcast(self, input_file):
+        '''
+        Read the broadcast file into a record array in OBJECTID batches.
+        '''
+        return split.concatenate_batches(
+            read_batches(input_file, self.catalog.field_types(input_file)))
+
+    def batch_size(self, fc, parts=1):
+        '''
+        Return the rows of a batch read from a feature class, sized from the
+        memory budget and the width of its fields.
+        '''
+        return memory.chunk_rows(
+            self.memory_budget, memory.row_bytes(self.catalog.field_types(fc)),
+            parts, split.BATCH_SIZE)
+
+    def split_numpy(self, input_file):
+        '''
+        Split the broadcast file by MMSI with a single stable sort. Output
+        names match those created by SplitByAttributes. When aggregating
+        to the MMSI store, the slices are appended to the store directly and
+        no per-MMSI feature classes are written.
+
+        If the broadcast file does not fit in the memory budget, it is read
+        in batches into spill files by MMSI, and each spill file is split
+        in turn. A spill file still too large, such as one holding a vessel
+        that reports all month, is split from a memory map.
+        '''
+        gdb = join(self.workspace, self.gdb_copy)
+        sr = self.catalog.spatial_reference(input_file)
+        field_types = self.catalog.field_types(input_file)
+        width = memory.row_bytes(field_types)
+        count = self.catalog.count(input_file)
+        if self.memory_budget is None or self.memory_budget.fits(count, width):
+            array = self.read_broadcast(input_file)
+            metrics.update(rows_in=len(array), bytes_read=array.nbytes)
+            if self.eez_mask:
+                array = list(self.select_eez([array]))[0]
+            metrics.update(rows_out=len(array))
+            self.write_groups(split.sort_by_mmsi(array), gdb, sr)
+            return
+
+        budget = self.memory_budget
+        batches = budget.sampled(
+            read_batches(input_file, field_types, budget.rows(width)), 'split')
+        if self.eez_mask:
+            batches = self.select_eez(batches)
+        rows = memory.split_spilled(
+            batches, budget, count, width,
+            lambda array: self.write_groups(array, gdb, sr),
+            lambda array: self.write_large_groups(array, gdb, sr, budget.rows(width)))
+        metrics.update(rows_in=count, rows_out=rows)
+
+    def write_groups(self, array, gdb, sr):
+        '''
+        Write the vessels of an array sorted by MMSI to their feature
+        classes, or append them to the MMSI store.
+        '''
+        for mmsi, group in split.iter_groups(array):
+            if self.aggregate == 'store':
+                if self.kinematic_fields:
+                    group = kinematics.add_columns(group, kinematics.compute(
+                        group['BaseDateTime'], group['POINT_X'], group['POINT_Y']))
+                self.store.append(mmsi, self.month, group)
+                continue
+            name = arcpy.ValidateTableName(str(mmsi), gdb)
+            out_fc = join(gdb, name)
+            if self.catalog.exists(out_fc):
+                continue
+            arcpy.da.NumPyArrayToFeatureClass(
+                group, out_fc, ('POINT_X', 'POINT_Y'), sr)
+            self.catalog.created(out_fc, count=len(group))
+
+    def write_large_groups(self, array, gdb, sr, size):
+        '''
+        Write the vessels of a memory-mapped spill bucket too large to be
+        read whole, as when one vessel reports all month. Only the sort
+        index is held; each vessel is copied from the memory map in chunks
+        of size rows, in time order.
+        '''
+        for mmsi, index in split.iter_group_index(array):
+            chunks = (
+                array[index[first:first + size]]
+                for first in range(0, len(index), size))
+            if self.aggregate == 'store':
+                if self.kinematic_fields:
+                    self.store_kinematics(mmsi, array, index, chunks)
+                else:
+                    self.store.append(mmsi, self.month, array, index)
+                continue
+            name = arcpy.ValidateTableName(str(mmsi), gdb)
+            out_fc = join(gdb, name)
+            if self.catalog.exists(out_fc):
+                continue
+            arcpy.da.NumPyArrayToFeatureClass(
+                next(chunks), out_fc, ('POINT_X', 'POINT_Y'), sr)
+            for chunk in chunks:
+                append_array(out_fc, chunk)
+            self.catalog.created(out_fc, count=len(index))
+
+    def store_kinematics(self, mmsi, array, index, chunks):
+        '''
+        Append a vessel too large to be read whole to the MMSI store with its
+        kinematic fields. The fields are computed from the time and position
+        columns, and the chunks with the fields added are written to a spill
+        file that the store reads from a memory map.
+        '''
+        columns = kinematics.compute(
+            array['BaseDateTime'][index], array['POINT_X'][index],
+            array['POINT_Y'][index])
+        with self.memory_budget.spill() as spill:
+            first = 0
+            for chunk in chunks:
+                stop = first + len(chunk)
+                spill.add(kinematics.add_columns(chunk, dict(
+                    (name, column[first:stop]) for name, column in columns.items())))
+                first = stop
+            del columns
+            vessel = spill.read(0, mmap=True)
+            self.store.append(mmsi, self.month, vessel)
+            # Release the memory map before the file is removed
+            del vessel
+
+    @metrics.measure('month.add_xy')
     def add_xy(self, fc):
         '''
         Add XY fields to feature class.
         '''
-        fields = [f.name for f in arcpy.ListFields(fc)]
+        metrics.update(mmsi=os.path.basename(fc))
+        fields = self.catalog.fields(fc)
         if 'POINT_X' in fields and 'POINT_Y' in fields:
             self.logger.info('XY fields have already been added to %s...', fc)
             return
 
         self.logger.info('Adding XY fields to to %s...', fc)
-        arcpy.AddXY_management(fc)
+        self.backend.add_xy(fc)
+        self.catalog.changed(fc, [('POINT_X', 'Double'), ('POINT_Y', 'Double')])
+
+    @metrics.measure('month.kinematics')
+    def add_kinematics(self, fc):
+        '''
+        Add the kinematic fields to feature class. The points are read and
+        ordered by time, the fields are computed over whole arrays, and
+        joined back to the feature class by OBJECTID in one call.
+        '''
+        metrics.update(mmsi=os.path.basename(fc))
+        names = [name for name, _, _ in kinematics.FIELDS]
+        if set(names) <= set(self.catalog.fields(fc)):
+            self.logger.info('Kinematic fields have already been added to %s...', fc)
+            return
 
+        self.logger.info('Adding kinematic fields to %s...', fc)
+        array = arcpy.da.FeatureClassToNumPyArray(
+            fc, ['OID@', 'BaseDateTime', 'SHAPE@X', 'SHAPE@Y'])
+        array = array[np.argsort(array['BaseDateTime'], kind='mergesort')]
+        columns = kinematics.compute(
+            array['BaseDateTime'], array['SHAPE@X'], array['SHAPE@Y'])
+        joined = np.empty(
+            len(array),
+            dtype=[('OID_JOIN', 'i4')] + [(n, d) for n, d, _ in kinematics.FIELDS])
+        joined['OID_JOIN'] = array['OID@']
+        for name in names:
+            joined[name] = columns[name]
+
+        oid = [name for name, kind in self.catalog.field_types(fc) if kind == 'OID'][0]
+        arcpy.da.ExtendTable(fc, oid, joined, 'OID_JOIN', False)
+        self.catalog.changed(fc, [(n, t) for n, _, t in kinematics.FIELDS])
+        counts = kinematics.summary(columns)
+        metrics.update(rows_in=len(array), rows_out=len(array))
+        self.logger.info(
+            '%s: %d spikes and %d gaps in %d points.', os.path.basename(fc),
+            counts['spikes'], counts['gaps'], counts['points'])
+
+    @metrics.measure('month.aggregate')
     def aggregate_month_mmsi(self, fc):
         '''
         Add the month shapefile to the MMSI geodatabase. If a file
         doesn't already exist in the MMSI gdb, copy over the month shapefile.
         If a file does exits, append the month shapefile to the existing
         MMSI file. Finally, delete the month shapefile (to prevent duplicate
-        appending).
+        appending). The MMSI file is kept sorted by BaseDateTime, see
+        append_sorted.
+
+        When aggregating to the MMSI store, the month is appended to the
+        vessel's field files instead.
+
+        An append interrupted before the month file was deleted is retried
+        once, after the month's rows have been deleted from the MMSI file.
         '''
-        name_fc = arcpy.Describe(fc).name
-        mmsi_fc = join(self.gdb_mmsi, name_fc)
+        name_fc = self.catalog.name(fc)
+        metrics.update(mmsi=name_fc)
+        attempt = self.begin('aggregate', name_fc)
+        if not attempt:
+            return
 
-        if arcpy.Exists(mmsi_fc):
-            self.logger.info('Appending %s...', name_fc)
-            arcpy.Append_management(fc, mmsi_fc)
+        if self.aggregate == 'store':
+            field_types = self.catalog.field_types(fc)
+            if self.memory_budget is not None and not self.memory_budget.fits(
+                    self.catalog.count(fc), memory.row_bytes(field_types)):
+                rows = self.store_spilled(fc)
+            else:
+                array = read_array(fc, field_types=field_types)
+                rows = len(array)
+                if rows:
+                    self.logger.info('Storing %s...', name_fc)
+                    self.store.append(array['MMSI'][0], self.month, array)
+                    metrics.update(bytes_written=array.nbytes)
         else:
-            self.logger.info('Copying %s...', name_fc)
-            arcpy.Copy_management(fc, mmsi_fc)
+            rows = self.catalog.count(fc)
+            mmsi_fc = join(self.gdb_mmsi, name_fc)
+            self.recover_merge(mmsi_fc)
+            if attempt > 1 and self.catalog.exists(mmsi_fc):
+                self.delete_month_rows(mmsi_fc)
+                self.catalog.changed(mmsi_fc)
+                if self.dedup is not None:
+                    self.dedup.discard(name_fc, self.month)
+            self.append_sorted(fc, mmsi_fc)
+            if self.index_tracks and rows:
+                self.index_month_fc(fc)
 
         self.logger.info('Deleting month file for %s...', name_fc)
         arcpy.Delete_management(fc)
+        self.catalog.deleted(fc)
+        metrics.update(rows_in=rows, rows_out=rows)
+        self.finish('aggregate', name_fc, rows)
+
+    def store_spilled(self, fc):
+        '''
+        Add a month file that does not fit in the memory budget to the MMSI
+        store. It is read in batches into a spill file, which the store sorts
+        and writes from a memory map. Return the number of rows.
+        '''
+        name_fc = self.catalog.name(fc)
+        budget = self.memory_budget
+        with budget.spill() as spill:
+            batches = read_batches(fc, self.catalog.field_types(fc), self.batch_size(fc))
+            for array in budget.sampled(batches, 'aggregate'):
+                spill.add(array)
+            rows = len(spill)
+            if rows:
+                self.logger.info('Storing %s from a spill file...', name_fc)
+                array = spill.read(0, mmap=True)
+                self.store.append(array['MMSI'][0], self.month, array)
+                metrics.update(bytes_written=array.nbytes)
+                # Release the memory map before the file is removed
+                del array
+                budget.sample('aggregate')
+        return rows
+
+    def create_like(self, template, out_fc):
+        '''
+        Create an empty feature class with the fields of a template.
+        '''
+        arcpy.CreateFeatureclass_management(
+            dirname(out_fc), self.catalog.name(out_fc), 'POINT', template,
+            'SAME_AS_TEMPLATE', 'SAME_AS_TEMPLATE',
+            self.catalog.spatial_reference(template))
+        self.catalog.created(out_fc, count=0)
+
+    def append_sorted(self, fc, mmsi_fc):
+        '''
+        Add a month file to a MMSI file so the MMSI file stays sorted by
+        BaseDateTime. If the month's rows are stored in time order and start
+        after the last row of the MMSI file, as when months are processed in
+        order, the month is copied or appended in bulk. Otherwise the month
+        is read in time order once; if it starts after the last row of the
+        MMSI file its rows are inserted at the end, and if not the MMSI file
+        and the month are merged in chunks into a new file that replaces it.
+        Repeated reports are dropped from the month first if deduplicating,
+        so the month is always read then.
+        '''
+        name_fc = self.catalog.name(fc)
+        if self.dedup is None and self.in_time_order(fc, mmsi_fc):
+            if self.catalog.exists(mmsi_fc):
+                self.logger.info('Appending %s...', name_fc)
+                self.backend.append(fc, mmsi_fc)
+                self.catalog.changed(mmsi_fc)
+            else:
+                self.logger.info('Copying %s...', name_fc)
+                self.backend.append(fc, mmsi_fc)
+                self.catalog.created(mmsi_fc)
+            return
+
+        fields = [
+            name for name, kind in self.catalog.field_types(fc)
+            if kind not in ('OID', 'Geometry')] + ['SHAPE@XY']
+        month = read_sorted(fc, fields, chunk_size=self.cursor_size(fields))
+        if self.memory_budget is not None:
+            month = self.memory_budget.sampled(month, 'aggregate')
+        if self.dedup is not None:
+            month = self.drop_repeated(name_fc, fields, month)
+
+        if not self.catalog.exists(mmsi_fc):
+            self.logger.info('Copying %s...', name_fc)
+            self.create_like(fc, mmsi_fc)
+            insert_rows(mmsi_fc, fields, month)
+        else:
+            self.merge_sorted(fc, mmsi_fc, fields, month)
+        self.catalog.changed(mmsi_fc)
+        if self.dedup is not None:
+            self.dedup.commit(name_fc, self.month)
+
+    def in_time_order(self, fc, mmsi_fc):
+        '''
+        Return True if the rows of a month file are stored in time order and
+        start at or after the last row of the MMSI file, so appending them
+        keeps the MMSI file sorted.
+        '''
+        times = read_times(fc)
+        if not merge.is_sorted(times):
+            return False
+        if not len(times) or not self.catalog.exists(mmsi_fc):
+            return True
+        last = time_bound(mmsi_fc, last=True)
+        return last is None or times[0] >= np.datetime64(last, 'us')
+
+    def merge_sorted(self, fc, mmsi_fc, fields, month):
+        '''
+        Add a time-sorted run of month rows to an existing MMSI file, see
+        append_sorted.
+        '''
+        name_fc = self.catalog.name(fc)
+        first, last = time_bound(fc), time_bound(mmsi_fc, last=True)
+        if first is None or last is None or first >= last:
+            self.logger.info('Appending %s...', name_fc)
+            insert_rows(mmsi_fc, fields, month)
+        else:
+            self.logger.info('Merging %s into earlier and later months...', name_fc)
+            temp_fc = mmsi_fc + '_merge'
+            self.create_like(mmsi_fc, temp_fc)
+            stored = read_sorted(mmsi_fc, fields, chunk_size=self.cursor_size(fields))
+            runs = [stored, month]
+            insert_rows(temp_fc, fields, merge.merge_runs(runs))
+            arcpy.Delete_management(mmsi_fc)
+            self.catalog.deleted(mmsi_fc)
+            arcpy.Rename_management(temp_fc, mmsi_fc)
+            self.catalog.deleted(temp_fc)
+            self.catalog.created(mmsi_fc)
+
+    def cursor_size(self, fields):
+        '''
+        Return the rows of a chunk of cursor rows when merging, sized from
+        the memory budget: a chunk of each run and of the output are held.
+        '''
+        return memory.chunk_rows(
+            self.memory_budget, memory.tuple_bytes(len(fields)), 3, merge.CHUNK_SIZE)
+
+    def drop_repeated(self, mmsi, fields, chunks):
+        '''
+        Drop repeated reports from a run of (times, rows) cursor chunks.
+        '''
+        for times, rows in chunks:
+            values = list(zip(*rows))
+            columns = dict(
+                (name, values[fields.index(name)])
+                for name in dedup.KEY_FIELDS if name in fields)
+            if 'POINT_X' not in columns:
+                xy = values[fields.index('SHAPE@XY')]
+                columns['POINT_X'] = [point[0] for point in xy]
+                columns['POINT_Y'] = [point[1] for point in xy]
+            keep = self.dedup.filter(mmsi, self.month, columns)
+            yield times[keep], [row for row, new in zip(rows, keep) if new]
+
+    def recover_merge(self, mmsi_fc):
+        '''
+        Finish or undo a merge into a MMSI file that was interrupted.
+        '''
+        temp_fc = mmsi_fc + '_merge'
+        if not self.catalog.exists(temp_fc):
+            return
+        if self.catalog.exists(mmsi_fc):
+            arcpy.Delete_management(temp_fc)
+        else:
+            self.logger.info('Restoring %s from an interrupted merge...', mmsi_fc)
+            arcpy.Rename_management(temp_fc, mmsi_fc)
+            self.catalog.created(mmsi_fc)
+        self.catalog.deleted(temp_fc)
+
+    def index_month_fc(self, fc):
+        '''
+        Add the month of a vessel to the track index. Rows of the MMSI gdb
+        cannot be addressed, so no row ranges are recorded.
+        '''
+        array = arcpy.da.FeatureClassToNumPyArray(
+            fc, ['MMSI', 'BaseDateTime', 'SHAPE@X', 'SHAPE@Y'])
+        self.track_index.add(
+            array['MMSI'][0], self.month, array['BaseDateTime'],
+            array['SHAPE@X'], array['SHAPE@Y'])
+
+    def delete_month_rows(self, mmsi_fc):
+        '''
+        Delete the rows of this month from a MMSI file.
+        '''
+        start = datetime(int(self.year), int(self.month), 1)
+        if start.month == 12:
+            end = datetime(start.year + 1, 1, 1)
+        else:
+            end = datetime(start.year, start.month + 1, 1)
+        where = "BaseDateTime >= date '%s' AND BaseDateTime < date '%s'" % (start, end)
+        self.logger.info('Deleting rows of %s from %s...', self.month, mmsi_fc)
+        with arcpy.da.UpdateCursor(mmsi_fc, ['OID@'], where) as cursor:
+            for row in cursor:
+                cursor.deleteRow()
 
 
 class Raw_MMSI(object):
 
     '''
     Process monthly MMSI files.
+
+    The EEZ engine is either 'arcpy', which selects points by location
+    against the EEZ polygon, or 'mask', which looks up POINT_X and POINT_Y
+    in a tiled EEZ mask (see ais_arcpy.eez) built once by make_eez_us.
+
+    The source is either 'gdb', the MMSI geodatabase, or 'store', the
+    columnar MMSI store. The store is always filtered with the EEZ mask.
+
+    If a manifest (see ais_arcpy.manifest) is given, the EEZ selection and
+    csv export of each MMSI are recorded in it, so a re-run only processes
+    the vessels that were not completed.
+
+    CSV files are written by export_threads threads (see ais_arcpy.export),
+    and compressed if compression is 'gzip' or 'lzma'. The output is either
+    'csv', one file per MMSI, or 'partitioned', one file per month with an
+    index of the rows of each MMSI (see ais_arcpy.partition).
+
+    If a simplifier (see ais_arcpy.simplify) is given, each vessel's EEZ
+    points are simplified before they are written, and the compression
+    ratio of each vessel is logged.
+
+    If kinematic_fields is True, the kinematic fields added by Raw_Month are
+    written with the other fields.
+
+    If a memory budget (see ais_arcpy.memory) is given, the exporter holds
+    one pending file per thread, and a vessel too large to be held with
+    them is selected and written in chunks of rows sized from the budget.
+    The peak memory of each stage is logged.
+
+    The arcpy EEZ selection and the reads of each vessel's feature class run
+    through a backend (see ais_arcpy.backend), an ArcpyBackend unless
+    another is given.
     '''
 
-    def __init__(self, directory, zone, year):
+    def __init__(self, directory, zone, year, eez_engine='arcpy', source='gdb',
+                 cache=None, manifest=None, export_threads=export.THREADS,
+                 compression=None, output='csv', simplifier=None,
+                 kinematic_fields=False, memory_budget=None, backend=None):
         '''
         Create instance of raw data for a given year, month, and zone.
         '''
         self.root = directory
         self.year = year
         self.zone = zone
+        self.eez_engine = eez_engine
+        self.source = source
+        self.cache = cache
+        self.manifest = manifest
+        self.catalog = catalog.Catalog()
+        self.export_threads = export_threads
+        self.compression = compression
+        self.output = output
+        self.simplifier = simplifier
+        self.memory_budget = memory_budget
+        self.backend = backend or backends.ArcpyBackend()
+        self.exporter = None
+        self._mask = None
 
         # Arcpy parameters
         self.workspace = join(self.root, self.year, 'MMSI')
@@ -209,6 +1098,7 @@ class Raw_MMSI(object):
 
         # MMSI gdb
         self.gdb_mmsi = 'Zone%s_%s_MMSI.gdb' % (self.zone, self.year)
+        self.store_mmsi = 'Zone%s_%s_MMSI.store' % (self.zone, self.year)
 
         # Fields
         self.fields = [
@@ -223,10 +1113,13 @@ class Raw_MMSI(object):
             'ReceiverType',
             'POINT_X',
             'POINT_Y']
+        if kinematic_fields:
+            self.fields.extend(name for name, _, _ in kinematics.FIELDS)
 
         # EEZ shapefile
         self.eez_world = join(self.root, 'World EEZ', 'eez_v10.shp')
         self.eez = join(self.root, 'World EEZ', 'eez_us.shp')
+        self.eez_mask = join(self.root, 'World EEZ', 'eez_us_mask.npz')
 
         # Logger
         self.logger = logging.getLogger()
@@ -236,53 +1129,170 @@ class Raw_MMSI(object):
         '''
         Select only EEZ points and write to csv.
         '''
+        if not self.begin('mmsi'):
+            self.logger.info('Zone %s %s already processed.', self.zone, self.year)
+            return
+
         self.download_eez()
         self.make_eez_us()
 
-        arcpy.env.workspace = join(self.workspace, self.gdb_mmsi)
-        featureClasses = arcpy.ListFeatureClasses()
+        if self.source == 'store':
+            self.exporter = self.make_exporter()
+            for mmsi in self.store.vessels():
+                self.store_to_csv(mmsi)
+            self.exporter.close()
+            self.exporter = None
+            self.report()
+            self.finish('mmsi')
+            return
+
+        gdb = join(self.workspace, self.gdb_mmsi)
+        arcpy.env.workspace = gdb
+        featureClasses = self.catalog.list(gdb)
         for fc in featureClasses:
-            name = arcpy.Describe(fc).name
+            name = self.catalog.name(fc)
             if '_eez' in name:
                 continue
             self.select_eez(fc)
-        featureClasses = arcpy.ListFeatureClasses()
+        featureClasses = sorted(self.catalog.list(gdb), key=partition.mmsi_key)
+        self.exporter = self.make_exporter()
         for fc in featureClasses:
             self.to_csv(fc)
+        self.exporter.close()
+        self.exporter = None
+        self.report()
+        self.catalog.report()
+        self.finish('mmsi')
+
+    def report(self):
+        '''
+        Log the simplification and memory use of the run.
+        '''
+        if self.simplifier is not None:
+            self.simplifier.report()
+        if self.memory_budget is not None:
+            self.memory_budget.report()
+
+    def make_exporter(self):
+        '''
+        Return the csv exporter or the partition writer for the output.
+        '''
+        if self.output == 'partitioned':
+            return partition.PartitionWriter(
+                join(self.root, self.year), self.zone, self.fields,
+                self.compression)
+        pending = self.export_threads if self.memory_budget is not None else None
+        return export.Exporter(self.export_threads, self.compression, pending)
+
+    def export_size(self):
+        '''
+        Return the most rows of a vessel that are written as one file, with
+        a file pending on each export thread, or None without a memory
+        budget.
+        '''
+        return memory.chunk_rows(
+            self.memory_budget, memory.tuple_bytes(len(self.fields)),
+            max(self.export_threads, 1) + 1)
+
+    def begin(self, stage, mmsi=''):
+        '''
+        Start a zone-year unit of work in the manifest and return the attempt
+        number, or 0 if the unit is done and should be skipped.
+
+        :raises unitFailed: The unit failed its last attempt, so a vessel
+            whose EEZ selection failed is never exported unfiltered
+        '''
+        if self.manifest is None:
+            return 1
+        return self.manifest.begin(self.zone, self.year, '', mmsi, stage)
+
+    def finish(self, stage, mmsi='', rows=None):
+        '''
+        Record a completed zone-year unit of work in the manifest.
+        '''
+        if self.manifest is not None:
+            self.manifest.finish(self.zone, self.year, '', mmsi, stage, rows)
 
     def download_eez(self):
         '''
-        Download World EEZ and extract US EEZ.
+        Download World EEZ and extract US EEZ. The World EEZ zip is kept in
+        the download cache if one is given, so it is only downloaded once.
         '''
-        folder = files.create_folder(self.root, 'World EEZ')
+        folder = util.create_folder(self.root, 'World EEZ')
         url = 'http://www.marineregions.org/download_file.php?name=World_EEZ_v10_20180221.zip'
-        if not exists(join(folder, self.eez_world)):
+        if exists(self.eez_world):
+            return
+
+        tempfile = self.cache.get(url) if self.cache is not None else None
+        if tempfile is None:
             text = u'Please download the World EEZ file'
-            result = user.message_box_OK_Cancel(text, text)
+            result = util.message_box_OK_Cancel(text, text)
             if result == 2:
                 return
             if result == 1:
                 webbrowser.open(url)
                 title = u'Extract US EEZ'
                 msg = u'Select \'OK\' to extract files to %s.' % folder
-                result1 = user.message_box_OK_Cancel(title, msg)
+                result1 = util.message_box_OK_Cancel(title, msg)
                 if result1 == 2:
                     return
 
-        downloads = join(expanduser("~"), 'Downloads')
-        tempfile = files.find_file(downloads, 'World_EEZ')
+            downloads = join(expanduser("~"), 'Downloads')
+            tempfile = util.find_file(downloads, 'World_EEZ')
+            if self.cache is not None:
+                tempfile = self.cache.put(url, tempfile)
+
         self.logger.info('Extracting files from %s:', tempfile)
-        files.extract_zip(tempfile, folder)
-        os.remove(tempfile)
+        util.extract_zip(tempfile, folder)
+        if self.cache is None:
+            os.remove(tempfile)
+
+    @property
+    def store(self):
+        '''
+        Return the columnar MMSI store for the zone and year.
+        '''
+        return store.MMSIStore(join(self.workspace, self.store_mmsi))
+
+    def read_track(self, mmsi):
+        '''
+        Return a vessel's points from the MMSI gdb or store as a compact
+        track (see ais_arcpy.track). In the gdb the feature class is named
+        as split_numpy and SplitByAttributes name it, and its EEZ selection
+        is read once select_eez has made it.
+        '''
+        if self.source == 'store':
+            return track.Track.from_columns(self.store.read(mmsi, self.fields), self.fields)
+        gdb = join(self.workspace, self.gdb_mmsi)
+        fc = join(gdb, arcpy.ValidateTableName(str(mmsi), gdb))
+        if self.catalog.exists(fc + '_eez'):
+            fc += '_eez'
+        elif not self.catalog.exists(fc):
+            raise ValueError('MMSI %s is not in %s.' % (mmsi, gdb))
+        return track.Track.from_cursor(fc, self.fields)
+
+    @property
+    def mask(self):
+        '''
+        Return the tiled US EEZ mask, loading it on first use.
+        '''
+        if self._mask is None:
+            self._mask = eez.EEZMask.load(self.eez_mask)
+        return self._mask
 
     def make_eez_us(self):
         '''
-        Select the US EEZ from the World EEZself.
+        Select the US EEZ from the World EEZ and build the EEZ mask.
         '''
         arcpy.env.workspace = join(self.root, 'World EEZ')
-        if arcpy.Exists(self.eez):
-            return
+        if not arcpy.Exists(self.eez):
+            self.copy_eez_us()
+        self.make_eez_mask()
 
+    def copy_eez_us(self):
+        '''
+        Select the US EEZ from the World EEZ and save it to disk.
+        '''
         name_world = arcpy.Describe(self.eez_world).name
         name_lyr = name_world + '_lyr'
         name_us = 'eez_us'
@@ -299,49 +1309,305 @@ class Raw_MMSI(object):
         self.logger.info('Saving the in_memory layer to disk.')
         arcpy.CopyFeatures_management(name_lyr, name_us)
 
+    @metrics.measure('mmsi.eez_mask')
+    def make_eez_mask(self):
+        '''
+        Build the tiled US EEZ mask from the polygon rings and cache it to
+        disk next to the shapefile.
+        '''
+        if exists(self.eez_mask):
+            return
+
+        self.logger.info('Building EEZ mask %s...', self.eez_mask)
+        rings = []
+        with arcpy.da.SearchCursor(self.eez, ['SHAPE@']) as cursor:
+            for row in cursor:
+                for part in row[0]:
+                    # Interior rings are separated by None
+                    ring = []
+                    for pnt in part:
+                        if pnt is None:
+                            rings.append(ring)
+                            ring = []
+                        else:
+                            ring.append((pnt.X, pnt.Y))
+                    rings.append(ring)
+        eez.EEZMask.build(rings).save(self.eez_mask)
+
+    @metrics.measure('mmsi.eez')
     def select_eez(self, fc):
         '''
         Select only points in EEZ.
         '''
-        name_mmsi = arcpy.Describe(fc).name
-        name_lyr = name_mmsi + "_lyr"
+        name_mmsi = self.catalog.name(fc)
+        metrics.update(mmsi=name_mmsi)
         name_eez = name_mmsi + "_eez"
 
-        if arcpy.Exists(name_eez):
+        attempt = self.begin('eez', name_mmsi)
+        if not attempt:
+            return
+        exists_mmsi = self.catalog.exists(name_mmsi)
+        if attempt > 1 and self.catalog.exists(name_eez) and exists_mmsi:
+            self.logger.info('Deleting partial EEZ selection %s', name_eez)
+            arcpy.Delete_management(name_eez)
+            self.catalog.deleted(name_eez)
+        if self.catalog.exists(name_eez):
+            self.finish('eez', name_mmsi)
             return
 
-        # Make in_memory temporary layer
-        self.logger.info('Creating an in_memory layer for %s...', name_lyr)
-        arcpy.MakeFeatureLayer_management(name_mmsi, name_lyr)
+        if self.eez_engine == 'mask':
+            self.select_eez_mask(name_mmsi, name_eez)
+            self.logger.info('Deleting original shapefile %s', name_mmsi)
+            arcpy.Delete_management(name_mmsi)
+            self.catalog.deleted(name_mmsi)
+            self.finish('eez', name_mmsi)
+            return
 
-        # Select features that are inside US EEZ
+        # Select features that are inside US EEZ, saved if there are more
+        # than two
         self.logger.info('Selecting by location within EEZ...')
-        arcpy.SelectLayerByLocation_management(name_lyr, 'within', self.eez)
-
-        # If there are more than zero features, save the layer
-        if arcpy.GetCount_management(name_lyr) > 2:
-            self.logger.info('Saving the in_memory layer to disk.')
-            arcpy.CopyFeatures_management(name_lyr, name_eez)
-
-        # Delete in_memory temporary file
-        self.logger.info('Deleting in_memory layer %s', name_lyr)
-        arcpy.Delete_management(name_lyr)
+        count = self.backend.select_within(name_mmsi, self.eez, name_eez, minimum=3)
+        if count > 2:
+            self.logger.info('Saved %d points to %s.', count, name_eez)
+            self.catalog.created(name_eez, count=count)
         # Delete original file
         self.logger.info('Deleting original shapefile %s', name_mmsi)
         arcpy.Delete_management(name_mmsi)
+        self.catalog.deleted(name_mmsi)
+        self.finish('eez', name_mmsi)
 
+    def select_eez_mask(self, name_mmsi, name_eez):
+        '''
+        Select only points in EEZ with the EEZ mask.
+        '''
+        self.logger.info('Selecting %s with the EEZ mask...', name_mmsi)
+        sr = self.catalog.spatial_reference(name_mmsi)
+        field_types = self.catalog.field_types(name_mmsi)
+        budget = self.memory_budget
+        if budget is not None and not budget.fits(
+                self.catalog.count(name_mmsi), memory.row_bytes(field_types)):
+            self.select_eez_chunks(name_mmsi, name_eez)
+            return
+
+        array = read_array(name_mmsi, field_types=field_types)
+        metrics.update(rows_in=len(array), bytes_read=array.nbytes)
+        array = array[self.mask.contains(array['POINT_X'], array['POINT_Y'])]
+        metrics.update(rows_out=len(array))
+        if len(array) > 2:
+            self.logger.info('Saving %d points to %s.', len(array), name_eez)
+            arcpy.da.NumPyArrayToFeatureClass(
+                array, name_eez, ('POINT_X', 'POINT_Y'), sr)
+            self.catalog.created(name_eez, count=len(array))
+
+    def select_eez_chunks(self, name_mmsi, name_eez):
+        '''
+        Select the EEZ points of a vessel that does not fit in the memory
+        budget, in batches of rows. Nothing is written until more than two
+        points have been selected.
+        '''
+        sr = self.catalog.spatial_reference(name_mmsi)
+        field_types = self.catalog.field_types(name_mmsi)
+        size = self.memory_budget.rows(memory.row_bytes(field_types))
+        batches = self.memory_budget.sampled(
+            read_batches(name_mmsi, field_types, size), 'eez')
+
+        pending = []
+        held = rows = 0
+        created = False
+        for array in batches:
+            metrics.update(rows_in=len(array), bytes_read=array.nbytes)
+            array = array[self.mask.contains(array['POINT_X'], array['POINT_Y'])]
+            metrics.update(rows_out=len(array))
+            pending.append(array)
+            held += len(array)
+            if not created and held <= 2:
+                continue
+            array = np.concatenate(pending)
+            pending = []
+            held = 0
+            if created:
+                append_array(name_eez, array)
+            else:
+                arcpy.da.NumPyArrayToFeatureClass(
+                    array, name_eez, ('POINT_X', 'POINT_Y'), sr)
+                created = True
+            rows += len(array)
+        if created:
+            self.logger.info('Saved %d points to %s.', rows, name_eez)
+            self.catalog.created(name_eez, count=rows)
+
+    @metrics.measure('mmsi.csv')
+    def store_to_csv(self, mmsi):
+        '''
+        Select a vessel's EEZ points from the MMSI store with the EEZ mask
+        and write them to csv. Partitioned output is recorded in the manifest
+        for the whole zone and year only.
+        '''
+        partitioned = self.output == 'partitioned'
+        file_out = export.output_path(
+            join(self.root, self.year, '%s_eez.csv' % mmsi), self.compression)
+        metrics.update(mmsi=mmsi)
+        if not partitioned:
+            attempt = self.begin('csv', mmsi)
+            if attempt > 1 and exists(file_out):
+                os.remove(file_out)
+            if not attempt or exists(file_out):
+                return
+
+        columns = self.store.read(mmsi, self.fields)
+        size = self.export_size()
+        if size is None:
+            inside = self.mask.contains(columns['POINT_X'], columns['POINT_Y'])
+        else:
+            x, y = columns['POINT_X'], columns['POINT_Y']
+            inside = np.zeros(len(x), dtype=bool)
+            for start in range(0, len(x), size):
+                inside[start:start + size] = self.mask.contains(
+                    x[start:start + size], y[start:start + size])
+        metrics.update(
+            rows_in=len(inside),
+            bytes_read=sum(column.nbytes for column in columns.values()))
+        if inside.sum() <= 2:
+            if not partitioned:
+                self.finish('csv', mmsi, 0)
+            return
+
+        self.logger.info('Writing %d EEZ points for %s...', inside.sum(), mmsi)
+        if size is not None and inside.sum() > size:
+            chunks = self.store_chunks(mmsi, columns, np.flatnonzero(inside), size)
+            if partitioned:
+                for rows in chunks:
+                    self.exporter.write(rows)
+            else:
+                self.stream_csv(file_out, chunks, mmsi)
+            return
+
+        selected = dict((name, columns[name][inside]) for name in self.fields)
+        if self.simplifier is not None:
+            keep = self.simplifier.simplify(mmsi, selected)
+            selected = dict((name, column[keep]) for name, column in selected.items())
+        rows = export.column_rows(selected, self.fields)
+        metrics.update(rows_out=len(rows))
+        if partitioned:
+            self.exporter.write(rows)
+        else:
+            self.write_csv(file_out, rows, mmsi)
+
+    def store_chunks(self, mmsi, columns, index, size):
+        '''
+        Yield the rows of a vessel's selected store rows in chunks of size
+        rows, after simplifying them if there is a simplifier.
+        '''
+        if self.simplifier is not None:
+            keep = self.simplifier.simplify(
+                mmsi, dict((name, columns[name][index]) for name in simplify.FIELDS))
+            index = index[keep]
+        metrics.update(rows_out=len(index))
+        for start in range(0, len(index), size):
+            part = index[start:start + size]
+            yield export.column_rows(
+                dict((name, columns[name][part]) for name in self.fields),
+                self.fields)
+            self.memory_budget.sample('export')
+
+    @metrics.measure('mmsi.csv')
     def to_csv(self, fc):
         '''
-        Write shapefile to csv.
+        Write shapefile to csv. A vessel too large for the memory budget is
+        read and written in chunks of rows.
         '''
         path = join(self.root, self.year)
-        name_mmsi = arcpy.Describe(fc).name
+        name_mmsi = self.catalog.name(fc)
         name_csv = name_mmsi + '.csv'
-        file_out = join(path, name_csv)
-        if not exists(file_out):
-            with open(file_out, 'wb') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow(self.fields)
-                with arcpy.da.SearchCursor(fc, self.fields) as cursor:
-                    for row in cursor:
-                        writer.writerow(row)
+        file_out = export.output_path(join(path, name_csv), self.compression)
+        metrics.update(mmsi=name_mmsi)
+        partitioned = self.output == 'partitioned'
+        if not partitioned:
+            attempt = self.begin('csv', name_mmsi)
+            if attempt > 1 and exists(file_out):
+                os.remove(file_out)
+            if not attempt or exists(file_out):
+                return
+
+        size = self.export_size()
+        if size is not None and self.catalog.count(fc) > size:
+            chunks = self.cursor_chunks(fc, name_mmsi, size)
+            if partitioned:
+                for rows in chunks:
+                    self.exporter.write(rows)
+            else:
+                self.stream_csv(file_out, chunks, name_mmsi)
+            return
+
+        rows = list(self.backend.cursor(fc, self.fields))
+        metrics.update(rows_in=len(rows))
+        rows = self.simplify_rows(name_mmsi, rows)
+        metrics.update(rows_out=len(rows))
+        if partitioned:
+            self.exporter.write(rows)
+        else:
+            self.write_csv(file_out, rows, name_mmsi)
+
+    def cursor_chunks(self, fc, name_mmsi, size):
+        '''
+        Yield the rows of a vessel in time order in chunks of size rows. If
+        there is a simplifier, the fields it needs are read first as arrays
+        to choose the OBJECTIDs of the points to keep.
+        '''
+        fields = list(self.fields)
+        keep = None
+        if self.simplifier is not None:
+            array = arcpy.da.FeatureClassToNumPyArray(
+                fc, ['OID@'] + list(simplify.FIELDS), null_value={'SOG': np.nan})
+            keep = np.sort(array['OID@'][self.simplifier.simplify(name_mmsi, array)])
+            del array
+            fields.append('OID@')
+        for _, rows in read_sorted(fc, fields, chunk_size=size):
+            metrics.update(rows_in=len(rows))
+            if keep is not None:
+                oids = np.array([row[-1] for row in rows])
+                found = keep[np.searchsorted(keep, oids).clip(0, max(len(keep) - 1, 0))]
+                rows = [row[:-1] for row, new in zip(rows, found == oids) if new]
+            metrics.update(rows_out=len(rows))
+            yield rows
+            self.memory_budget.sample('export')
+
+    def simplify_rows(self, mmsi, rows):
+        '''
+        Return the cursor rows of a vessel kept by the simplifier, in time
+        order, or the rows unchanged if there is no simplifier.
+        '''
+        if self.simplifier is None or not rows:
+            return rows
+        points = track.Track.from_rows(rows, self.fields)
+        keep = self.simplifier.simplify(mmsi, points.columns)
+        return [rows[i] for i in keep]
+
+    def write_csv(self, file_out, rows, mmsi):
+        '''
+        Write the rows of a vessel to csv with the exporter, or directly
+        if no export is running. The csv unit is recorded in the manifest
+        once the file is complete.
+        '''
+        record = metrics.current()
+
+        def done(count, size):
+            metrics.update(record=record, bytes_written=size)
+            self.finish('csv', mmsi, count)
+
+        exporter = self.exporter or export.Exporter(1, self.compression)
+        exporter.write(file_out, self.fields, rows, done)
+
+    def stream_csv(self, file_out, chunks, mmsi):
+        '''
+        Write chunks of rows of a vessel to csv on the calling thread. The
+        csv unit is recorded in the manifest once the file is complete.
+        '''
+        record = metrics.current()
+
+        def done(count, size):
+            metrics.update(record=record, bytes_written=size)
+            self.finish('csv', mmsi, count)
+
+        exporter = self.exporter or export.Exporter(1, self.compression)
+        exporter.stream(file_out, self.fields, chunks, done)
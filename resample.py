@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.resample
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: vectorized resampling of vessel tracks to a regular time grid
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import multiprocessing
+import os
+from os.path import basename, join
+import threading
+import time
+
+import numpy as np
+
+from . import export
+from . import kinematics
+from . import partition
+from . import track
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+# Seconds between points of the grid
+INTERVAL = 60
+# Seconds between reports above which the track is not interpolated
+MAX_GAP = kinematics.MAX_GAP
+
+# Fields written, in the order of Raw_MMSI
+FIELDS = ('SOG', 'COG', 'Heading', 'BaseDateTime', 'MMSI', 'POINT_X', 'POINT_Y')
+# Fields interpolated as straight lines, and as angles in degrees
+LINEAR_FIELDS = ('POINT_X', 'POINT_Y', 'SOG')
+ANGLE_FIELDS = ('COG', 'Heading')
+# Decimals kept of interpolated speeds and angles
+DECIMALS = 2
+
+SUFFIX = '_eez.csv'
+ENDINGS = tuple(SUFFIX + extension for extension in export.EXTENSIONS.values())
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def grid_points(seconds, interval = INTERVAL, max_gap = MAX_GAP):
+    '''
+    Return the times of a regular grid over a time-ordered track, with the
+    position of the report at or before each time and the weight of the
+    report after it. The grid is aligned to multiples of interval since the
+    epoch, so every vessel is sampled at the same times. Times inside a gap
+    of more than max_gap seconds between reports are left out.
+
+    :param seconds: Time of each report in seconds, sorted and unique
+    :param interval: Seconds between grid times
+    :param max_gap: Longest gap interpolated across in seconds
+
+    :type seconds: numpy.ndarray
+    :type interval: int
+    :type max_gap: float
+
+    :return: Grid times, positions of the reports before, and weights
+    :rtype: tuple of numpy.ndarrays
+    '''
+    if not len(seconds):
+        return np.empty(0, dtype='i8'), np.empty(0, dtype='i8'), np.empty(0)
+    first = -(-int(seconds[0]) // interval) * interval
+    times = np.arange(first, int(seconds[-1]) + 1, interval, dtype='i8')
+
+    before = np.searchsorted(seconds, times, side='right') - 1
+    after = np.minimum(before + 1, len(seconds) - 1)
+    span = seconds[after] - seconds[before]
+    offset = times - seconds[before]
+    exact = offset == 0
+    keep = exact | ((span > 0) & (span <= max_gap))
+
+    weight = np.zeros(len(times))
+    inside = keep & ~exact
+    weight[inside] = offset[inside] / span[inside].astype('f8')
+    return times[keep], before[keep], weight[keep]
+
+def interpolate(values, before, weight):
+    '''
+    Return values interpolated along straight lines between the reports
+    before and after each grid time. A value next to a null is null unless
+    the grid time falls on a report.
+    '''
+    values = np.asarray(values, dtype='f8')
+    start = values[before]
+    moved = weight > 0
+    out = start.copy()
+    out[moved] = start[moved] + weight[moved] * (
+        values[before[moved] + 1] - start[moved])
+    return out
+
+def interpolate_angle(values, before, weight):
+    '''
+    Return angles in degrees interpolated along the shorter arc between the
+    reports before and after each grid time, in [0, 360). Values outside
+    [0, 360), such as the Heading of 511 sent when it is not available, are
+    treated as null.
+    '''
+    values = np.asarray(values, dtype='f8')
+    with np.errstate(invalid='ignore'):
+        values = np.where((values >= 0) & (values < 360), values, np.nan)
+    start = values[before]
+    moved = weight > 0
+    out = start.copy()
+    turn = (values[before[moved] + 1] - start[moved] + 180) % 360 - 180
+    out[moved] = (start[moved] + weight[moved] * turn) % 360
+    return out
+
+def file_mmsi(filepath):
+    '''
+    Return the MMSI of a per-vessel csv file written by Raw_MMSI, read from
+    the digits of its name as partition.mmsi_key reads them, so names given
+    a letter prefix by ValidateTableName are matched. Returns None if the
+    file is not a vessel csv.
+    '''
+    name = basename(filepath)
+    if not name.endswith(ENDINGS):
+        return None
+    ending = [e for e in ENDINGS if name.endswith(e)][0]
+    return partition.mmsi_digits(name[:-len(ending)]) or None
+
+def vessel_files(directory):
+    '''
+    Return the per-vessel csv files written by Raw_MMSI to a folder, plain
+    or compressed, in MMSI order.
+    '''
+    names = [
+        name for name in os.listdir(directory)
+        if file_mmsi(name) is not None]
+    return [join(directory, name) for name in sorted(names, key=partition.mmsi_key)]
+
+def to_rows(columns):
+    '''
+    Return resampled columns as rows in the layout read by SearchCursor,
+    with BaseDateTime as datetime and nulls as None.
+    '''
+    columns = dict(columns)
+    columns['BaseDateTime'] = columns['BaseDateTime'].view('M8[s]')
+    for name in LINEAR_FIELDS + ANGLE_FIELDS:
+        null = np.isnan(columns[name])
+        if null.any():
+            columns[name] = np.where(null, None, columns[name])
+    return export.column_rows(columns, FIELDS)
+
+def resample_file(task):
+    '''
+    Read, resample, and write the track of one vessel. Runs in a worker
+    process.
+
+    :param task: Input path, output path or None, resampler, and compression
+    :type task: tuple
+
+    :return: MMSI, points in and out, and the resampled rows if no output
+        path was given, else the bytes written
+    :rtype: tuple
+    '''
+    filepath, output, resampler, compression = task
+    points = track.Track.from_csv(filepath, FIELDS)
+    mmsi = points.mmsi
+    if mmsi is None:
+        mmsi = file_mmsi(filepath)
+    resampled = resampler.resample(mmsi, points.columns)
+    rows = to_rows(resampled)
+    if output is None:
+        return mmsi, len(points), len(rows), rows
+    _, size = export.write_csv(output, list(FIELDS), rows, compression)
+    return mmsi, len(points), len(rows), size
+
+
+# ------------------------------------------------------------------------------
+# RESAMPLER
+# ------------------------------------------------------------------------------
+class Resampler(object):
+
+    '''
+    Resample vessel tracks to a regular time grid of interval seconds.
+    POINT_X, POINT_Y, and SOG are interpolated along straight lines between
+    the reports around each grid time, and COG and Heading along the
+    shorter arc between their angles. Grid times inside a gap of more than
+    max_gap seconds between reports are left out, so a vessel that goes
+    silent is not drawn across the gap. Each track is resampled in a few
+    passes over whole arrays.
+
+    The points in and out of each vessel are kept in vessels, and report
+    logs the totals of the run.
+    '''
+
+    def __init__(self, interval = INTERVAL, max_gap = MAX_GAP):
+        if interval <= 0:
+            raise ValueError('Resample interval must be positive.')
+        self.interval = int(interval)
+        self.max_gap = max_gap
+        self.vessels = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Workers return their counts to the calling process
+        return {'interval': self.interval, 'max_gap': self.max_gap}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def resample(self, mmsi, columns):
+        '''
+        Return the columns of a vessel's track on the grid.
+
+        :param mmsi: Vessel identifier
+        :param columns: Dictionary with BaseDateTime, as datetime64 or
+            seconds, POINT_X, POINT_Y, SOG, COG, and Heading columns
+
+        :type mmsi: int or string
+        :type columns: dict
+
+        :return: Dictionary of the FIELDS columns, with BaseDateTime as
+            int64 seconds since the epoch
+        :rtype: dict
+        '''
+        seconds = kinematics.to_seconds(columns['BaseDateTime'])
+        order = np.argsort(seconds, kind='mergesort')
+        seconds = seconds[order]
+        # The first report of each time
+        unique = np.ones(len(seconds), dtype=bool)
+        unique[1:] = seconds[1:] != seconds[:-1]
+        order = order[unique]
+        seconds = seconds[unique]
+
+        times, before, weight = grid_points(seconds, self.interval, self.max_gap)
+        resampled = {
+            'BaseDateTime': times,
+            'MMSI': np.full(len(times), int(mmsi), dtype='i4')}
+        for name in LINEAR_FIELDS:
+            resampled[name] = interpolate(
+                np.asarray(columns[name])[order], before, weight)
+        for name in ANGLE_FIELDS:
+            resampled[name] = interpolate_angle(
+                np.asarray(columns[name])[order], before, weight)
+        for name in ('SOG',) + ANGLE_FIELDS:
+            resampled[name] = np.round(resampled[name], DECIMALS)
+
+        self.record(mmsi, len(columns['BaseDateTime']), len(times))
+        return resampled
+
+    def record(self, mmsi, rows_in, rows_out):
+        '''
+        Record the points in and out of a vessel.
+        '''
+        with self.lock:
+            self.vessels[str(mmsi)] = (rows_in, rows_out)
+
+    @property
+    def stats(self):
+        '''
+        Return the vessels and points in and out.
+        '''
+        with self.lock:
+            counts = list(self.vessels.values())
+        return {
+            'vessels': len(counts),
+            'rows_in': sum(c[0] for c in counts),
+            'rows_out': sum(c[1] for c in counts)}
+
+    def report(self):
+        '''
+        Log the points in and out of the run.
+        '''
+        stats = self.stats
+        logger.info(
+            'Resampled %d vessels from %d to %d points every %ds.',
+            stats['vessels'], stats['rows_in'], stats['rows_out'], self.interval)
+
+
+# ------------------------------------------------------------------------------
+# DRIVER
+# ------------------------------------------------------------------------------
+def resample_files(filepaths, output_directory, resampler = None,
+                   processes = None, compression = None, output = 'csv',
+                   zone = None):
+    '''
+    Resample the tracks of per-vessel csv files in a pool of worker
+    processes and write them in the export formats of Raw_MMSI: with
+    output 'csv', one <MMSI>_eez.csv file per vessel written by the worker;
+    with output 'partitioned', one file per month (see ais_arcpy.partition)
+    written by the calling process in MMSI order.
+
+    On Windows this must be called from under an
+    ``if __name__ == '__main__':`` guard.
+
+    :param filepaths: Paths of the csv files, one vessel each
+    :param output_directory: Folder of the resampled files
+    :param resampler: Resampler, default is one with the default grid
+    :param processes: Number of worker processes, default is the CPU count
+    :param compression: None, 'gzip', or 'lzma'
+    :param output: 'csv' or 'partitioned'
+    :param zone: Zone in the names of partitioned files
+
+    :type filepaths: list of strings
+    :type output_directory: string
+    :type resampler: Resampler
+    :type processes: int
+    :type compression: string
+    :type output: string
+    :type zone: string
+
+    :return: Vessels, points in and out, bytes, and seconds
+    :rtype: dict
+    '''
+    if output not in ('csv', 'partitioned'):
+        raise ValueError('Unknown output %s.' % output)
+    resampler = resampler or Resampler()
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    start = time.time()
+
+    writer = None
+    if output == 'partitioned':
+        writer = partition.PartitionWriter(
+            output_directory, zone, FIELDS, compression)
+        filepaths = sorted(filepaths, key=partition.mmsi_key)
+    tasks = []
+    for filepath in filepaths:
+        path = None
+        if writer is None:
+            mmsi = file_mmsi(filepath)
+            if mmsi is None:
+                raise ValueError('%s is not a vessel csv file.' % filepath)
+            path = export.output_path(
+                join(output_directory, mmsi + SUFFIX), compression)
+        tasks.append((filepath, path, resampler, compression))
+
+    size = 0
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        results = pool.imap(resample_file, tasks) if pool else map(resample_file, tasks)
+        for mmsi, rows_in, rows_out, result in results:
+            resampler.record(mmsi, rows_in, rows_out)
+            if writer is None:
+                size += result
+            else:
+                writer.write(result)
+        if pool is not None:
+            pool.close()
+    except Exception:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    if writer is not None:
+        size = writer.close()['bytes']
+
+    resampler.report()
+    stats = resampler.stats
+    stats['bytes'] = size
+    stats['seconds'] = time.time() - start
+    logger.info(
+        'Wrote %.1f MB of resampled tracks in %.1fs.', size / 1e6, stats['seconds'])
+    return stats
+
+def resample_year(directory, zone, year, interval = INTERVAL,
+                  max_gap = MAX_GAP, processes = None, compression = None,
+                  output = 'csv'):
+    '''
+    Resample the per-vessel csv files written by Raw_MMSI for a year to
+    <directory>/<year>/Resampled <interval>s.
+
+    :param directory: Root directory for the data
+    :param zone: Zone in the names of partitioned files
+    :param year: Year to resample
+    :param interval: Seconds between grid times
+    :param max_gap: Longest gap interpolated across in seconds
+    :param processes: Number of worker processes, default is the CPU count
+    :param compression: None, 'gzip', or 'lzma'
+    :param output: 'csv' or 'partitioned'
+
+    :type directory: string
+    :type zone: string
+    :type year: string
+    :type interval: int
+    :type max_gap: float
+    :type processes: int
+    :type compression: string
+    :type output: string
+
+    :return: Vessels, points in and out, bytes, and seconds
+    :rtype: dict
+    '''
+    folder = join(directory, year)
+    output_directory = util.create_folder(folder, 'Resampled %ds' % interval)
+    return resample_files(
+        vessel_files(folder), output_directory, Resampler(interval, max_gap),
+        processes, compression, output, zone)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.simplify
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: vectorized simplification of vessel tracks
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import logging
+import threading
+
+import numpy as np
+
+from . import split
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+# Meters per degree of latitude, and of longitude at the equator
+METERS_LAT = 110574.0
+METERS_LON = 111320.0
+
+# Points at or below this SOG in knots may be collapsed
+STATIONARY_SPEED = 0.5
+# Largest extent in meters of a stationary run
+STATIONARY_DISTANCE = 50.0
+# Seconds; at most one point is kept in each interval
+MIN_SPACING = 10
+# Meters a dropped point may be from its time-interpolated position
+TOLERANCE = 25.0
+
+# Fields read by Simplifier.simplify
+FIELDS = ('BaseDateTime', 'POINT_X', 'POINT_Y', 'SOG')
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def to_seconds(times):
+    '''
+    Return timestamps as float seconds since the epoch. Integer columns, as
+    held by ais_arcpy.track, are taken to be seconds already.
+    '''
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        times = times.astype('M8[s]').astype('i8')
+    return times.astype('f8')
+
+def to_meters(x, y):
+    '''
+    Project longitudes and latitudes to meters on a plane tangent at the
+    mean latitude of the points.
+    '''
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    scale = np.cos(np.radians(np.nanmean(y))) if len(y) else 1.0
+    return x * METERS_LON * scale, y * METERS_LAT
+
+def keep_moving(mx, my, sog, speed = STATIONARY_SPEED,
+                distance = STATIONARY_DISTANCE):
+    '''
+    Return a mask that collapses stationary runs. A run of consecutive
+    points at or below speed whose extent is within distance meters is
+    reduced to its first and last point. A longer slow run, such as a
+    vessel drifting, is reduced to the points where it moves into another
+    grid cell of the given size, and the point before.
+
+    :param mx: X in meters
+    :param my: Y in meters
+    :param sog: Speed over ground in knots, NaN if unknown
+    :param speed: Largest SOG of a stationary point
+    :param distance: Largest extent of a stationary run in meters
+
+    :type mx: numpy.ndarray
+    :type my: numpy.ndarray
+    :type sog: numpy.ndarray
+    :type speed: float
+    :type distance: float
+
+    :return: Mask of the points to keep
+    :rtype: numpy.ndarray
+    '''
+    count = len(mx)
+    if count < 3:
+        return np.ones(count, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        slow = np.asarray(sog) <= speed
+
+    # Runs of slow and moving points
+    _, starts, stops = split.group_bounds(np.cumsum(np.r_[True, slow[1:] != slow[:-1]]))
+    width = np.fmax.reduceat(mx, starts) - np.fmin.reduceat(mx, starts)
+    height = np.fmax.reduceat(my, starts) - np.fmin.reduceat(my, starts)
+    run = np.repeat(np.arange(len(starts)), stops - starts)
+    still = slow & (np.fmax(width, height) <= distance)[run]
+
+    cx = np.floor(mx / distance)
+    cy = np.floor(my / distance)
+    change = np.ones(count, dtype=bool)
+    change[1:] = (cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1])
+    change[starts] = True
+    ends = np.zeros(count, dtype=bool)
+    ends[starts] = ends[stops - 1] = True
+    before = np.zeros(count, dtype=bool)
+    before[:-1] = change[1:]
+    return ~slow | ends | (~still & (change | before))
+
+def keep_spaced(seconds, spacing = MIN_SPACING):
+    '''
+    Return a mask that keeps the first point of each interval of spacing
+    seconds and the last point.
+    '''
+    if len(seconds) < 3:
+        return np.ones(len(seconds), dtype=bool)
+    bins = np.floor(seconds / spacing)
+    keep = np.ones(len(seconds), dtype=bool)
+    keep[1:] = bins[1:] != bins[:-1]
+    keep[-1] = True
+    return keep
+
+def keep_shape(seconds, mx, my, tolerance = TOLERANCE):
+    '''
+    Return a mask of the points kept by a top-down line simplification with
+    the synchronized Euclidean distance: a point is dropped if it is within
+    tolerance meters of the position interpolated at its time between the
+    kept points around it.
+
+    Every segment is split at its worst point at once, so each iteration is
+    one pass of array operations over the track, and the number of
+    iterations is the depth of the split tree rather than the number of
+    points kept.
+
+    :param seconds: Time of each point in seconds
+    :param mx: X in meters
+    :param my: Y in meters
+    :param tolerance: Largest error of a dropped point in meters
+
+    :type seconds: numpy.ndarray
+    :type mx: numpy.ndarray
+    :type my: numpy.ndarray
+    :type tolerance: float
+
+    :return: Mask of the points to keep
+    :rtype: numpy.ndarray
+    '''
+    count = len(seconds)
+    keep = np.zeros(count, dtype=bool)
+    if count < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+    positions = np.arange(count)
+    while True:
+        before = np.maximum.accumulate(np.where(keep, positions, 0))
+        after = np.minimum.accumulate(
+            np.where(keep, positions, count - 1)[::-1])[::-1]
+        points = positions[~keep]
+        if not len(points):
+            break
+        a, b = before[points], after[points]
+        span = seconds[b] - seconds[a]
+        ratio = np.zeros(len(points))
+        moving = span > 0
+        ratio[moving] = (seconds[points][moving] - seconds[a][moving]) / span[moving]
+        ex = mx[a] + ratio * (mx[b] - mx[a])
+        ey = my[a] + ratio * (my[b] - my[a])
+        error = np.hypot(mx[points] - ex, my[points] - ey)
+        error[np.isnan(error)] = 0
+
+        # Worst point of every segment, if it is over the tolerance
+        _, starts, stops = split.group_bounds(a)
+        segment = np.repeat(np.arange(len(starts)), stops - starts)
+        worst = np.maximum.reduceat(error, starts)
+        candidates = (error == worst[segment]) & (error > tolerance)
+        if not candidates.any():
+            break
+        chosen = segment[candidates]
+        first = np.ones(len(chosen), dtype=bool)
+        first[1:] = chosen[1:] != chosen[:-1]
+        keep[points[candidates][first]] = True
+    return keep
+
+
+# ------------------------------------------------------------------------------
+# SIMPLIFIER
+# ------------------------------------------------------------------------------
+class Simplifier(object):
+
+    '''
+    Drop near-duplicate points from vessel tracks before they are written.
+    Each track is simplified in three passes over whole arrays: stationary
+    runs are collapsed, at most one point is kept per spacing seconds, and
+    a line simplification drops points within tolerance meters of the
+    track. A bound of None skips its pass. The first and last points of a
+    track are always kept.
+
+    The points in and out of each vessel are kept in vessels, and report
+    logs the compression ratio of the run.
+    '''
+
+    def __init__(self, speed = STATIONARY_SPEED, distance = STATIONARY_DISTANCE,
+                 spacing = MIN_SPACING, tolerance = TOLERANCE):
+        self.speed = speed
+        self.distance = distance
+        self.spacing = spacing
+        self.tolerance = tolerance
+        self.vessels = {}
+        self.lock = threading.Lock()
+
+    def simplify(self, mmsi, columns):
+        '''
+        Return the index of the points of a vessel to keep, in time order.
+
+        :param mmsi: Vessel identifier
+        :param columns: Dictionary with BaseDateTime, POINT_X, POINT_Y, and
+            SOG columns
+
+        :type mmsi: int or string
+        :type columns: dict
+
+        :return: Index of the points to keep
+        :rtype: numpy.ndarray
+        '''
+        seconds = to_seconds(columns['BaseDateTime'])
+        index = np.argsort(seconds, kind='mergesort')
+        mx, my = to_meters(columns['POINT_X'], columns['POINT_Y'])
+        sog = np.asarray(columns['SOG'], dtype='f8')
+
+        if self.speed is not None and self.distance is not None:
+            index = index[keep_moving(
+                mx[index], my[index], sog[index], self.speed, self.distance)]
+        if self.spacing:
+            index = index[keep_spaced(seconds[index], self.spacing)]
+        if self.tolerance is not None:
+            index = index[keep_shape(
+                seconds[index], mx[index], my[index], self.tolerance)]
+
+        with self.lock:
+            self.vessels[str(mmsi)] = (len(seconds), len(index))
+        if len(index):
+            logger.info(
+                'Simplified %s from %d to %d points (%.1fx).',
+                mmsi, len(seconds), len(index), len(seconds) / float(len(index)))
+        return index
+
+    def ratio(self, mmsi):
+        '''
+        Return the compression ratio of a vessel, points in over points out.
+        '''
+        rows_in, rows_out = self.vessels[str(mmsi)]
+        return rows_in / float(rows_out) if rows_out else None
+
+    @property
+    def stats(self):
+        '''
+        Return the vessels, points in and out, and overall ratio.
+        '''
+        with self.lock:
+            counts = list(self.vessels.values())
+        rows_in = sum(c[0] for c in counts)
+        rows_out = sum(c[1] for c in counts)
+        return {
+            'vessels': len(counts),
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'ratio': rows_in / float(rows_out) if rows_out else None}
+
+    def report(self):
+        '''
+        Log the points in and out of the run and the overall ratio.
+        '''
+        stats = self.stats
+        if stats['rows_out']:
+            logger.info(
+                'Simplified %d vessels from %d to %d points (%.1fx).',
+                stats['vessels'], stats['rows_in'], stats['rows_out'],
+                stats['ratio'])
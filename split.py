@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.split
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: group broadcast rows by MMSI with NumPy
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+BATCH_SIZE = 1000000
+
+
+# ------------------------------------------------------------------------------
+# GROUP BY
+# ------------------------------------------------------------------------------
+def concatenate_batches(batches):
+    '''
+    Concatenate an iterable of record arrays read in column batches.
+
+    :param batches: Record arrays with identical dtypes
+    :type batches: iterable of numpy.ndarray
+
+    :return: Single record array
+    :rtype: numpy.ndarray
+    '''
+    batches = [b for b in batches if len(b)]
+    if not batches:
+        raise ValueError('No rows were read.')
+    if len(batches) == 1:
+        return batches[0]
+    return np.concatenate(batches)
+
+def sort_order(array, key = 'MMSI', time = 'BaseDateTime'):
+    '''
+    Return the index that stable sorts a record array by MMSI and then by
+    time. Only the key and time columns are read, so the array may be a
+    memory map larger than memory.
+
+    :param array: Record array holding the key and time fields
+    :param key: Name of the vessel identifier field
+    :param time: Name of the timestamp field, None to sort by key only
+
+    :type array: numpy.ndarray
+    :type key: string
+    :type time: string
+
+    :return: Index of the rows in sorted order
+    :rtype: numpy.ndarray
+    '''
+    if time is None or time not in array.dtype.names:
+        return np.argsort(array[key], kind='mergesort')
+    return np.lexsort((array[time], array[key]))
+
+def sort_by_mmsi(array, key = 'MMSI', time = 'BaseDateTime'):
+    '''
+    Stable sort a record array by MMSI and then by time. Rows with equal
+    MMSI and time keep their original order.
+
+    :param array: Record array holding the key and time fields
+    :param key: Name of the vessel identifier field
+    :param time: Name of the timestamp field, None to sort by key only
+
+    :type array: numpy.ndarray
+    :type key: string
+    :type time: string
+
+    :return: Sorted copy of the array
+    :rtype: numpy.ndarray
+    '''
+    return array[sort_order(array, key, time)]
+
+def group_bounds(keys):
+    '''
+    Return the unique values of a sorted key column together with the start
+    and stop index of each run.
+
+    :param keys: Sorted key column
+    :type keys: numpy.ndarray
+
+    :return: Unique keys, run starts, run stops
+    :rtype: tuple of numpy.ndarray
+    '''
+    if len(keys) == 0:
+        empty = np.array([], dtype=np.intp)
+        return keys[:0], empty, empty
+    change = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    stops = np.concatenate((change, [len(keys)]))
+    return keys[starts], starts, stops
+
+def iter_groups(array, key = 'MMSI'):
+    '''
+    Yield (key, slice) pairs for each contiguous run of a sorted record
+    array. The slices are views and are not copied.
+
+    :param array: Record array sorted by key
+    :param key: Name of the key field
+
+    :type array: numpy.ndarray
+    :type key: string
+
+    :return: Generator of key and record array view
+    :rtype: generator
+    '''
+    values, starts, stops = group_bounds(array[key])
+    for value, start, stop in zip(values, starts, stops):
+        yield value, array[start:stop]
+
+def iter_group_index(array, key = 'MMSI', time = 'BaseDateTime'):
+    '''
+    Yield (key, index) pairs for each key of an unsorted record array, where
+    index selects the rows of the key in time order. Only the sort index is
+    held, so the array may be a memory map larger than memory.
+
+    :param array: Record array
+    :param key: Name of the key field
+    :param time: Name of the time field
+
+    :type array: numpy.ndarray
+    :type key: string
+    :type time: string
+
+    :return: Generator of key and index array
+    :rtype: generator
+    '''
+    order = sort_order(array, key, time)
+    values, starts, stops = group_bounds(array[key][order])
+    for value, start, stop in zip(values, starts, stops):
+        yield value, order[start:stop]
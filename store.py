@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.store
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: columnar on-disk store of AIS data partitioned by MMSI and month
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import json
+import logging
+import os
+from os.path import exists, getsize, join
+import shutil
+
+import numpy as np
+
+from . import dedup
+from . import merge
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+SCHEMA = 'schema.json'
+INDEX = 'index.json'
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def read_json(filepath, default = None):
+    '''
+    Return the contents of a json file, or default if it does not exist.
+    '''
+    if not exists(filepath):
+        return default
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+def write_json(filepath, obj):
+    '''
+    Write obj to a json file by replacing it with a temporary file, so a
+    reader never sees a partially written file.
+    '''
+    temp = filepath + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(obj, f)
+    util.replace_file(temp, filepath)
+
+def to_records(columns, names = None):
+    '''
+    Copy a dictionary of columns into a record array.
+
+    :param columns: Dictionary of field name to column
+    :param names: Field order, defaults to sorted field names
+
+    :type columns: dict
+    :type names: list of strings
+
+    :return: Record array
+    :rtype: numpy.ndarray
+    '''
+    names = names or sorted(columns)
+    dtype = [(str(n), columns[n].dtype) for n in names]
+    size = len(columns[names[0]]) if names else 0
+    array = np.empty(size, dtype=dtype)
+    for n in names:
+        array[n] = columns[n]
+    return array
+
+def write_column(f, column, order = None, dtype = None,
+                 chunk_size = merge.CHUNK_SIZE):
+    '''
+    Write a column to a binary file in chunks of rows, taken in the given
+    order, or as stored if order is None, so at most one chunk is copied at
+    a time.
+    '''
+    count = len(column) if order is None else len(order)
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        part = column[start:stop] if order is None else column[order[start:stop]]
+        f.write(np.ascontiguousarray(part, dtype=dtype).tobytes())
+
+
+# ------------------------------------------------------------------------------
+# STORE
+# ------------------------------------------------------------------------------
+class MMSIStore(object):
+
+    '''
+    Columnar store of AIS data for one zone and year.
+
+    Each vessel has a folder named by its MMSI holding one raw binary file
+    per field. A month is appended to the end of every field file, and the
+    vessel's index records the offset and row count of each month. Reading
+    a vessel's year memory-maps the field files without copying them.
+
+    The field dtypes are fixed by the first array appended to the store and
+    saved to schema.json.
+
+    Months are sorted by BaseDateTime before they are written and kept in
+    month order, so reading a vessel returns its rows in time order. A month
+    appended after a later month has been stored is inserted in place by
+    rewriting the vessel's field files. Rows are sorted by index and each
+    field is written in chunks, so a month may be a memory-mapped array
+    larger than memory.
+
+    If a track index (see ais_arcpy.trackindex) is given, the daily extents
+    and row ranges of each month are added to it as the month is appended.
+    If a deduplicator (see ais_arcpy.dedup) is given, rows already stored
+    for the vessel are dropped from each month before it is written.
+    '''
+
+    def __init__(self, directory, track_index = None, dedup = None):
+        self.directory = directory
+        self.track_index = track_index
+        self.dedup = dedup
+        if not exists(self.directory):
+            os.makedirs(self.directory)
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def schema(self):
+        '''
+        Return the list of (field, dtype) pairs, or None for an empty store.
+        '''
+        schema = read_json(join(self.directory, SCHEMA))
+        if schema is None:
+            return None
+        return [(str(name), np.dtype(str(dtype))) for name, dtype in schema]
+
+    @property
+    def fields(self):
+        '''
+        Return the list of field names.
+        '''
+        return [name for name, _ in self.schema or []]
+
+    def vessels(self):
+        '''
+        Return the sorted list of MMSI in the store.
+        '''
+        return sorted(
+            int(name) for name in os.listdir(self.directory)
+            if name.isdigit() and exists(join(self.directory, name, INDEX)))
+
+    def index(self, mmsi):
+        '''
+        Return the list of [month, offset, count] partitions for a vessel.
+        '''
+        return read_json(join(self.directory, str(mmsi), INDEX), [])
+
+    def months(self, mmsi):
+        '''
+        Return the months stored for a vessel.
+        '''
+        return [month for month, _, _ in self.index(mmsi)]
+
+    def count(self, mmsi):
+        '''
+        Return the number of rows stored for a vessel.
+        '''
+        return sum(count for _, _, count in self.index(mmsi))
+
+    def init_schema(self, array):
+        '''
+        Fix the store schema from the dtype of the first appended array.
+        '''
+        schema = [
+            (name, array.dtype[name].newbyteorder('<').str)
+            for name in array.dtype.names]
+        write_json(join(self.directory, SCHEMA), schema)
+
+    def append(self, mmsi, month, array, select = None):
+        '''
+        Append one month of a vessel's records. Each field is written to the
+        end of its file, and the index is replaced only after all fields have
+        been written. Bytes past the indexed length, left by an interrupted
+        append, are truncated first. A month that is already stored is not
+        appended again, and a month earlier than a stored month is inserted.
+
+        The records may be a subset of the rows of a larger array, such as a
+        memory-mapped spill file holding several vessels; the fields are then
+        copied from it in chunks.
+
+        :param mmsi: Vessel identifier
+        :param month: Month of the records
+        :param array: Record array with the store fields
+        :param select: Positions of the vessel's rows in array, default all
+
+        :type mmsi: int
+        :type month: string
+        :type array: numpy.ndarray
+        :type select: numpy.ndarray
+
+        :return: True if the month was appended
+        :rtype: bool
+        '''
+        if self.schema is None:
+            self.init_schema(array)
+        order = select
+        names = array.dtype.names
+        if 'BaseDateTime' in names:
+            times = array['BaseDateTime']
+            if select is not None:
+                times = times[select]
+            if not merge.is_sorted(times):
+                order = np.argsort(times, kind='mergesort')
+                if select is not None:
+                    order = select[order]
+            del times
+
+        folder = join(self.directory, str(mmsi))
+        self.recover(folder)
+        if not exists(folder):
+            os.makedirs(folder)
+
+        index = self.index(mmsi)
+        if month in [m for m, _, _ in index]:
+            self.logger.info('Month %s already stored for %s.', month, mmsi)
+            return False
+        if self.dedup is not None:
+            if select is None:
+                keep = self.dedup.filter(mmsi, month, array)
+            else:
+                selected = self.dedup.filter(mmsi, month, dict(
+                    (name, array[name][select]) for name in dedup.KEY_FIELDS))
+                keep = np.zeros(len(array), dtype=bool)
+                keep[select] = selected
+            if not keep.all():
+                order = np.flatnonzero(keep) if order is None else order[keep[order]]
+        rows = len(array) if order is None else len(order)
+        if index and month < max(m for m, _, _ in index):
+            self.insert(mmsi, month, array, order)
+            if self.dedup is not None:
+                self.dedup.commit(mmsi, month)
+            return True
+        offset = sum(count for _, _, count in index)
+
+        for name, dtype in self.schema:
+            filepath = join(folder, name + '.bin')
+            with open(filepath, 'ab') as f:
+                f.truncate(offset * dtype.itemsize)
+                write_column(f, array[name], order, dtype)
+
+        index.append([month, offset, rows])
+        write_json(join(folder, INDEX), index)
+        if self.track_index is not None:
+            self.track_index.add_array(mmsi, month, self.read_month(mmsi, month), offset)
+        if self.dedup is not None:
+            self.dedup.commit(mmsi, month)
+        return True
+
+    def insert(self, mmsi, month, array, order = None):
+        '''
+        Insert a month before the later months of a vessel. The field files
+        are rewritten in month order to a temporary folder, copying the
+        stored months in chunks, and swapped with the vessel's folder.
+
+        :param mmsi: Vessel identifier
+        :param month: Month of the records
+        :param array: Record array with the store fields
+        :param order: Index of the rows of array in time order, None if
+            array is sorted
+
+        :type mmsi: int
+        :type month: string
+        :type array: numpy.ndarray
+        :type order: numpy.ndarray
+        '''
+        self.logger.info('Inserting month %s before later months of %s.', month, mmsi)
+        folder = join(self.directory, str(mmsi))
+        temp = folder + '.merge'
+        if exists(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        old = self.index(mmsi)
+        rows = len(array) if order is None else len(order)
+        parts = sorted(old + [[month, None, rows]])
+        index = []
+        offset = 0
+        for m, _, count in parts:
+            index.append([m, offset, count])
+            offset += count
+
+        for name, dtype in self.schema:
+            column = self.column(mmsi, name)
+            with open(join(temp, name + '.bin'), 'wb') as f:
+                for m, start, count in parts:
+                    if start is None:
+                        write_column(f, array[name], order, dtype)
+                    else:
+                        write_column(f, column[start:start + count])
+            del column
+        write_json(join(temp, INDEX), index)
+
+        # The complete copy replaces the folder; see recover
+        os.rename(folder, folder + '.old')
+        os.rename(temp, folder)
+        shutil.rmtree(folder + '.old')
+
+        if self.track_index is not None:
+            moved = dict((m, o) for m, o, _ in old)
+            for m, o, _ in index:
+                if moved.get(m) != o:
+                    self.track_index.add_array(mmsi, m, self.read_month(mmsi, m), o)
+
+    def recover(self, folder):
+        '''
+        Finish or undo an insert of a vessel that was interrupted.
+        '''
+        temp, old = folder + '.merge', folder + '.old'
+        if exists(old):
+            if not exists(folder):
+                os.rename(temp, folder)
+            shutil.rmtree(old)
+        elif exists(temp):
+            shutil.rmtree(temp)
+
+    def column(self, mmsi, name):
+        '''
+        Return a read-only memory map of one field of a vessel's data.
+        '''
+        dtype = dict(self.schema)[name]
+        count = self.count(mmsi)
+        filepath = join(self.directory, str(mmsi), name + '.bin')
+        if count == 0 or getsize(filepath) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filepath, dtype=dtype, mode='r', shape=(count,))
+
+    def read(self, mmsi, fields = None):
+        '''
+        Return a dictionary of field name to read-only memory map holding
+        every month stored for the vessel.
+
+        :param mmsi: Vessel identifier
+        :param fields: Fields to read, default is all fields
+
+        :type mmsi: int
+        :type fields: list of strings
+
+        :return: Dictionary of columns
+        :rtype: dict
+        '''
+        return dict(
+            (name, self.column(mmsi, name))
+            for name in fields or self.fields)
+
+    def read_month(self, mmsi, month, fields = None):
+        '''
+        Return a dictionary of field name to memory mapped column for one
+        month of a vessel's data.
+        '''
+        for m, offset, count in self.index(mmsi):
+            if m == month:
+                columns = self.read(mmsi, fields)
+                return dict(
+                    (name, col[offset:offset + count])
+                    for name, col in columns.items())
+        raise KeyError('Month %s not stored for %s' % (month, mmsi))
+
+    def merge(self, other):
+        '''
+        Append every vessel and month of another store. Months that are
+        already stored are skipped, so an interrupted merge can be rerun.
+
+        :param other: Store to merge into this store
+        :type other: MMSIStore
+        '''
+        fields = other.fields
+        for mmsi in other.vessels():
+            for month in other.months(mmsi):
+                columns = other.read_month(mmsi, month, fields)
+                self.append(mmsi, month, to_records(columns, fields))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.synthetic
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: generate synthetic AIS broadcast data
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import calendar
+
+import numpy as np
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+BROADCAST_DTYPE = np.dtype([
+    ('SOG', 'f8'),
+    ('COG', 'f8'),
+    ('Heading', 'f8'),
+    ('ROT', 'f8'),
+    ('BaseDateTime', 'M8[us]'),
+    ('Status', 'i4'),
+    ('VoyageID', 'i4'),
+    ('MMSI', 'i4'),
+    ('ReceiverType', 'i4'),
+    ('POINT_X', 'f8'),
+    ('POINT_Y', 'f8')])
+
+# Approximate extent of UTM zone 10 coastal waters
+EXTENT = (-126.0, 32.0, -120.0, 49.0)
+
+# Size of a 1x month; a full month of zone 10 is roughly 100x
+SCALE_ROWS = 100000
+SCALE_VESSELS = 300
+
+
+# ------------------------------------------------------------------------------
+# GENERATOR
+# ------------------------------------------------------------------------------
+def synthetic_month(rows, vessels, year = 2014, month = 1, seed = 0):
+    '''
+    Return a record array resembling one month of a zone's Broadcast table.
+    Rows are shuffled so that no MMSI or time ordering can be assumed.
+
+    :param rows: Number of rows to generate
+    :param vessels: Number of distinct MMSI
+    :param year: Year of the timestamps
+    :param month: Month of the timestamps
+    :param seed: Random seed
+
+    :type rows: int
+    :type vessels: int
+    :type year: int
+    :type month: int
+    :type seed: int
+
+    :return: Broadcast records
+    :rtype: numpy.ndarray
+    '''
+    rng = np.random.RandomState(seed)
+    array = np.zeros(rows, dtype=BROADCAST_DTYPE)
+
+    mmsi = rng.choice(100000000, vessels, replace=False) + 200000000
+    array['MMSI'] = mmsi[rng.randint(0, vessels, rows)]
+
+    days = calendar.monthrange(year, month)[1]
+    start = np.datetime64('%04d-%02d-01' % (year, month), 's')
+    seconds = rng.randint(0, days * 86400, rows)
+    array['BaseDateTime'] = start + seconds.astype('m8[s]')
+
+    xmin, ymin, xmax, ymax = EXTENT
+    array['POINT_X'] = rng.uniform(xmin, xmax, rows)
+    array['POINT_Y'] = rng.uniform(ymin, ymax, rows)
+    array['SOG'] = rng.gamma(2.0, 4.0, rows).round(1)
+    array['COG'] = rng.uniform(0, 360, rows).round(1)
+    array['Heading'] = array['COG'].round()
+    array['ROT'] = rng.normal(0, 5, rows).round()
+    array['Status'] = rng.randint(0, 16, rows)
+    array['VoyageID'] = rng.randint(0, 1000, rows)
+    array['ReceiverType'] = rng.randint(0, 2, rows)
+    return array
+
+def synthetic_tracks(rows, vessels, year = 2014, month = 1, seed = 0):
+    '''
+    Return a record array of vessel tracks resembling one month of a zone's
+    Broadcast table. Unlike synthetic_month, a few vessels send most of the
+    messages (a log-normal share per vessel), and each vessel moves along a
+    path given by its speed and course, so points are dense along tracks.
+    Rows are shuffled so that no MMSI or time ordering can be assumed.
+
+    :param rows: Number of rows to generate
+    :param vessels: Number of distinct MMSI
+    :param year: Year of the timestamps
+    :param month: Month of the timestamps
+    :param seed: Random seed
+
+    :type rows: int
+    :type vessels: int
+    :type year: int
+    :type month: int
+    :type seed: int
+
+    :return: Broadcast records
+    :rtype: numpy.ndarray
+    '''
+    rng = np.random.RandomState(seed)
+    array = np.zeros(rows, dtype=BROADCAST_DTYPE)
+
+    # Messages per vessel
+    share = rng.lognormal(0.0, 1.5, vessels)
+    counts = rng.multinomial(rows, share / share.sum())
+    vessel = np.repeat(np.arange(vessels), counts)
+    starts = np.cumsum(counts) - counts
+
+    # Sorted timestamps within each vessel
+    days = calendar.monthrange(year, month)[1]
+    seconds = rng.randint(0, days * 86400, rows)
+    order = np.lexsort((seconds, vessel))
+    seconds = seconds[order]
+    first = starts[counts > 0]
+    lengths = counts[counts > 0]
+    dt = np.zeros(rows)
+    dt[1:] = np.diff(seconds)
+    dt[first] = 0.0
+
+    # Speed in knots and a course that drifts along each track
+    sog = rng.gamma(2.0, 4.0, vessels)[vessel] * rng.uniform(0.8, 1.2, rows)
+    rot = rng.normal(0.0, 5.0, rows)
+    rot[first] = 0.0
+    turn = rot.copy()
+    turn[first] = rng.uniform(0, 360, len(first))
+    cog = np.cumsum(turn)
+    cog -= np.repeat(cog[first] - turn[first], lengths)
+    cog %= 360
+
+    # Positions in degrees, starting anywhere in the extent
+    xmin, ymin, xmax, ymax = EXTENT
+    step = sog * dt / 3600.0 / 60.0
+    ex = step * np.sin(np.radians(cog))
+    ey = step * np.cos(np.radians(cog))
+    dx = np.cumsum(ex)
+    dy = np.cumsum(ey)
+    dx -= np.repeat(dx[first] - ex[first], lengths)
+    dy -= np.repeat(dy[first] - ey[first], lengths)
+    x0 = rng.uniform(xmin, xmax, vessels)[vessel]
+    y0 = rng.uniform(ymin, ymax, vessels)[vessel]
+
+    mmsi = rng.choice(100000000, vessels, replace=False) + 200000000
+    start = np.datetime64('%04d-%02d-01' % (year, month), 's')
+    array['MMSI'] = mmsi[vessel]
+    array['BaseDateTime'] = start + seconds.astype('m8[s]')
+    array['POINT_X'] = np.clip(x0 + dx, xmin, xmax)
+    array['POINT_Y'] = np.clip(y0 + dy, ymin, ymax)
+    array['SOG'] = sog.round(1)
+    array['COG'] = cog.round(1)
+    array['Heading'] = array['COG'].round()
+    array['ROT'] = rot.round()
+    array['Status'] = np.where(sog < 0.5, 1, 0)
+    array['VoyageID'] = rng.randint(0, 1000, vessels)[vessel]
+    array['ReceiverType'] = rng.randint(0, 2, rows)
+    return array[rng.permutation(rows)]
+
+def synthetic_eez(vertices = 2000):
+    '''
+    Return the rings of a polygon covering the coastal half of EXTENT, with
+    a wavy seaward boundary of the given number of vertices.
+
+    :param vertices: Number of vertices on the seaward boundary
+    :type vertices: int
+
+    :return: Rings as lists of (x, y) vertices
+    :rtype: list
+    '''
+    xmin, ymin, xmax, ymax = EXTENT
+    y = np.linspace(ymin, ymax, vertices)
+    x = (xmin + xmax) / 2.0 + 0.5 * np.sin(y * 3.0) + 0.1 * np.sin(y * 40.0)
+    ring = list(zip(x, y)) + [(xmax, ymax), (xmax, ymin)]
+    return [ring]
+
+def scaled_month(scale, year = 2014, month = 1, seed = 0):
+    '''
+    Return synthetic tracks for a month at a multiple of SCALE_ROWS rows.
+    The number of vessels grows with the square root of the scale, as busier
+    months add messages faster than they add vessels.
+
+    :param scale: Multiple of the 1x month size
+    :param year: Year of the timestamps
+    :param month: Month of the timestamps
+    :param seed: Random seed
+
+    :type scale: int
+    :type year: int
+    :type month: int
+    :type seed: int
+
+    :return: Broadcast records
+    :rtype: numpy.ndarray
+    '''
+    rows = int(SCALE_ROWS * scale)
+    vessels = int(SCALE_VESSELS * scale ** 0.5)
+    return synthetic_tracks(rows, vessels, year, month, seed)
@@ -0,0 +1,9 @@
+'''
+Make the ais_arcpy package importable when the tests are run from a clone.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
@@ -0,0 +1,15 @@
+'''
+Smoke test of ais_arcpy.benchmark: every stage runs on the NumPy backend.
+'''
+
+from ais_arcpy import benchmark
+
+
+def test_stages_run_on_numpy(tmpdir):
+    timings = benchmark.bench_stages(scale=1, engine='numpy', directory=str(tmpdir))
+    assert timings['rows'] > 0
+    assert timings['vessels'] > 0
+    for stage in benchmark.STAGES:
+        assert timings[stage] >= 0
+    assert tmpdir.listdir(lambda path: path.ext == '.csv')
+    assert 'cursor' in benchmark.format_suite({1: timings})
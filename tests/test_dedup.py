@@ -0,0 +1,61 @@
+'''
+Tests of ais_arcpy.dedup: reports that differ only in the signs of their
+fields hash apart, and repeated reports are dropped.
+'''
+
+import numpy as np
+
+from ais_arcpy import dedup
+
+
+def make_columns(rows):
+    names = dedup.KEY_FIELDS
+    columns = dict((name, np.array([row[i] for row in rows], dtype='f8'))
+                   for i, name in enumerate(names))
+    columns['BaseDateTime'] = (
+        np.datetime64('2014-01-01T00:00:00') +
+        columns['BaseDateTime'].astype('i8').astype('m8[s]'))
+    return columns
+
+
+def test_sign_flips_do_not_collide():
+    rows = [
+        (366000000, 0, -122.5, 47.25, 10.0, 90.0),
+        (366000000, 0, 122.5, -47.25, 10.0, 90.0),
+        (366000000, 0, -122.5, 47.25, -10.0, -90.0),
+        (366000000, 0, -122.5, -47.25, 10.0, -90.0),
+        (366000000, 0, 122.5, 47.25, -10.0, 90.0)]
+    keys = dedup.hash_columns(make_columns(rows))
+    assert len(np.unique(keys)) == len(rows)
+
+
+def test_random_sign_flips_do_not_collide():
+    random = np.random.RandomState(0)
+    count = 20000
+    base = np.column_stack([
+        np.full(count, 366000000.0),
+        random.randint(0, 86400, count).astype('f8'),
+        random.uniform(-180, 180, count),
+        random.uniform(-90, 90, count),
+        random.uniform(0, 30, count),
+        random.uniform(0, 360, count)])
+    rows = [tuple(row) for row in base]
+    flipped = base.copy()
+    flipped[:, 2:] *= np.where(random.rand(count, 4) < 0.5, -1.0, 1.0)
+    flipped[:, 2] *= -1.0
+    rows.extend(tuple(row) for row in flipped)
+    keys = dedup.hash_columns(make_columns(rows))
+    assert len(np.unique(keys)) == len(set(rows))
+
+
+def test_repeated_reports_are_dropped(tmpdir):
+    rows = [
+        (366000000, 0, -122.5, 47.25, 10.0, 90.0),
+        (366000000, 60, -122.5, 47.26, 10.0, 90.0),
+        (366000000, 0, -122.5, 47.25, 10.0, 90.0)]
+    keys = dedup.Deduplicator(str(tmpdir))
+    mask = keys.filter(366000000, '01', make_columns(rows))
+    assert mask.tolist() == [True, True, False]
+    keys.commit(366000000, '01')
+    mask = keys.filter(366000000, '02', make_columns(rows[:1]))
+    assert mask.tolist() == [False]
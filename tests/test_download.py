@@ -0,0 +1,205 @@
+'''
+Tests of ais_arcpy.download against a local HTTP server that supports Range
+requests: resume after an interrupted transfer, fallback when the server
+ignores ranges, retry after errors, and several files at once.
+'''
+
+import os
+from os.path import exists
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+pycurl = pytest.importorskip('pycurl')
+pytest.importorskip('certifi')
+
+from ais_arcpy import download
+
+
+DATA = os.urandom(1024 ** 2)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    '''
+    Server of DATA at every path. Options on the server change how it
+    answers, and every request is recorded.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.ranges = True
+        self.errors = {}
+        self.cut = {}
+        self.delay = 0
+        self.requests = []
+        self.running = 0
+        self.most = 0
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.lstrip('/')
+        with server.lock:
+            server.requests.append((path, self.headers.get('Range')))
+            server.running += 1
+            server.most = max(server.most, server.running)
+            error = server.errors.get(path)
+            if error and error[1]:
+                server.errors[path] = (error[0], error[1] - 1)
+            cut = server.cut.pop(path, None)
+        try:
+            time.sleep(server.delay)
+            if error and error[1]:
+                self.send_error(error[0])
+                return
+            self.send_data(cut)
+        finally:
+            with server.lock:
+                server.running -= 1
+
+    def send_data(self, cut):
+        start = 0
+        header = self.headers.get('Range')
+        if header and self.server.ranges:
+            start = int(header.split('=')[1].split('-')[0])
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(DATA))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (start, len(DATA) - 1, len(DATA)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(DATA) - start))
+        self.end_headers()
+        # A cut response closes the connection part of the way through
+        self.wfile.write(DATA[start:cut])
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+
+def test_interrupted_download_is_resumed(server, tmpdir):
+    url = server.url('month.zip')
+    filepath = str(tmpdir.join('month.zip'))
+    server.cut['month.zip'] = len(DATA) // 3
+
+    assert download.fetch(url, filepath) == filepath
+    assert read(filepath) == DATA
+    assert server.requests == [
+        ('month.zip', None), ('month.zip', 'bytes=%d-' % (len(DATA) // 3))]
+    assert not exists(download.part_file(url, filepath))
+
+
+def test_partial_file_is_resumed(server, tmpdir):
+    url = server.url('month.zip')
+    filepath = str(tmpdir.join('month.zip'))
+    with open(download.part_file(url, filepath), 'wb') as f:
+        f.write(DATA[:1000])
+
+    download.fetch(url, filepath)
+    assert read(filepath) == DATA
+    assert server.requests == [('month.zip', 'bytes=1000-')]
+
+
+def test_complete_partial_file_is_kept(server, tmpdir):
+    url = server.url('month.zip')
+    filepath = str(tmpdir.join('month.zip'))
+    with open(download.part_file(url, filepath), 'wb') as f:
+        f.write(DATA)
+
+    download.fetch(url, filepath)
+    assert read(filepath) == DATA
+
+
+def test_server_without_ranges_restarts(server, tmpdir):
+    server.ranges = False
+    url = server.url('month.zip')
+    filepath = str(tmpdir.join('month.zip'))
+    with open(download.part_file(url, filepath), 'wb') as f:
+        f.write(DATA[:1000])
+
+    download.fetch(url, filepath)
+    assert read(filepath) == DATA
+    assert server.requests[-1] == ('month.zip', None)
+
+
+def test_error_is_retried(server, tmpdir):
+    server.errors['month.zip'] = (404, 1)
+    filepath = str(tmpdir.join('month.zip'))
+
+    download.fetch(server.url('month.zip'), filepath)
+    assert read(filepath) == DATA
+    assert len(server.requests) == 2
+
+
+def test_missing_file_fails_after_retries(server, tmpdir):
+    server.errors['missing.zip'] = (404, download.RETRIES + 1)
+    filepath = str(tmpdir.join('missing.zip'))
+
+    with pytest.raises(download.downloadFailed) as err:
+        download.fetch(server.url('missing.zip'), filepath)
+    assert 'HTTP 404' in str(err.value)
+    assert len(server.requests) == download.RETRIES
+    assert not exists(filepath)
+
+
+def test_files_are_downloaded_at_once(server, tmpdir):
+    server.delay = 0.2
+    server.errors['3.zip'] = (500, 1)
+    server.cut['5.zip'] = len(DATA) // 2
+    targets = [
+        (server.url('%d.zip' % i), str(tmpdir.join('%d.zip' % i)))
+        for i in range(8)]
+    with open(targets[0][1], 'wb') as f:
+        f.write(DATA)
+
+    manager = download.DownloadManager(connections=3)
+    try:
+        done = manager.download(targets)
+    finally:
+        manager.close()
+
+    assert done == dict(targets)
+    for url, filepath in targets:
+        assert read(filepath) == DATA
+    assert '0.zip' not in [path for path, _ in server.requests]
+    assert 1 < server.most <= 3
+    assert len(server.requests) == 7 + 2
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        '%d.zip' % i for i in range(8))
@@ -0,0 +1,55 @@
+'''
+Tests of ais_arcpy.manifest: completed units are skipped, interrupted units
+are retried once, and a unit that fails its retry raises instead of being
+taken as done.
+'''
+
+import pytest
+
+from ais_arcpy import manifest
+
+
+UNIT = ('10', '2014', '01', '', 'split')
+
+
+@pytest.fixture
+def units(tmpdir):
+    return manifest.Manifest(str(tmpdir))
+
+
+def test_completed_unit_is_skipped(units):
+    assert units.begin(*UNIT) == 1
+    units.finish(*UNIT, rows=10)
+    assert units.begin(*UNIT) == 0
+    assert units.done(*UNIT)
+
+
+def test_interrupted_unit_is_retried_once(units):
+    assert units.begin(*UNIT) == 1
+    assert units.begin(*UNIT) == 2
+    units.finish(*UNIT)
+    assert units.begin(*UNIT) == 0
+
+
+def test_failed_unit_raises(units):
+    assert units.begin(*UNIT) == 1
+    assert units.begin(*UNIT) == manifest.MAX_ATTEMPTS
+    with pytest.raises(manifest.unitFailed) as err:
+        units.begin(*UNIT)
+    assert err.value.key == UNIT
+    assert units.status(*UNIT) == manifest.FAILED
+    assert not units.done(*UNIT)
+
+    # Later runs fail too instead of skipping the unit
+    with pytest.raises(manifest.unitFailed):
+        units.begin(*UNIT)
+    assert units.summary() == {('split', manifest.FAILED): 1}
+
+
+def test_failed_unit_does_not_affect_others(units):
+    other = UNIT[:-1] + ('copy',)
+    units.begin(*UNIT)
+    units.begin(*UNIT)
+    with pytest.raises(manifest.unitFailed):
+        units.begin(*UNIT)
+    assert units.begin(*other) == 1
@@ -0,0 +1,159 @@
+'''
+Tests of ais_arcpy.memory: a synthetic month larger than a small memory
+budget is split through spill files, stored from memory maps, and exported
+in chunks, and the output is compared with the path that holds everything
+in memory.
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+from ais_arcpy import dedup
+from ais_arcpy import export
+from ais_arcpy import memory
+from ais_arcpy import merge
+from ais_arcpy import split
+from ais_arcpy import store
+from ais_arcpy import synthetic
+
+
+ROWS = 30000
+VESSELS = 40
+LIMIT = 1024 ** 2
+MONTH = '01'
+
+
+@pytest.fixture(scope='module')
+def month():
+    return synthetic.synthetic_tracks(ROWS, VESSELS)
+
+
+@pytest.fixture
+def budget(tmpdir):
+    return memory.MemoryBudget(LIMIT, str(tmpdir.mkdir('spill')))
+
+
+def make_store(directory, deduplicate):
+    keys = dedup.Deduplicator(directory + '.keys') if deduplicate else None
+    return store.MMSIStore(directory, dedup=keys)
+
+
+def store_in_memory(directory, array, deduplicate = False):
+    mmsi_store = make_store(directory, deduplicate)
+    for mmsi, group in split.iter_groups(split.sort_by_mmsi(array)):
+        mmsi_store.append(mmsi, MONTH, group)
+    return mmsi_store
+
+
+def store_with_budget(directory, array, budget, deduplicate = False):
+    '''
+    Split a month through memory.split_spilled into the store, as
+    Raw_Month.split_numpy does when aggregating to the store.
+    '''
+    mmsi_store = make_store(directory, deduplicate)
+    width = array.dtype.itemsize
+    size = budget.rows(width)
+    large = []
+
+    def write_groups(array):
+        for mmsi, group in split.iter_groups(array):
+            mmsi_store.append(mmsi, MONTH, group)
+
+    def write_large_groups(array):
+        assert isinstance(array, np.memmap)
+        large.append(os.path.dirname(array.filename))
+        for mmsi, index in split.iter_group_index(array):
+            mmsi_store.append(mmsi, MONTH, array, index)
+
+    batches = (array[start:start + size] for start in range(0, len(array), size))
+    rows = memory.split_spilled(
+        batches, budget, len(array), width, write_groups, write_large_groups)
+    assert rows == len(array)
+    for directory in large:
+        assert not os.path.exists(directory)
+    return mmsi_store, len(large)
+
+
+def test_month_is_larger_than_budget(month, budget):
+    width = month.dtype.itemsize
+    assert not budget.fits(len(month), width)
+    # A few vessels send most of the messages
+    counts = np.bincount(month['MMSI'] - month['MMSI'].min())
+    assert counts.max() > budget.rows(width)
+
+
+@pytest.mark.parametrize('deduplicate', [False, True])
+def test_split_through_spill_matches_memory(tmpdir, month, budget, deduplicate):
+    # Reports heard twice are dropped by the deduplicator
+    array = np.concatenate([month, month[::7]])
+    expected = store_in_memory(str(tmpdir.join('memory')), array, deduplicate)
+    actual, large = store_with_budget(
+        str(tmpdir.join('budget')), array, budget, deduplicate)
+    assert large > 0
+    stored = sum(expected.count(mmsi) for mmsi in expected.vessels())
+    assert stored == (len(month) if deduplicate else len(array))
+
+    assert sorted(actual.vessels()) == sorted(expected.vessels())
+    for mmsi in expected.vessels():
+        want = expected.read(mmsi)
+        got = actual.read(mmsi)
+        for name in want:
+            np.testing.assert_array_equal(got[name], want[name])
+        assert merge.is_sorted(got['BaseDateTime'])
+    assert 'split' in budget.stats['peaks']
+
+
+def test_store_from_spilled_vessel(tmpdir, month, budget):
+    first = month['MMSI'].min()
+    mmsi = np.bincount(month['MMSI'] - first).argmax() + first
+    vessel = month[month['MMSI'] == mmsi]
+    expected = store.MMSIStore(str(tmpdir.join('memory')))
+    expected.append(mmsi, MONTH, vessel)
+
+    actual = store.MMSIStore(str(tmpdir.join('budget')))
+    with budget.spill() as spill:
+        size = budget.rows(vessel.dtype.itemsize)
+        for start in range(0, len(vessel), size):
+            spill.add(vessel[start:start + size])
+        mapped = spill.read(0, mmap=True)
+        actual.append(mmsi, MONTH, mapped)
+        del mapped
+
+    want = expected.read(mmsi)
+    got = actual.read(mmsi)
+    for name in want:
+        np.testing.assert_array_equal(got[name], want[name])
+
+
+def test_export_in_chunks_matches_memory(tmpdir, month, budget):
+    array = split.sort_by_mmsi(month)
+    fields = ['MMSI', 'BaseDateTime', 'POINT_X', 'POINT_Y', 'SOG', 'COG']
+    columns = dict((name, array[name]) for name in fields)
+    size = budget.rows(memory.tuple_bytes(len(fields)))
+    assert size < len(array)
+
+    whole = str(tmpdir.join('whole.csv'))
+    export.write_csv(whole, fields, export.column_rows(columns, fields))
+    chunked = str(tmpdir.join('chunked.csv'))
+    chunks = (
+        export.column_rows(
+            dict((name, column[start:start + size]) for name, column in columns.items()),
+            fields)
+        for start in range(0, len(array), size))
+    count, _ = export.write_chunks(chunked, fields, budget.sampled(chunks, 'export'))
+
+    assert count == len(array)
+    with open(whole, 'rb') as a, open(chunked, 'rb') as b:
+        assert a.read() == b.read()
+    assert 'export' in budget.stats['peaks']
+
+
+def test_budget_pickles(budget):
+    import pickle
+
+    copy = pickle.loads(pickle.dumps(budget))
+    assert copy.limit == budget.limit
+    assert copy.directory == budget.directory
+    assert copy.rows(100) == budget.rows(100)
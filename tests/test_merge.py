@@ -0,0 +1,48 @@
+'''
+Tests of ais_arcpy.merge: runs merged in chunks come out ordered by time,
+then run, then position in the run.
+'''
+
+import numpy as np
+
+from ais_arcpy import merge
+
+
+def make_runs(random):
+    runs, expected = [], []
+    for index in range(random.randint(1, 5)):
+        count = random.randint(0, 40)
+        times = np.sort(random.randint(0, 10, count)).astype('M8[s]').astype('M8[us]')
+        rows = [(index, position) for position in range(count)]
+        expected.extend(
+            (time, index, position) for time, (_, position)
+            in zip(times.tolist(), rows))
+        size = random.randint(1, 8)
+        runs.append([
+            (times[start:start + size], rows[start:start + size])
+            for start in range(0, count, size)])
+    return runs, sorted(expected)
+
+
+def test_ties_keep_run_order():
+    random = np.random.RandomState(1)
+    for _ in range(2000):
+        runs, expected = make_runs(random)
+        merged = []
+        for times, rows in merge.merge_runs(runs):
+            assert merge.is_sorted(times)
+            merged.extend(
+                (time, index, position) for time, (index, position)
+                in zip(times.tolist(), rows))
+        assert merged == expected
+
+
+def test_record_arrays_are_merged():
+    dtype = [('BaseDateTime', 'M8[us]'), ('SOG', 'f8')]
+    first = np.array([(0, 1.0), (2, 2.0)], dtype=dtype)
+    second = np.array([(1, 3.0), (2, 4.0)], dtype=dtype)
+    runs = [merge.array_chunks(first, chunk_size=1),
+            merge.array_chunks(second, chunk_size=1)]
+    chunks = list(merge.merge_runs(runs))
+    sog = np.concatenate([rows['SOG'] for _, rows in chunks])
+    assert sog.tolist() == [1.0, 3.0, 2.0, 4.0]
@@ -0,0 +1,101 @@
+'''
+Tests of ais_arcpy.metrics: counts added from export threads reach the
+record of the stage that submitted the files, and the peak RSS of a stage
+is sampled while it runs.
+'''
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from ais_arcpy import export
+from ais_arcpy import metrics
+
+
+FIELDS = ['MMSI', 'SOG']
+FILES = 8
+
+
+def write_files(directory, exporter):
+    '''
+    Stage submitting csv files to the exporter as Raw_MMSI.write_csv does.
+    '''
+    record = metrics.current()
+
+    def done(count, size):
+        metrics.update(record=record, bytes_written=size)
+
+    for i in range(FILES):
+        rows = [(i, float(j)) for j in range(1000)]
+        exporter.write(os.path.join(directory, '%d.csv' % i), FIELDS, rows, done)
+
+
+def test_bytes_written_on_export_threads(tmpdir):
+    directory = str(tmpdir)
+    recorder = metrics.start()
+    try:
+        exporter = export.Exporter(4)
+        metrics.measure('mmsi.csv')(write_files)(directory, exporter)
+        stats = exporter.close()
+    finally:
+        metrics.finish()
+
+    size = sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory))
+    assert stats['bytes'] == size
+    record, = recorder.records
+    assert record['stage'] == 'mmsi.csv'
+    assert record['bytes_written'] == size
+
+
+def test_update_outside_stage_does_nothing():
+    recorder = metrics.start()
+    try:
+        assert metrics.current() is None
+        metrics.update(bytes_written=10)
+    finally:
+        metrics.finish()
+    assert recorder.records == []
+
+
+def allocate(size):
+    '''
+    Stage that holds size bytes for a while and frees them before it ends.
+    '''
+    array = np.ones(size // 8)
+    time.sleep(4 * metrics.SAMPLE_INTERVAL)
+    del array
+
+
+@pytest.mark.skipif(
+    not os.path.exists('/proc/self/statm'), reason='needs the current RSS')
+def test_peak_rss_is_sampled_during_stage():
+    size = 256 * 1024 ** 2
+    recorder = metrics.start()
+    try:
+        metrics.measure('large')(allocate)(size)
+        metrics.measure('small')(allocate)(1024)
+    finally:
+        metrics.finish()
+
+    large, small = recorder.records
+    assert large['peak_rss'] - small['peak_rss'] > size // 2
+    assert large['pid'] == os.getpid()
+    assert recorder.summary()['large']['peak_rss'] == large['peak_rss']
+    assert recorder.sampler is None
+
+
+def test_worker_records_are_added():
+    worker = metrics.Recorder()
+    record = worker.start('month.split')
+    worker.stop(record)
+    worker.close()
+
+    recorder = metrics.start()
+    try:
+        metrics.add(worker.records)
+    finally:
+        metrics.finish()
+    assert [r['stage'] for r in recorder.records] == ['month.split']
@@ -0,0 +1,67 @@
+'''
+Tests of ais_arcpy.pipeline: months are processed in order while later
+months are fetched, and with cleanup the raw data of each processed month
+is deleted before another month is fetched.
+'''
+
+import threading
+
+import pytest
+
+from ais_arcpy import pipeline
+
+
+class Month(object):
+
+    '''
+    Stand-in for Raw_Month that records the months with raw data on disk.
+    '''
+
+    def __init__(self, name, disk, fail = False):
+        self.name = name
+        self.workspace = name
+        self.disk = disk
+        self.fail = fail
+
+    def download_raw_data(self):
+        if self.fail:
+            raise IOError('Download of %s failed' % self.name)
+        with self.disk['lock']:
+            self.disk['raw'].add(self.name)
+            self.disk['most'] = max(self.disk['most'], len(self.disk['raw']))
+
+    def process_month(self):
+        assert self.name in self.disk['raw']
+        self.disk['processed'].append(self.name)
+
+    def delete_raw_data(self):
+        with self.disk['lock']:
+            self.disk['raw'].remove(self.name)
+
+
+def make_months(count, failed = ()):
+    disk = {'lock': threading.Lock(), 'raw': set(), 'most': 0, 'processed': []}
+    months = [Month(str(i), disk, str(i) in failed) for i in range(count)]
+    return months, disk
+
+
+def test_cleanup_bounds_raw_data():
+    months, disk = make_months(8)
+    stats = pipeline.Pipeline(months, depth=2, cleanup=True).run()
+    assert disk['processed'] == [month.name for month in months]
+    assert disk['raw'] == set()
+    assert disk['most'] <= 2 + 1
+    assert set(stats) == set(['fetch', 'fetch_wait', 'process', 'process_wait'])
+
+
+def test_raw_data_is_kept_without_cleanup():
+    months, disk = make_months(4)
+    pipeline.Pipeline(months, depth=1).run()
+    assert disk['raw'] == set(month.name for month in months)
+
+
+def test_download_error_is_raised():
+    months, disk = make_months(4, failed=['2'])
+    with pytest.raises(IOError):
+        pipeline.Pipeline(months, depth=1, cleanup=True).run()
+    assert disk['processed'] == ['0', '1']
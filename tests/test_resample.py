@@ -0,0 +1,157 @@
+'''
+Tests of ais_arcpy.resample: tracks are sampled on a grid aligned to the
+epoch, interpolated along straight lines and the shorter arc of angles,
+and not across long gaps; the per-vessel csv files written by Raw_MMSI are
+found and named by the MMSI in their names, with or without the letter
+prefix added by ValidateTableName.
+'''
+
+import csv
+from datetime import datetime, timedelta
+import os
+from os.path import basename, join
+
+import numpy as np
+
+from ais_arcpy import export
+from ais_arcpy import partition
+from ais_arcpy import resample
+
+
+def track_columns(seconds, **columns):
+    '''
+    Return the columns of a track reported at the given seconds, with every
+    field not given set to zero.
+    '''
+    seconds = np.array(seconds, dtype='i8')
+    for name in resample.LINEAR_FIELDS + resample.ANGLE_FIELDS:
+        columns.setdefault(name, np.zeros(len(seconds)))
+    columns['BaseDateTime'] = seconds
+    return columns
+
+
+def test_grid_is_aligned_to_interval():
+    times, before, weight = resample.grid_points(
+        np.array([30, 150, 290], dtype='i8'), interval=60)
+    assert times.tolist() == [60, 120, 180, 240]
+    assert before.tolist() == [0, 0, 1, 1]
+    np.testing.assert_allclose(weight, [0.25, 0.75, 30 / 140.0, 90 / 140.0])
+
+
+def test_reports_on_grid_are_kept():
+    times, before, weight = resample.grid_points(
+        np.array([0, 60, 100], dtype='i8'), interval=60)
+    assert times.tolist() == [0, 60]
+    assert before.tolist() == [0, 1]
+    assert weight.tolist() == [0, 0]
+
+
+def test_linear_interpolation():
+    columns = track_columns(
+        [0, 120], POINT_X=[-122.0, -121.0], POINT_Y=[47.0, 47.6], SOG=[10.0, 20.0])
+    resampled = resample.Resampler(interval=30).resample(366000001, columns)
+    assert resampled['BaseDateTime'].tolist() == [0, 30, 60, 90, 120]
+    np.testing.assert_allclose(
+        resampled['POINT_X'], [-122.0, -121.75, -121.5, -121.25, -121.0])
+    np.testing.assert_allclose(
+        resampled['POINT_Y'], [47.0, 47.15, 47.3, 47.45, 47.6])
+    assert resampled['SOG'].tolist() == [10.0, 12.5, 15.0, 17.5, 20.0]
+    assert resampled['MMSI'].tolist() == [366000001] * 5
+
+
+def test_angles_take_shorter_arc():
+    columns = track_columns([0, 120], COG=[350.0, 10.0], Heading=[10.0, 350.0])
+    resampled = resample.Resampler(interval=30).resample(366000001, columns)
+    assert resampled['COG'].tolist() == [350.0, 355.0, 0.0, 5.0, 10.0]
+    assert resampled['Heading'].tolist() == [10.0, 5.0, 0.0, 355.0, 350.0]
+
+
+def test_unavailable_heading_is_null():
+    columns = track_columns([0, 120, 240], Heading=[511.0, 90.0, 100.0])
+    resampled = resample.Resampler(interval=60).resample(366000001, columns)
+    heading = resampled['Heading']
+    # Grid times next to the report of 511 have no heading
+    assert np.isnan(heading[:2]).all()
+    assert heading[2:].tolist() == [90.0, 95.0, 100.0]
+
+
+def test_long_gaps_are_not_interpolated():
+    columns = track_columns([0, 120, 1200, 1260], POINT_X=[0.0, 1.0, 2.0, 3.0])
+    resampler = resample.Resampler(interval=60, max_gap=300)
+    resampled = resampler.resample(366000001, columns)
+    assert resampled['BaseDateTime'].tolist() == [0, 60, 120, 1200, 1260]
+    assert resampled['POINT_X'].tolist() == [0.0, 0.5, 1.0, 2.0, 3.0]
+    assert resampler.stats == {'vessels': 1, 'rows_in': 4, 'rows_out': 5}
+
+
+def test_first_report_of_a_time_is_used():
+    columns = track_columns([60, 0, 60], SOG=[4.0, 2.0, 8.0])
+    resampled = resample.Resampler(interval=30).resample(366000001, columns)
+    assert resampled['SOG'].tolist() == [2.0, 3.0, 4.0]
+
+
+def write_vessel(filepath, mmsi, compression = None):
+    start = datetime(2014, 1, 1)
+    rows = [
+        (10.0, 90.0, 90.0, start + timedelta(seconds=150 * i), mmsi,
+         -122.5 + 0.001 * i, 47.25)
+        for i in range(5)]
+    filepath = export.output_path(filepath, compression)
+    export.write_csv(filepath, list(resample.FIELDS), rows, compression)
+    return filepath
+
+
+def test_file_mmsi():
+    assert resample.file_mmsi('366000001_eez.csv') == '366000001'
+    assert resample.file_mmsi('T366000001_eez.csv') == '366000001'
+    assert resample.file_mmsi('/a/b2/T366000001_eez.csv.gz') == '366000001'
+    assert resample.file_mmsi('T366000001_eez.txt') is None
+    assert resample.file_mmsi('Zone_eez.csv') is None
+
+
+def test_prefixed_files_are_resampled(tmpdir):
+    directory = tmpdir.mkdir('csv')
+    write_vessel(str(directory.join('T366000002_eez.csv')), 366000002)
+    write_vessel(str(directory.join('366000001_eez.csv')), 366000001)
+    write_vessel(str(directory.join('T366000003_eez.csv')), 366000003, 'gzip')
+    directory.join('notes.txt').write('')
+
+    filepaths = resample.vessel_files(str(directory))
+    assert [resample.file_mmsi(path) for path in filepaths] == [
+        '366000001', '366000002', '366000003']
+
+    output = str(tmpdir.join('resampled'))
+    stats = resample.resample_files(filepaths, output, processes=1)
+    assert stats['vessels'] == 3
+    assert sorted(os.listdir(output)) == [
+        '366000001_eez.csv', '366000002_eez.csv', '366000003_eez.csv']
+    assert [basename(path) for path in resample.vessel_files(output)] == sorted(
+        os.listdir(output))
+
+
+def read_csv(filepath):
+    with open(filepath) as f:
+        return list(csv.reader(f))
+
+
+def test_partitioned_output_matches_csv(tmpdir):
+    directory = tmpdir.mkdir('csv')
+    filepaths = [
+        write_vessel(str(directory.join('%d_eez.csv' % mmsi)), mmsi)
+        for mmsi in (366000002, 366000001)]
+
+    csv_output = str(tmpdir.join('csv_output'))
+    resample.resample_files(filepaths, csv_output, processes=1)
+    partitioned = str(tmpdir.join('partitioned'))
+    stats = resample.resample_files(
+        filepaths, partitioned, processes=1, output='partitioned', zone='10')
+    assert stats['vessels'] == 2
+
+    filepath = join(partitioned, 'Zone10_2014_01_eez.csv')
+    assert partition.read_index(filepath)['fields'] == list(resample.FIELDS)
+    for mmsi in (366000001, 366000002):
+        rows = read_csv(join(csv_output, '%d_eez.csv' % mmsi))
+        assert rows.pop(0) == list(resample.FIELDS)
+        # Reports every 150s over 600s give the grid times 0, 60, ... 600
+        assert len(rows) == 11
+        assert partition.read_vessel(filepath, mmsi) == rows
@@ -0,0 +1,133 @@
+'''
+Tests of ais_arcpy.track: timestamps are parsed from csv text with each date
+converted once, and tracks read from csv files and columns hold the compact
+dtypes with nulls as NaN, -1, or NULL_TIME.
+'''
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from ais_arcpy import export
+from ais_arcpy import track
+
+
+FIELDS = ['SOG', 'COG', 'Heading', 'BaseDateTime', 'Status', 'MMSI', 'POINT_X', 'POINT_Y']
+
+
+def seconds(text):
+    return int(np.datetime64(text, 's').astype('i8'))
+
+
+@pytest.fixture
+def dates():
+    '''
+    Empty the date cache for a test and restore it afterwards.
+    '''
+    saved = dict(track.DATES)
+    track.DATES.clear()
+    yield track.DATES
+    track.DATES.clear()
+    track.DATES.update(saved)
+
+
+def test_parse_times(dates):
+    values = [
+        '2014-01-01 00:00:00',
+        '2014-01-01 23:59:59',
+        '2016-02-29T12:30:15',
+        '2014-12-31 06:07:08.250000',
+        '',
+        '1969-12-31 23:59:59']
+    parsed = track.parse_times(values)
+    assert parsed.dtype == np.dtype('i8')
+    assert parsed.tolist() == [
+        seconds('2014-01-01T00:00:00'),
+        seconds('2014-01-01T23:59:59'),
+        seconds('2016-02-29T12:30:15'),
+        seconds('2014-12-31T06:07:08'),
+        track.NULL_TIME,
+        -1]
+    # Null timestamps are given the epoch date before they are masked
+    assert sorted(dates) == [19691231, 19700101, 20140101, 20141231, 20160229]
+
+
+def test_dates_are_cached(dates):
+    track.parse_times(['2014-01-01 00:00:00'])
+    assert dates[20140101] == seconds('2014-01-01T00:00:00')
+
+    # A cached date is not converted again
+    dates[20140101] = 0
+    assert track.parse_times(['2014-01-01 00:00:10']).tolist() == [10]
+
+
+def test_other_formats_fall_back():
+    parsed = track.parse_times(['2014-01-01 00:01', '2014-01-02'])
+    assert parsed.tolist() == [
+        seconds('2014-01-01T00:01:00'), seconds('2014-01-02T00:00:00')]
+
+
+def test_to_seconds():
+    expected = [seconds('2014-01-01T00:00:05'), seconds('2014-01-01T00:00:06')]
+    times = np.array(['2014-01-01T00:00:05', '2014-01-01T00:00:06'], dtype='M8[us]')
+    assert track.to_seconds(times).tolist() == expected
+    assert track.to_seconds(times.tolist()).tolist() == expected
+    assert track.to_seconds(['2014-01-01 00:00:05', '2014-01-01 00:00:06']).tolist() == expected
+
+
+def write_rows(filepath, compression = None):
+    rows = [
+        (10.5, 90.0, 511.0, datetime(2014, 1, 1, 0, 0, i), 0, 366000001,
+         -122.5 + i, 47.25)
+        for i in range(7)]
+    rows[2] = (None,) + rows[2][1:4] + (None,) + rows[2][5:]
+    filepath = export.output_path(filepath, compression)
+    export.write_csv(filepath, FIELDS, rows, compression)
+    return filepath, rows
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_from_csv(tmpdir, compression):
+    filepath, rows = write_rows(str(tmpdir.join('366000001_eez.csv')), compression)
+    points = track.Track.from_csv(filepath, chunk_size=3)
+
+    assert len(points) == len(rows)
+    assert points.fields == FIELDS
+    assert points.mmsi == 366000001
+    assert points['SOG'].dtype == np.dtype('f4')
+    assert points['Status'].dtype == np.dtype('i1')
+    assert points['BaseDateTime'].dtype == np.dtype('i8')
+    assert points['POINT_X'].dtype == np.dtype('f8')
+    assert np.isnan(points['SOG'][2])
+    assert points['Status'][2] == -1
+    assert points['POINT_X'].tolist() == [row[6] for row in rows]
+    assert points.times.astype(datetime).tolist() == [row[3] for row in rows]
+
+
+def test_from_csv_selects_fields(tmpdir):
+    filepath, rows = write_rows(str(tmpdir.join('366000001_eez.csv')))
+    points = track.Track.from_csv(filepath, ['MMSI', 'BaseDateTime'])
+    assert points.fields == ['MMSI', 'BaseDateTime']
+    assert points['MMSI'].tolist() == [366000001] * len(rows)
+
+
+def test_from_columns_round_trip():
+    times = np.array(
+        ['2014-01-01T00:00:10', 'NaT', '2014-01-01T00:00:05'], dtype='M8[us]')
+    columns = {
+        'BaseDateTime': times,
+        'SOG': [1.0, None, 3.0],
+        'MMSI': [366000001, 366000001, 366000001],
+        'Extra': ['a', 'b', 'c']}
+    points = track.Track.from_columns(columns, ['MMSI', 'BaseDateTime', 'SOG', 'Extra'])
+
+    assert points['BaseDateTime'][1] == track.NULL_TIME
+    assert points['SOG'].dtype == np.dtype('f4')
+    assert np.isnan(points['SOG'][1])
+    assert points['Extra'].tolist() == ['a', 'b', 'c']
+
+    ordered = points.take([0, 2]).sort()
+    assert ordered['SOG'].tolist() == [3.0, 1.0]
+    rows = ordered.to_rows(['BaseDateTime', 'SOG'])
+    assert rows[0][0] == datetime(2014, 1, 1, 0, 0, 5)
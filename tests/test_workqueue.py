@@ -0,0 +1,159 @@
+'''
+Tests of ais_arcpy.workqueue with several local worker processes and a
+runner that records when each unit starts and ends instead of running it.
+'''
+
+import multiprocessing
+import os
+from os.path import join
+import threading
+import time
+
+import pytest
+
+from ais_arcpy import workqueue
+
+
+PROCESSES = 4
+TIMEOUT = 60
+
+
+def record_unit(directory, unit, month_options, mmsi_options):
+    '''
+    Runner that appends the start and end of a unit to a log file.
+    '''
+    log = join(directory, 'log')
+    with open(log, 'a') as f:
+        f.write('start %s %.6f\n' % (unit['id'], time.time()))
+    time.sleep(0.01)
+    if unit['id'] in month_options.get('fail', ()):
+        raise RuntimeError('Failed %s' % unit['id'])
+    with open(log, 'a') as f:
+        f.write('end %s %.6f\n' % (unit['id'], time.time()))
+
+
+def run(queue_directory, **options):
+    '''
+    Run workers on a queue, failing the test instead of hanging if they do
+    not finish.
+    '''
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(workqueue.run_workers(
+        queue_directory, PROCESSES, runner=record_unit, poll=0.02,
+        heartbeat=0.05, **options)))
+    thread.daemon = True
+    thread.start()
+    thread.join(TIMEOUT)
+    if thread.is_alive():
+        for child in multiprocessing.active_children():
+            child.terminate()
+        pytest.fail('Workers did not finish: %s' % workqueue.WorkQueue(
+            queue_directory).summary())
+    return result
+
+
+def read_log(directory):
+    '''
+    Return the start and end events of the log as (event, unit, time).
+    '''
+    with open(join(directory, 'log')) as f:
+        return [(e, uid, float(t)) for e, uid, t in (line.split() for line in f)]
+
+
+def check_order(queue, events):
+    '''
+    Check every unit started after the units it depends on ended.
+    '''
+    starts = dict((uid, t) for e, uid, t in events if e == 'start')
+    ends = dict((uid, t) for e, uid, t in events if e == 'end')
+    for unit in queue.load():
+        for other in unit['after']:
+            if unit['id'] in starts:
+                assert ends[other] <= starts[unit['id']], (unit['id'], other)
+
+
+@pytest.fixture
+def folders(tmpdir):
+    data = str(tmpdir.mkdir('data'))
+    return str(tmpdir.join('queue')), data
+
+
+def test_units_run_once_in_order(folders):
+    queue_directory, data = folders
+    queue = workqueue.WorkQueue(queue_directory)
+    queue.submit(data, ['10', '11'], ['2014'], ['01', '02', '03'])
+
+    summary = run(queue_directory)
+    assert summary['done'] == 2 * (2 * 3 + 1)
+    events = read_log(data)
+    started = [uid for e, uid, _ in events if e == 'start']
+    assert sorted(started) == sorted(set(started))
+    assert len(started) == summary['done']
+    check_order(queue, events)
+
+    # The MMSI pass of each zone and year runs after all of its months
+    for zone in ('10', '11'):
+        position = started.index('mmsi-%s-2014' % zone)
+        assert all(
+            started.index(uid) < position for uid in started
+            if uid.startswith(('month-%s-' % zone, 'merge-%s-' % zone)))
+    assert os.listdir(join(queue_directory, 'leases')) == []
+
+
+def test_failed_unit_blocks_dependants(folders):
+    queue_directory, data = folders
+    queue = workqueue.WorkQueue(queue_directory)
+    queue.submit(data, ['10'], ['2014'], ['01', '02'])
+
+    summary = run(queue_directory, month_options={'fail': ['month-10-2014-02']})
+    assert summary['failed'] == 1
+    assert summary['blocked'] == 2
+    started = [uid for e, uid, _ in read_log(data) if e == 'start']
+    assert started.count('month-10-2014-02') == workqueue.MAX_ATTEMPTS
+    assert 'mmsi-10-2014' not in started
+
+
+def test_resubmit_before_running(folders):
+    queue_directory, data = folders
+    queue = workqueue.WorkQueue(queue_directory)
+    queue.submit(data, ['10'], ['2014'], ['01'])
+    assert queue.submit(data, ['10'], ['2014'], ['01', '02']) == 2
+
+    summary = run(queue_directory)
+    assert summary['done'] == 5
+    events = read_log(data)
+    check_order(queue, events)
+    started = [uid for e, uid, _ in events if e == 'start']
+    assert started[-1] == 'mmsi-10-2014'
+
+
+def test_resubmit_after_running(folders):
+    queue_directory, data = folders
+    queue = workqueue.WorkQueue(queue_directory)
+    queue.submit(data, ['10'], ['2014'], ['01'])
+    assert run(queue_directory)['done'] == 3
+
+    queue.submit(data, ['10'], ['2014'], ['01', '02'])
+    assert queue.states()['mmsi-10-2014'] == 'waiting'
+    summary = run(queue_directory)
+    assert summary['done'] == 5
+    started = [uid for e, uid, _ in read_log(data) if e == 'start']
+    assert started.count('month-10-2014-01') == 1
+    assert started.count('mmsi-10-2014') == 2
+    assert started[-1] == 'mmsi-10-2014'
+
+
+def test_expired_lease_is_taken_over(folders):
+    queue_directory, data = folders
+    queue = workqueue.WorkQueue(queue_directory, ttl=1)
+    queue.submit(data, ['10'], ['2014'], ['01'])
+
+    unit, first = queue.claim('a')
+    assert queue.claim('b') is None
+    past = time.time() - 5
+    os.utime(first.path, (past, past))
+    taken, second = queue.claim('b')
+    assert taken['id'] == unit['id']
+    assert second.generation == first.generation + 1
+    assert not queue.renew(first)
+    assert queue.renew(second)
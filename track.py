@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.track
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: compact array-backed vessel tracks
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import csv
+import gzip
+import io
+import itertools
+import logging
+import sys
+
+import numpy as np
+
+from . import export
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+# Compact dtype of each field; BaseDateTime is held as seconds since the epoch
+FIELDS = (
+    ('SOG', 'f4'),
+    ('COG', 'f4'),
+    ('Heading', 'f4'),
+    ('ROT', 'f4'),
+    ('BaseDateTime', 'i8'),
+    ('Status', 'i1'),
+    ('VoyageID', 'i4'),
+    ('MMSI', 'i4'),
+    ('ReceiverType', 'i1'),
+    ('POINT_X', 'f8'),
+    ('POINT_Y', 'f8'))
+
+TIME_FIELD = 'BaseDateTime'
+
+# Missing timestamps have the integer value of NaT
+NULL_TIME = np.iinfo(np.int64).min
+
+CHUNK_SIZE = 100000
+
+# Seconds since the epoch of each date seen, keyed by YYYYMMDD
+DATES = {}
+
+# Byte offsets of YYYY-MM-DD HH:MM:SS
+DIGITS = {
+    'year': (0, 1, 2, 3),
+    'month': (5, 6),
+    'day': (8, 9),
+    'hour': (11, 12),
+    'minute': (14, 15),
+    'second': (17, 18)}
+SEPARATORS = ((4, b'-'), (7, b'-'), (13, b':'), (16, b':'))
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def field_dtype(name):
+    '''
+    Return the compact dtype of a field, or None for fields kept as given.
+    '''
+    return dict(FIELDS).get(name)
+
+def null_value(dtype):
+    '''
+    Return the value that stands for a null in a column of a dtype.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind in 'iu':
+        return -1
+    return None
+
+def to_array(values, dtype):
+    '''
+    Convert a sequence of values to a typed column. Nulls, as None or empty
+    strings, are replaced with NaN or -1.
+    '''
+    try:
+        return np.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        values = np.array(values, dtype=object)
+        null = np.array([v is None or v == '' for v in values], dtype=bool)
+        values[null] = null_value(dtype)
+        return values.astype(dtype)
+
+def date_seconds(keys):
+    '''
+    Return the seconds since the epoch at the start of each YYYYMMDD key.
+    Each distinct date is converted once and cached.
+    '''
+    unique, inverse = np.unique(keys, return_inverse=True)
+    missing = [int(key) for key in unique if int(key) not in DATES]
+    if missing:
+        dates = np.array(
+            ['%04d-%02d-%02d' % (k // 10000, k // 100 % 100, k % 100) for k in missing],
+            dtype='M8[D]')
+        DATES.update(zip(missing, (dates.astype('i8') * 86400).tolist()))
+    seconds = np.array([DATES[int(key)] for key in unique], dtype='i8')
+    return seconds[inverse]
+
+def parse_times(values):
+    '''
+    Parse timestamps written as YYYY-MM-DD HH:MM:SS, with a space or T and
+    optional fractional seconds, into seconds since the epoch. The digits of
+    every string are decoded at once from a byte matrix, and each distinct
+    date is converted once. Other formats fall back to NumPy's parser.
+
+    :param values: Timestamp strings, empty for null
+    :type values: sequence of strings
+
+    :return: Seconds since the epoch, NULL_TIME for null
+    :rtype: numpy.ndarray
+    '''
+    if len(values) == 0:
+        return np.empty(0, dtype='i8')
+    text = np.array(values).astype('S19')
+    null = text == b''
+    matrix = np.frombuffer(text.tobytes(), dtype='u1').reshape(len(text), 19)
+    valid = matrix[~null]
+    if not all((valid[:, i] == ord(c)).all() for i, c in SEPARATORS) or not (
+            (valid[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]] - 48) < 10).all():
+        times = np.array(
+            [v if v else 'NaT' for v in np.array(values).astype(str)], dtype='M8[s]')
+        return times.astype('i8')
+
+    digits = matrix.astype('i8') - 48
+    number = lambda part: sum(
+        digits[:, i] * 10 ** (len(DIGITS[part]) - 1 - n)
+        for n, i in enumerate(DIGITS[part]))
+    keys = number('year') * 10000 + number('month') * 100 + number('day')
+    keys[null] = 19700101
+    seconds = date_seconds(keys) + (
+        number('hour') * 3600 + number('minute') * 60 + number('second'))
+    seconds[null] = NULL_TIME
+    return seconds
+
+def to_seconds(values):
+    '''
+    Convert datetimes, NumPy datetime64, or strings to seconds since the
+    epoch, NULL_TIME for null.
+    '''
+    if not isinstance(values, (list, tuple)):
+        values = np.asarray(values)
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'M':
+        return values.astype('M8[s]').astype('i8')
+    if len(values) and isinstance(values[0], (str, bytes)):
+        return parse_times(values)
+    return np.array(values, dtype='M8[us]').astype('M8[s]').astype('i8')
+
+def open_csv(filepath):
+    '''
+    Open a csv file written by ais_arcpy.export for reading as text,
+    decompressing .gz and .xz files.
+    '''
+    if filepath.endswith('.gz'):
+        f = gzip.open(filepath, 'rb')
+    elif filepath.endswith('.xz'):
+        f = export.lzma.LZMAFile(filepath, 'rb')
+    else:
+        f = open(filepath, 'rb')
+    if sys.version_info[0] < 3:
+        return f
+    return io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+
+# ------------------------------------------------------------------------------
+# TRACK
+# ------------------------------------------------------------------------------
+class Track(object):
+
+    '''
+    One vessel's points held as one typed array per field instead of a
+    tuple per point. BaseDateTime is stored as int64 seconds since the
+    epoch, kinematic fields as float32, coordinates as float64, and Status
+    and ReceiverType as int8, see FIELDS. Fields not in FIELDS keep the
+    dtype they are loaded with. Nulls are NaN, -1, or NULL_TIME.
+    '''
+
+    def __init__(self, columns, fields = None):
+        self.fields = list(fields or columns.keys())
+        self.columns = dict((name, columns[name]) for name in self.fields)
+
+    def __len__(self):
+        if not self.fields:
+            return 0
+        return len(self.columns[self.fields[0]])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def nbytes(self):
+        '''
+        Return the bytes held by the columns.
+        '''
+        return sum(column.nbytes for column in self.columns.values())
+
+    @property
+    def times(self):
+        '''
+        Return BaseDateTime as NumPy datetime64 seconds.
+        '''
+        return self.columns[TIME_FIELD].view('M8[s]')
+
+    @property
+    def mmsi(self):
+        '''
+        Return the MMSI of the track, or None if it is empty.
+        '''
+        if 'MMSI' not in self.columns or not len(self):
+            return None
+        return int(self.columns['MMSI'][0])
+
+    def take(self, index):
+        '''
+        Return a track of the points selected by a slice, mask, or index
+        array.
+        '''
+        return Track(
+            dict((name, self.columns[name][index]) for name in self.fields),
+            self.fields)
+
+    def sort(self):
+        '''
+        Return the track stable sorted by time.
+        '''
+        times = self.columns[TIME_FIELD]
+        if len(times) < 2 or (times[1:] >= times[:-1]).all():
+            return self
+        return self.take(np.argsort(times, kind='mergesort'))
+
+    def to_rows(self, fields = None):
+        '''
+        Return the points as a list of tuples, with BaseDateTime as datetime,
+        in the layout read by SearchCursor.
+        '''
+        columns = dict(self.columns)
+        columns[TIME_FIELD] = self.times
+        return export.column_rows(columns, fields or self.fields)
+
+    @classmethod
+    def from_columns(cls, columns, fields = None):
+        '''
+        Create a track from a dictionary of columns, such as the columns read
+        from the MMSI store, converting each field to its compact dtype.
+        '''
+        fields = list(fields or columns.keys())
+        converted = {}
+        for name in fields:
+            dtype = field_dtype(name)
+            if name == TIME_FIELD:
+                converted[name] = to_seconds(columns[name])
+            elif dtype is None:
+                converted[name] = np.asarray(columns[name])
+            else:
+                converted[name] = to_array(columns[name], dtype)
+        return cls(converted, fields)
+
+    @classmethod
+    def from_rows(cls, rows, fields):
+        '''
+        Create a track from rows of values, such as the tuples returned by
+        SearchCursor or parsed from a csv file.
+
+        :param rows: Rows of field values
+        :param fields: Field names of the rows
+
+        :type rows: list of sequences
+        :type fields: list of strings
+
+        :return: Track
+        :rtype: Track
+        '''
+        if not rows:
+            return cls(dict(
+                (name, np.empty(0, dtype=field_dtype(name) or 'O'))
+                for name in fields), fields)
+        columns = dict(zip(fields, (list(c) for c in zip(*rows))))
+        return cls.from_columns(columns, fields)
+
+    @classmethod
+    def concatenate(cls, tracks, fields = None):
+        '''
+        Join tracks with the same fields end to end.
+        '''
+        fields = fields or tracks[0].fields
+        return cls(
+            dict((name, np.concatenate([t[name] for t in tracks])) for name in fields),
+            fields)
+
+    @classmethod
+    def from_cursor(cls, fc, fields, where_clause = None,
+                    chunk_size = CHUNK_SIZE):
+        '''
+        Read a feature class with SearchCursor in chunks, so at most
+        chunk_size tuples are held at once.
+
+        :param fc: Path of the feature class
+        :param fields: Fields to read
+        :param where_clause: SQL expression selecting the rows
+
+        :type fc: string
+        :type fields: list of strings
+        :type where_clause: string
+
+        :return: Track
+        :rtype: Track
+        '''
+        import arcpy
+
+        chunks = []
+        with arcpy.da.SearchCursor(fc, fields, where_clause) as cursor:
+            while True:
+                rows = list(itertools.islice(cursor, chunk_size))
+                if not rows:
+                    break
+                chunks.append(cls.from_rows(rows, fields))
+        if not chunks:
+            return cls.from_rows([], fields)
+        return cls.concatenate(chunks, fields)
+
+    @classmethod
+    def from_csv(cls, filepath, fields = None, chunk_size = CHUNK_SIZE):
+        '''
+        Read a csv file written by Raw_MMSI, compressed or not, in chunks of
+        rows. Timestamps are parsed with parse_times.
+
+        :param filepath: Path of the csv file
+        :param fields: Fields to keep, default is all fields
+
+        :type filepath: string
+        :type fields: list of strings
+
+        :return: Track
+        :rtype: Track
+        '''
+        chunks = []
+        with open_csv(filepath) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            fields = list(fields or header)
+            positions = [header.index(name) for name in fields]
+            while True:
+                rows = list(itertools.islice(reader, chunk_size))
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                chunks.append(cls.from_columns(
+                    dict((name, columns[i]) for name, i in zip(fields, positions)),
+                    fields))
+        if not chunks:
+            return cls.from_rows([], fields)
+        return cls.concatenate(chunks, fields)
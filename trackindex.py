@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.trackindex
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: per-vessel, per-day extents for spatio-temporal queries
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import contextlib
+import logging
+import os
+from os.path import dirname, exists
+import sqlite3
+
+import numpy as np
+
+from . import split
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS days (
+    mmsi INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    xmin REAL,
+    ymin REAL,
+    xmax REAL,
+    ymax REAL,
+    tmin INTEGER NOT NULL,
+    tmax INTEGER NOT NULL,
+    row_start INTEGER,
+    row_stop INTEGER,
+    rows INTEGER NOT NULL,
+    PRIMARY KEY (mmsi, month, day));
+CREATE INDEX IF NOT EXISTS days_day ON days (day);
+'''
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def to_seconds(value):
+    '''
+    Return a datetime, NumPy datetime64, or ISO date string as seconds since
+    the epoch, or None.
+    '''
+    if value is None:
+        return None
+    return int(np.datetime64(value, 's').astype('i8'))
+
+def day_extents(times, x, y):
+    '''
+    Return the bounding box, time range, and covering row range of each day
+    of a vessel's records.
+
+    :param times: Timestamps in seconds since the epoch
+    :param x: Longitudes
+    :param y: Latitudes
+
+    :type times: numpy.ndarray
+    :type x: numpy.ndarray
+    :type y: numpy.ndarray
+
+    :return: Columns day, xmin, ymin, xmax, ymax, tmin, tmax, row_start,
+        row_stop, and rows
+    :rtype: dict
+    '''
+    times = np.asarray(times, dtype='i8')
+    day = times // DAY
+    order = np.argsort(day, kind='mergesort')
+    days, starts, stops = split.group_bounds(day[order])
+    x = np.asarray(x, dtype='f8')[order]
+    y = np.asarray(y, dtype='f8')[order]
+    rows = np.arange(len(times))[order]
+    return {
+        'day': days,
+        'xmin': np.fmin.reduceat(x, starts),
+        'ymin': np.fmin.reduceat(y, starts),
+        'xmax': np.fmax.reduceat(x, starts),
+        'ymax': np.fmax.reduceat(y, starts),
+        'tmin': np.minimum.reduceat(times[order], starts),
+        'tmax': np.maximum.reduceat(times[order], starts),
+        'row_start': np.minimum.reduceat(rows, starts),
+        'row_stop': np.maximum.reduceat(rows, starts) + 1,
+        'rows': stops - starts}
+
+def merge_ranges(ranges):
+    '''
+    Merge overlapping and adjacent [start, stop) row ranges.
+    '''
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+# ------------------------------------------------------------------------------
+# INDEX
+# ------------------------------------------------------------------------------
+class TrackIndex(object):
+
+    '''
+    SQLite index of the bounding box and time range of each vessel on each
+    day, built while months are aggregated.
+
+    For the MMSI store, each day also records the range of rows of the
+    vessel's data that covers it, so a query returns the rows to read. For
+    the MMSI gdb the row range is not known and only the vessel is returned.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if not exists(dirname(self.filepath)):
+            os.makedirs(dirname(self.filepath))
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        '''
+        Open a connection to the index for one transaction. Connections are
+        not kept on the instance so it can be passed to worker processes.
+        '''
+        db = sqlite3.connect(self.filepath, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, mmsi, month, times, x, y, offset = None):
+        '''
+        Index one month of a vessel's records, replacing any earlier entries
+        for the month.
+
+        :param mmsi: Vessel identifier
+        :param month: Month of the records
+        :param times: Timestamps as NumPy datetime64
+        :param x: Longitudes
+        :param y: Latitudes
+        :param offset: Row of the vessel's data where the month starts, None
+            if rows cannot be addressed
+
+        :type mmsi: int
+        :type month: string
+        :type times: numpy.ndarray
+        :type x: numpy.ndarray
+        :type y: numpy.ndarray
+        :type offset: int
+        '''
+        if len(times) == 0:
+            return
+        seconds = np.asarray(times).astype('M8[s]').astype('i8')
+        extents = day_extents(seconds, x, y)
+        if offset is None:
+            row_start = row_stop = [None] * len(extents['day'])
+        else:
+            row_start = (extents['row_start'] + offset).tolist()
+            row_stop = (extents['row_stop'] + offset).tolist()
+        records = zip(
+            [int(mmsi)] * len(extents['day']),
+            [month] * len(extents['day']),
+            extents['day'].tolist(),
+            extents['xmin'].tolist(),
+            extents['ymin'].tolist(),
+            extents['xmax'].tolist(),
+            extents['ymax'].tolist(),
+            extents['tmin'].tolist(),
+            extents['tmax'].tolist(),
+            row_start,
+            row_stop,
+            extents['rows'].tolist())
+        with self.connect() as db:
+            db.execute(
+                'DELETE FROM days WHERE mmsi = ? AND month = ?', (int(mmsi), month))
+            db.executemany(
+                'INSERT INTO days VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                records)
+
+    def add_array(self, mmsi, month, array, offset = None):
+        '''
+        Index one month of a vessel's records from a record array with
+        BaseDateTime, POINT_X, and POINT_Y fields.
+        '''
+        self.add(
+            mmsi, month, array['BaseDateTime'], array['POINT_X'],
+            array['POINT_Y'], offset)
+
+    def search(self, bbox = None, start = None, end = None):
+        '''
+        Return the days of each vessel whose extent intersects a bounding box
+        and time window.
+
+        :param bbox: xmin, ymin, xmax, ymax, or None for any place
+        :param start: Start of the window, or None
+        :param end: End of the window, or None
+
+        :type bbox: tuple of floats
+        :type start: datetime or string
+        :type end: datetime or string
+
+        :return: Rows of mmsi, day, tmin, tmax, row_start, row_stop, rows
+        :rtype: list of tuples
+        '''
+        where = []
+        params = []
+        start, end = to_seconds(start), to_seconds(end)
+        if start is not None:
+            where.append('day >= ? AND tmax >= ?')
+            params.extend([start // DAY, start])
+        if end is not None:
+            where.append('day <= ? AND tmin <= ?')
+            params.extend([end // DAY, end])
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            where.append('xmax >= ? AND xmin <= ? AND ymax >= ? AND ymin <= ?')
+            params.extend([xmin, xmax, ymin, ymax])
+        sql = (
+            'SELECT mmsi, day, tmin, tmax, row_start, row_stop, rows FROM days'
+            + (' WHERE ' + ' AND '.join(where) if where else '')
+            + ' ORDER BY mmsi, row_start')
+        with self.connect() as db:
+            return db.execute(sql, params).fetchall()
+
+    def query(self, bbox = None, start = None, end = None):
+        '''
+        Return the vessels that may have been in a bounding box during a time
+        window, with the ranges of their rows to read. Every matching record
+        is within the ranges, but the ranges may hold other records too.
+
+        :param bbox: xmin, ymin, xmax, ymax, or None for any place
+        :param start: Start of the window, or None
+        :param end: End of the window, or None
+
+        :type bbox: tuple of floats
+        :type start: datetime or string
+        :type end: datetime or string
+
+        :return: Dictionary of MMSI to [start, stop) row ranges, or None if
+            the rows of the vessel cannot be addressed
+        :rtype: dict
+        '''
+        matches = {}
+        for mmsi, _, _, _, row_start, row_stop, _ in self.search(bbox, start, end):
+            ranges = matches.setdefault(mmsi, [])
+            if ranges is not None:
+                if row_start is None:
+                    matches[mmsi] = None
+                else:
+                    ranges.append((row_start, row_stop))
+        for mmsi, ranges in matches.items():
+            if ranges is not None:
+                matches[mmsi] = merge_ranges(ranges)
+        return matches
+
+    def read(self, mmsi_store, bbox = None, start = None, end = None,
+             fields = None):
+        '''
+        Read the records in a bounding box and time window from the MMSI
+        store, reading only the row ranges returned by query.
+
+        :param mmsi_store: Store the index was built for
+        :param bbox: xmin, ymin, xmax, ymax, or None for any place
+        :param start: Start of the window, or None
+        :param end: End of the window, or None
+        :param fields: Fields to read, default is all fields
+
+        :type mmsi_store: ais_arcpy.store.MMSIStore
+        :type bbox: tuple of floats
+        :type start: datetime or string
+        :type end: datetime or string
+        :type fields: list of strings
+
+        :return: Generator of MMSI and dictionary of columns
+        :rtype: generator
+        '''
+        fields = list(fields or mmsi_store.fields)
+        names = fields + [
+            f for f in ('BaseDateTime', 'POINT_X', 'POINT_Y') if f not in fields]
+        start, end = to_seconds(start), to_seconds(end)
+        for mmsi, ranges in sorted(self.query(bbox, start, end).items()):
+            columns = mmsi_store.read(mmsi, names)
+            if ranges is None:
+                ranges = [[0, mmsi_store.count(mmsi)]]
+            rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+            selected = dict((name, np.asarray(columns[name][rows])) for name in names)
+
+            keep = np.ones(len(rows), dtype=bool)
+            seconds = selected['BaseDateTime'].astype('M8[s]').astype('i8')
+            if start is not None:
+                keep &= seconds >= start
+            if end is not None:
+                keep &= seconds <= end
+            if bbox is not None:
+                x, y = selected['POINT_X'], selected['POINT_Y']
+                keep &= (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+            if keep.any():
+                yield mmsi, dict((name, selected[name][keep]) for name in fields)
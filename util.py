@@ -13,16 +13,20 @@
 # ------------------------------------------------------------------------------
 # IMPORTS
 # ------------------------------------------------------------------------------
-import certifi
 import ctypes
 import datetime
+import hashlib
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-from os.path import abspath, exists, join
-import pycurl
+from os.path import abspath, dirname, exists, getsize, join
 import re
+import shutil
+import time
 import zipfile
 
+from . import metrics
+
 
 # ------------------------------------------------------------------------------
 # PARAMETERS
@@ -30,6 +34,7 @@ import zipfile
 logger = logging.getLogger(__name__)
 
 now = datetime.datetime.now()
+zipBufferSize = 16 * 1024 * 1024
 sf = '%(asctime)s - %(levelname)s - line %(lineno)d - %(funcName)s - %(message)s'
 stdFormatter = logging.Formatter(sf, datefmt = '%Y-%m-%d %H.%M.%S')
 
@@ -50,9 +55,12 @@ class fileNotFound(Exception):
 # ------------------------------------------------------------------------------
 # WEB
 # ------------------------------------------------------------------------------
+@metrics.measure('util.download_url')
 def download_url(url, destination, fileExtension = '.xls'):
     '''
-    Write url to temp file.
+    Write url to temp file. The temp file name is unique to the URL, and an
+    interrupted download is resumed (see ais_arcpy.download).
+
     :param url: URL to download data from
     :param destination: Path to download data to
     :param fileExtension: extension to use for temp file
@@ -63,14 +71,12 @@ def download_url(url, destination, fileExtension = '.xls'):
     :return: Path to temp file containing URL data
     :rtype: string
     '''
-    tempFile = join(destination, 'temp_data' + fileExtension)
-    with open(tempFile, 'wb') as f:
-        c = pycurl.Curl()
-        c.setopt(c.URL, url)
-        c.setopt(pycurl.CAINFO, certifi.where())
-        c.setopt(c.WRITEDATA, f)
-        c.perform()
-        c.close()
+    from . import download
+
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    tempFile = join(destination, 'temp_data_' + digest + fileExtension)
+    download.fetch(url, tempFile)
+    metrics.update(bytes_written=getsize(tempFile))
     logger.info('Downloaded file to %s.', tempFile)
     return tempFile
 
@@ -116,16 +122,26 @@ def add_handler(logger, level, formatter, filepath):
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-def initialize_logger(directory, level = logging.DEBUG):
+def initialize_logger(directory, level = logging.DEBUG, report = False,
+                      prometheus = False):
     '''
     Creates a logger with one file handler. The file is saved to the directory
     provided. The standard formatter is used and the default level is DEBUG.
 
+    If report is True, stage timings are recorded (see ais_arcpy.metrics) and
+    a JSON run report with the same name as the log file is written when the
+    logger is closed, together with a Prometheus textfile if prometheus is
+    True.
+
     :param directory: Directory to save log file to
     :param level: Logging level, default is DEBUG
+    :param report: Record stages and write a run report
+    :param prometheus: Also write the stage totals as a Prometheus textfile
 
     :type directory: string
     :type level: Logging level
+    :type report: bool
+    :type prometheus: bool
 
     :return: Log object to use for logging within script
     :rtype: Logging logger
@@ -139,17 +155,21 @@ def initialize_logger(directory, level = logging.DEBUG):
     name = 'log '+ now.strftime('%Y-%m-%d %H.%M.%S') + '.log'
     filepath = join(directory, name)
     add_handler(logger, level, stdFormatter, filepath)
+    if report:
+        metrics.start(filepath[:-len('.log')], prometheus)
 
     logger.info('********** Script began at %s **********', str(now))
     return logger
 
 def close_logger(logger):
     '''
-    Removes the handlers from and closes the logger.
+    Removes the handlers from and closes the logger, after writing the run
+    report if one is being recorded.
 
     :param logger: Logger to close
     :type logger: Logging logger
     '''
+    metrics.finish()
     logger.info('********** Script ended at %s **********', str(now))
     for handler in logger.handlers:
         handler.close()
@@ -183,6 +203,24 @@ def create_folder(parent, name):
                 raise err
     return folder
 
+def replace_file(source, destination):
+    '''
+    Rename source to destination, replacing destination if it exists. The
+    rename is atomic where the platform supports it.
+
+    :param source: Path of the file to rename
+    :param destination: Path to rename the file to
+
+    :type source: string
+    :type destination: string
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+        return
+    if exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
 def find_file(directory, filename):
     '''
     Search for a filename in the directory and return the full path. The
@@ -211,6 +249,7 @@ def find_file(directory, filename):
 # ------------------------------------------------------------------------------
 # ZIP FILES
 # ------------------------------------------------------------------------------
+@metrics.measure('util.extract_zip')
 def extract_zip(filepath, destination):
     '''
     Extract zip file to the destination and return list of filenames contained
@@ -229,8 +268,119 @@ def extract_zip(filepath, destination):
     zfile.printdir()
     zfile.extractall(destination)
     zfile.close()
+    metrics.update(
+        bytes_read=getsize(filepath),
+        bytes_written=sum(info.file_size for info in zfile.infolist()))
     return zfile.namelist()
 
+def extract_member(filepath, destination, name, bufferSize = zipBufferSize):
+    '''
+    Stream-decompress one member of a zip file to the destination and return
+    the number of bytes written. Each call opens its own handle on the zip
+    file so members can be extracted on several threads.
+
+    :param filepath: Filepath to the zip file
+    :param destination: Location for the member to be extracted to
+    :param name: Name of the member within the archive
+    :param bufferSize: Size of the copy buffer in bytes
+
+    :type filepath: string
+    :type destination: string
+    :type name: string
+    :type bufferSize: int
+
+    :return: Number of bytes written
+    :rtype: int
+    '''
+    target = join(destination, *name.split('/'))
+    folder = dirname(target)
+    if not exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not exists(folder):
+                raise
+    zfile = zipfile.ZipFile(filepath, 'r')
+    try:
+        with zfile.open(name) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, bufferSize)
+    finally:
+        zfile.close()
+    return zfile.getinfo(name).file_size
+
+@metrics.measure('util.extract_selected')
+def extract_selected(filepath, destination, memberFilter = None, threads = 1,
+                     bufferSize = zipBufferSize):
+    '''
+    Extract only the members of a zip file accepted by the filter, without
+    printing the directory. Members are stream-decompressed with a large
+    buffer, on a pool of threads if threads is greater than one. Members
+    with absolute paths or '..' components are skipped.
+
+    :param filepath: Filepath to the zip file
+    :param destination: Location for the archive files to be extracted to
+    :param memberFilter: Function of the member name, or a regular
+        expression searched for in it; None extracts every member
+    :param threads: Number of extraction threads
+    :param bufferSize: Size of the copy buffer in bytes
+
+    :type filepath: string
+    :type destination: string
+    :type memberFilter: function or string
+    :type threads: int
+    :type bufferSize: int
+
+    :return: Extracted names, files, bytes written, compressed bytes read,
+        skipped files and seconds taken
+    :rtype: dict
+    '''
+    if memberFilter is None:
+        accept = lambda name: True
+    elif callable(memberFilter):
+        accept = memberFilter
+    else:
+        accept = re.compile(memberFilter).search
+
+    start = time.time()
+    zfile = zipfile.ZipFile(filepath, 'r')
+    infos = zfile.infolist()
+    zfile.close()
+
+    members = []
+    for info in infos:
+        name = info.filename
+        parts = name.split('/')
+        if name.endswith('/') or name.startswith('/') or '..' in parts:
+            continue
+        if accept(name):
+            members.append(info)
+
+    names = [info.filename for info in members]
+    extract = lambda name: extract_member(filepath, destination, name, bufferSize)
+    if threads > 1 and len(names) > 1:
+        pool = ThreadPool(threads)
+        try:
+            written = pool.map(extract, names)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        written = [extract(name) for name in names]
+
+    stats = {
+        'names': names,
+        'files': len(names),
+        'bytes': sum(written),
+        'compressed': sum(info.compress_size for info in members),
+        'skipped': len(infos) - len(names),
+        'seconds': time.time() - start}
+    metrics.update(bytes_read=stats['compressed'], bytes_written=stats['bytes'])
+    logger.info(
+        'Extracted %d files (%d bytes, %d skipped) from %s in %.1fs.',
+        stats['files'], stats['bytes'], stats['skipped'], filepath,
+        stats['seconds'])
+    return stats
+
 def extract_file(filepath, destination):
     '''
     Return the path to the first file extracted from a zip file.
@@ -0,0 +1,765 @@
+#!/usr/bin/env python
+'''
+.. module:: ais_arcpy.workqueue
+    :language: Python Version 2.7
+    :platform: Windows 10
+    :synopsis: work queue of zone, year, and month units on a shared folder
+
+.. moduleauthor:: Maura Rowell <mkrowell@uw.edu>
+'''
+
+
+# ------------------------------------------------------------------------------
+# IMPORTS
+# ------------------------------------------------------------------------------
+import argparse
+import errno
+import json
+import logging
+import multiprocessing
+import os
+from os.path import exists, join
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from . import parallel
+from . import util
+
+
+# ------------------------------------------------------------------------------
+# PARAMETERS
+# ------------------------------------------------------------------------------
+logger = logging.getLogger(__name__)
+
+# Seconds without a heartbeat after which a lease may be claimed by another worker
+LEASE_TTL = 600
+# Seconds between heartbeats of a running unit
+HEARTBEAT = 30
+# Seconds a worker waits before looking for a unit again
+POLL = 10
+# Failures after which a unit is not tried again
+MAX_ATTEMPTS = 2
+
+PLAN = 'plan.json'
+STATES = ('done', 'failed', 'blocked', 'leased', 'waiting', 'ready')
+
+
+# ------------------------------------------------------------------------------
+# HELPERS
+# ------------------------------------------------------------------------------
+def unit_id(kind, zone, year, month = None):
+    '''
+    Return the name of a unit, which is also the name of its files.
+
+    :param kind: 'month', 'merge', or 'mmsi'
+    :param zone: Zone of the unit
+    :param year: Year of the unit
+    :param month: Month of the unit, None for the MMSI pass of a year
+
+    :type kind: string
+    :type zone: string
+    :type year: string
+    :type month: string
+
+    :return: Unit name
+    :rtype: string
+    '''
+    parts = [kind, zone, year] + ([month] if month is not None else [])
+    return '-'.join(parts)
+
+def plan_units(zones, years, months):
+    '''
+    Return the units of every zone, year, and month, with the units each
+    depends on. Each month is staged in its own workspace by a month unit
+    and merged into the MMSI gdb or store of its zone and year by a merge
+    unit. Merges of a zone and year run in month order, one at a time, so
+    the shared MMSI output is only written by one worker. The MMSI unit of a
+    zone and year runs once all of its months are merged.
+
+    :param zones: Zones to process
+    :param years: Years to process
+    :param months: Months to process
+
+    :type zones: list of strings
+    :type years: list of strings
+    :type months: list of strings
+
+    :return: Units as dictionaries of id, kind, zone, year, month, and after
+    :rtype: list of dicts
+    '''
+    units = []
+    for zone in zones:
+        for year in years:
+            merges = []
+            for month in months:
+                staged = unit_id('month', zone, year, month)
+                units.append({
+                    'id': staged, 'kind': 'month',
+                    'zone': zone, 'year': year, 'month': month, 'after': []})
+                merge = unit_id('merge', zone, year, month)
+                units.append({
+                    'id': merge, 'kind': 'merge',
+                    'zone': zone, 'year': year, 'month': month,
+                    'after': [staged] + merges[-1:]})
+                merges.append(merge)
+            units.append({
+                'id': unit_id('mmsi', zone, year), 'kind': 'mmsi',
+                'zone': zone, 'year': year, 'month': None, 'after': merges})
+    return units
+
+def read_json(path):
+    '''
+    Return the contents of a json file, or None if it does not exist or is
+    being written.
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    '''
+    Write a json file under a temporary name and rename it into place, so
+    readers on other hosts never see a partial file.
+    '''
+    temp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    with open(temp, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    util.replace_file(temp, path)
+
+def make_folder(folder):
+    '''
+    Create a folder and its parents, if another worker has not already.
+    '''
+    try:
+        os.makedirs(folder)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def run_unit(directory, unit, month_options, mmsi_options):
+    '''
+    Run one unit with the Raw_Month or Raw_MMSI options of the worker.
+
+    :param directory: Root directory for the data
+    :param unit: Unit from the plan
+    :param month_options: Keyword options passed to Raw_Month
+    :param mmsi_options: Keyword options passed to Raw_MMSI
+
+    :type directory: string
+    :type unit: dict
+    :type month_options: dict
+    :type mmsi_options: dict
+    '''
+    from . import raw
+
+    zone, year, month = unit['zone'], unit['year'], unit['month']
+    if unit['kind'] == 'month':
+        parallel.preprocess_staged(
+            (directory, zone, year, month, month_options, False))
+    elif unit['kind'] == 'merge':
+        raw_month = raw.Raw_Month(
+            directory, zone, year, month, staged=True, **month_options)
+        raw_month.merge_month()
+    elif unit['kind'] == 'mmsi':
+        raw_mmsi = raw.Raw_MMSI(directory, zone, year, **mmsi_options)
+        raw_mmsi.preprocess_mmsi()
+    else:
+        raise ValueError('Unknown unit kind %s.' % unit['kind'])
+
+
+# ------------------------------------------------------------------------------
+# LEASE
+# ------------------------------------------------------------------------------
+class Lease(object):
+
+    '''
+    Claim of one unit by one worker. The lease is the file
+    ``leases/<unit>.<generation>.lease``, created with O_EXCL so only one
+    worker can create each generation; its modification time is the last
+    heartbeat. A lease whose heartbeat is older than the TTL has expired,
+    and the next generation may be claimed by any worker.
+    '''
+
+    def __init__(self, unit, generation, path, token, worker):
+        self.unit = unit
+        self.generation = generation
+        self.path = path
+        self.token = token
+        self.worker = worker
+
+
+class Heartbeat(threading.Thread):
+
+    '''
+    Daemon thread that renews a lease every interval seconds while its unit
+    runs. If the lease is found to have been taken over, lost is set and
+    the thread stops.
+    '''
+
+    def __init__(self, queue, lease, interval = HEARTBEAT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.lease = lease
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.renew(self.lease):
+                self.lost = True
+                logger.warning(
+                    'Lease of %s was taken over by another worker.',
+                    self.lease.unit['id'])
+                return
+
+    def stop(self):
+        '''
+        Stop renewing the lease and wait for the thread to finish.
+        '''
+        self.stopped.set()
+        self.join()
+
+
+# ------------------------------------------------------------------------------
+# WORK QUEUE
+# ------------------------------------------------------------------------------
+class WorkQueue(object):
+
+    '''
+    Queue of units kept in a folder that every worker can reach, such as a
+    network share. The folder holds:
+
+    - ``plan.json``: the data directory and the units with their dependencies
+    - ``leases/``: one file per claimed unit, see Lease
+    - ``done/``: one marker file per finished unit
+    - ``failed/``: one json record per failed attempt, with the traceback
+
+    No process coordinates the workers; they only create, touch, and rename
+    files. A unit is ready once every unit it depends on is done, and is not
+    tried again once it has failed max_attempts times. Units that depend on
+    a unit that failed are blocked.
+    '''
+
+    def __init__(self, directory, ttl = LEASE_TTL, max_attempts = MAX_ATTEMPTS):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.plan_path = join(directory, PLAN)
+        for folder in ('leases', 'done', 'failed'):
+            make_folder(join(directory, folder))
+        self.plan = None
+
+    # PLAN ---------------------------------------------------------------------
+    def submit(self, directory, zones, years, months):
+        '''
+        Add the units of every zone, year, and month to the plan. Units that
+        are already in the plan are kept with their state, so a request can
+        be submitted again or extended while workers are running. A
+        finished unit that gains units to depend on, such as the MMSI pass of
+        a year that months are added to, runs again once they are done.
+
+        :param directory: Root directory for the data
+        :param zones: Zones to process
+        :param years: Years to process
+        :param months: Months to process
+
+        :type directory: string
+        :type zones: list of strings
+        :type years: list of strings
+        :type months: list of strings
+
+        :return: Number of units added
+        :rtype: int
+        '''
+        plan = read_json(self.plan_path) or {'directory': directory, 'units': []}
+        if plan['directory'] != directory:
+            raise ValueError(
+                'Queue %s is for directory %s.' % (self.directory, plan['directory']))
+
+        known = dict((unit['id'], unit) for unit in plan['units'])
+        added = 0
+        for unit in plan_units(zones, years, months):
+            if unit['id'] in known:
+                # Months added to a zone and year are merged after the others
+                after = known[unit['id']]['after']
+                extra = [u for u in unit['after'] if u not in after]
+                after.extend(extra)
+                if extra and self.is_done(unit['id']):
+                    # The MMSI pass of the year runs again with the new months
+                    os.remove(join(self.directory, 'done', unit['id']))
+                    logger.info(
+                        '%s will run again after %s.', unit['id'], ', '.join(extra))
+                continue
+            plan['units'].append(unit)
+            known[unit['id']] = unit
+            added += 1
+        write_json(self.plan_path, plan)
+        self.plan = plan
+        logger.info('Submitted %d units to %s.', added, self.directory)
+        return added
+
+    def load(self):
+        '''
+        Read the plan and return the units.
+
+        :return: Units in the order they were submitted
+        :rtype: list of dicts
+        '''
+        plan = read_json(self.plan_path)
+        if plan is None:
+            raise ValueError('Queue %s has no plan.' % self.directory)
+        self.plan = plan
+        return plan['units']
+
+    @property
+    def data_directory(self):
+        '''
+        Return the root directory for the data of the plan.
+        '''
+        if self.plan is None:
+            self.load()
+        return self.plan['directory']
+
+    # STATE --------------------------------------------------------------------
+    def is_done(self, uid):
+        '''
+        Return True if a unit has finished.
+        '''
+        return exists(join(self.directory, 'done', uid))
+
+    def attempts(self, uid):
+        '''
+        Return the number of failed attempts of a unit.
+        '''
+        prefix = uid + '.'
+        return sum(
+            1 for name in os.listdir(join(self.directory, 'failed'))
+            if name.startswith(prefix) and name.endswith('.json'))
+
+    def generations(self, uid):
+        '''
+        Return the generations of the lease files of a unit, in order.
+        '''
+        prefix = uid + '.'
+        generations = []
+        for name in os.listdir(join(self.directory, 'leases')):
+            if not (name.startswith(prefix) and name.endswith('.lease')):
+                continue
+            generation = name[len(prefix):-len('.lease')]
+            if generation.isdigit():
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def lease_path(self, uid, generation):
+        '''
+        Return the path of a lease file.
+        '''
+        return join(self.directory, 'leases', '%s.%d.lease' % (uid, generation))
+
+    def heartbeat_age(self, uid, generation):
+        '''
+        Return the seconds since the last heartbeat of a lease, or None if
+        the lease file is gone.
+        '''
+        try:
+            return time.time() - os.path.getmtime(self.lease_path(uid, generation))
+        except OSError:
+            return None
+
+    def is_leased(self, uid):
+        '''
+        Return True if a unit has a lease that has not expired.
+        '''
+        generations = self.generations(uid)
+        if not generations:
+            return False
+        age = self.heartbeat_age(uid, generations[-1])
+        return age is not None and age < self.ttl
+
+    def states(self):
+        '''
+        Return the state of every unit: done, failed, blocked by a failed
+        unit it depends on, leased, waiting for units it depends on, or
+        ready to be claimed.
+
+        :return: Dictionary of unit id to state
+        :rtype: dict
+        '''
+        units = dict((unit['id'], unit) for unit in self.load())
+        done = set(os.listdir(join(self.directory, 'done')))
+        failed = {}
+        for name in os.listdir(join(self.directory, 'failed')):
+            if name.endswith('.json'):
+                uid = name.split('.')[0]
+                failed[uid] = failed.get(uid, 0) + 1
+
+        states = {}
+
+        def resolve(uid):
+            # Units added by a later submit may come after the units that
+            # depend on them, so the units each depends on are resolved first
+            if uid in states:
+                return states[uid]
+            if uid not in units:
+                return 'waiting'
+            after = [resolve(u) for u in units[uid]['after']]
+            if uid in done:
+                state = 'done'
+            elif failed.get(uid, 0) >= self.max_attempts:
+                state = 'failed'
+            elif any(other in ('failed', 'blocked') for other in after):
+                state = 'blocked'
+            elif self.is_leased(uid):
+                state = 'leased'
+            elif any(other != 'done' for other in after):
+                state = 'waiting'
+            else:
+                state = 'ready'
+            states[uid] = state
+            return state
+
+        for uid in units:
+            resolve(uid)
+        return states
+
+    def summary(self):
+        '''
+        Return the number of units in each state.
+
+        :return: Dictionary of state to count
+        :rtype: dict
+        '''
+        counts = dict((state, 0) for state in STATES)
+        for state in self.states().values():
+            counts[state] += 1
+        return counts
+
+    def finished(self):
+        '''
+        Return True if no unit is left to run: every unit is done, failed,
+        or blocked.
+        '''
+        return all(
+            state in ('done', 'failed', 'blocked') for state in self.states().values())
+
+    # LEASES -------------------------------------------------------------------
+    def claim(self, worker):
+        '''
+        Claim the first ready unit of the plan.
+
+        :param worker: Name of the claiming worker
+        :type worker: string
+
+        :return: Unit and lease, or None if no unit is ready
+        :rtype: tuple
+        '''
+        states = self.states()
+        for unit in self.plan['units']:
+            if states[unit['id']] != 'ready':
+                continue
+            lease = self.acquire(unit, worker)
+            if lease is not None:
+                return unit, lease
+        return None
+
+    def acquire(self, unit, worker):
+        '''
+        Create the next generation of the lease of a unit, if its current
+        lease has expired. Returns None if another worker holds or claimed
+        it first.
+        '''
+        uid = unit['id']
+        generations = self.generations(uid)
+        if generations:
+            age = self.heartbeat_age(uid, generations[-1])
+            if age is not None and age < self.ttl:
+                return None
+        generation = (generations[-1] if generations else 0) + 1
+
+        path = self.lease_path(uid, generation)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return None
+            raise
+        lease = Lease(unit, generation, path, uuid.uuid4().hex, worker)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'token': lease.token, 'worker': worker, 'host': socket.gethostname(),
+                'pid': os.getpid(), 'claimed': time.time()}, f)
+
+        # The unit may have finished between reading its state and the claim
+        if self.is_done(uid):
+            self.release(lease)
+            return None
+        for old in generations:
+            try:
+                os.remove(self.lease_path(uid, old))
+            except OSError:
+                pass
+        if generations:
+            logger.warning(
+                'Lease %d of %s expired; claimed by %s.', generations[-1], uid, worker)
+        return lease
+
+    def holds(self, lease):
+        '''
+        Return True if a lease is still the current lease of its unit.
+        '''
+        generations = self.generations(lease.unit['id'])
+        if not generations or generations[-1] != lease.generation:
+            return False
+        data = read_json(lease.path)
+        return data is not None and data.get('token') == lease.token
+
+    def renew(self, lease):
+        '''
+        Record a heartbeat on a lease. Returns False if the lease was taken
+        over by another worker.
+        '''
+        if not self.holds(lease):
+            return False
+        try:
+            os.utime(lease.path, None)
+        except OSError:
+            return False
+        return True
+
+    def release(self, lease):
+        '''
+        Remove a lease file if it is still held.
+        '''
+        if not self.holds(lease):
+            return
+        try:
+            os.remove(lease.path)
+        except OSError:
+            pass
+
+    def complete(self, lease):
+        '''
+        Mark the unit of a lease done and release the lease.
+        '''
+        uid = lease.unit['id']
+        write_json(join(self.directory, 'done', uid), {
+            'worker': lease.worker, 'generation': lease.generation,
+            'finished': time.time()})
+        self.release(lease)
+
+    def fail(self, lease, error):
+        '''
+        Record a failed attempt of the unit of a lease and release the lease.
+
+        :param lease: Lease of the unit
+        :param error: Traceback or message of the error
+
+        :type lease: Lease
+        :type error: string
+        '''
+        uid = lease.unit['id']
+        path = join(self.directory, 'failed', '%s.%s.json' % (uid, lease.token))
+        write_json(path, {
+            'worker': lease.worker, 'generation': lease.generation,
+            'failed': time.time(), 'error': error})
+        self.release(lease)
+
+    def report(self):
+        '''
+        Log the number of units in each state.
+        '''
+        counts = self.summary()
+        logger.info(
+            'Queue %s: %s.', self.directory,
+            ', '.join('%d %s' % (counts[state], state) for state in STATES))
+
+
+# ------------------------------------------------------------------------------
+# WORKER
+# ------------------------------------------------------------------------------
+class Worker(object):
+
+    '''
+    Loop that claims units from a queue and runs them until no unit is left
+    to run. Any number of workers may run on any host that can reach the
+    queue folder and the data directory. The Raw_Month and Raw_MMSI options
+    belong to the worker, so each process can pass its own manifest, cache,
+    or memory budget.
+
+    The number of units done, failed, and lost to another worker is kept in
+    stats, with the seconds spent running and waiting.
+    '''
+
+    def __init__(self, queue, month_options = None, mmsi_options = None,
+                 worker = None, runner = run_unit, heartbeat = HEARTBEAT,
+                 poll = POLL):
+        self.queue = queue
+        self.month_options = month_options or {}
+        self.mmsi_options = mmsi_options or {}
+        self.worker = worker or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.runner = runner
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.stats = {
+            'done': 0, 'failed': 0, 'lost': 0, 'running': 0.0, 'waiting': 0.0}
+
+    def run(self):
+        '''
+        Run units until every unit of the queue is done, failed, or blocked.
+
+        :return: Units done, failed, and lost, and seconds running and waiting
+        :rtype: dict
+        '''
+        directory = self.queue.data_directory
+        while True:
+            claimed = self.queue.claim(self.worker)
+            if claimed is None:
+                if self.queue.finished():
+                    break
+                time.sleep(self.poll)
+                self.stats['waiting'] += self.poll
+                continue
+            unit, lease = claimed
+            self.run_unit(directory, unit, lease)
+        self.report()
+        return self.stats
+
+    def run_unit(self, directory, unit, lease):
+        '''
+        Run one claimed unit while a heartbeat renews its lease, and record
+        the result if the lease is still held.
+        '''
+        logger.info('%s running %s...', self.worker, unit['id'])
+        start = time.time()
+        heartbeat = Heartbeat(self.queue, lease, self.heartbeat)
+        heartbeat.start()
+        error = None
+        try:
+            self.runner(directory, unit, self.month_options, self.mmsi_options)
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            heartbeat.stop()
+            self.stats['running'] += time.time() - start
+
+        if heartbeat.lost or not self.queue.holds(lease):
+            # Another worker claimed the unit and records its result
+            self.stats['lost'] += 1
+            return
+        if error is not None:
+            logger.error('%s failed %s:\n%s', self.worker, unit['id'], error)
+            self.queue.fail(lease, error)
+            self.stats['failed'] += 1
+            return
+        self.queue.complete(lease)
+        self.stats['done'] += 1
+
+    def report(self):
+        '''
+        Log the units run by the worker and the time it spent waiting.
+        '''
+        logger.info(
+            '%s: %d done, %d failed, %d lost; %.1fs running, %.1fs waiting.',
+            self.worker, self.stats['done'], self.stats['failed'],
+            self.stats['lost'], self.stats['running'], self.stats['waiting'])
+
+
+# ------------------------------------------------------------------------------
+# DRIVER
+# ------------------------------------------------------------------------------
+def work(queue_directory, options):
+    '''
+    Run one worker on a queue. Target of the local worker processes.
+
+    :param queue_directory: Folder of the queue
+    :param options: Keyword options passed to Worker
+
+    :type queue_directory: string
+    :type options: dict
+
+    :return: Worker stats
+    :rtype: dict
+    '''
+    return Worker(WorkQueue(queue_directory), **options).run()
+
+def run_workers(queue_directory, processes = None, **options):
+    '''
+    Run workers on a queue in local processes and wait for them to finish.
+    Workers on other hosts may run on the same queue at the same time.
+
+    On Windows this must be called from under an
+    ``if __name__ == '__main__':`` guard.
+
+    :param queue_directory: Folder of the queue
+    :param processes: Number of worker processes, default is the CPU count
+    :param options: Keyword options passed to Worker
+
+    :type queue_directory: string
+    :type processes: int
+    :type options: dict
+
+    :return: Number of units in each state
+    :rtype: dict
+    '''
+    workers = [
+        multiprocessing.Process(target=work, args=(queue_directory, options))
+        for _ in range(processes or multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    queue = WorkQueue(queue_directory)
+    queue.report()
+    return queue.summary()
+
+
+# ------------------------------------------------------------------------------
+# COMMAND LINE
+# ------------------------------------------------------------------------------
+def main(argv = None):
+    '''
+    Submit units to a queue, run workers on it, or show its state:
+
+        python -m ais_arcpy.workqueue submit QUEUE ROOT --zones 10 11 --years 2014
+        python -m ais_arcpy.workqueue work QUEUE --processes 4
+        python -m ais_arcpy.workqueue status QUEUE
+    '''
+    parser = argparse.ArgumentParser(description='AIS work queue')
+    commands = parser.add_subparsers(dest='command')
+
+    submit = commands.add_parser('submit', help='add units to a queue')
+    submit.add_argument('queue')
+    submit.add_argument('directory')
+    submit.add_argument('--zones', nargs='+', required=True)
+    submit.add_argument('--years', nargs='+', required=True)
+    submit.add_argument(
+        '--months', nargs='+', default=['%02d' % i for i in range(1, 13)])
+
+    run = commands.add_parser('work', help='run workers on a queue')
+    run.add_argument('queue')
+    run.add_argument('--processes', type=int, default=1)
+
+    status = commands.add_parser('status', help='count units by state')
+    status.add_argument('queue')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(processName)s %(message)s')
+    queue = WorkQueue(args.queue)
+    if args.command == 'submit':
+        queue.submit(args.directory, args.zones, args.years, args.months)
+    elif args.command == 'work':
+        run_workers(args.queue, args.processes)
+    queue.report()
+
+
+if __name__ == '__main__':
+    main()